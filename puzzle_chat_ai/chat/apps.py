@@ -1,6 +1,34 @@
+import logging
+import sys
+import threading
+
 from django.apps import AppConfig
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _is_server_process():
+    """True under daphne/uvicorn or `manage.py runserver`, False for other management commands."""
+    if len(sys.argv) > 1 and sys.argv[0].endswith('manage.py'):
+        return sys.argv[1] == 'runserver'
+    return True
+
+
+def _warm_judge_cache():
+    from django.core.management import call_command
+    try:
+        call_command('warm_judge_cache', source='db', verbosity=0)
+        logger.info("Judge verdict cache warmed at startup")
+    except Exception as e:
+        logger.error(f"Failed to warm judge verdict cache: {e}")
 
 
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        # 部署時預熱裁判快取，在背景執行不拖慢啟動
+        if getattr(settings, 'JUDGE_CACHE_WARM_ON_STARTUP', False) and _is_server_process():
+            threading.Thread(target=_warm_judge_cache, name='warm-judge-cache', daemon=True).start()
@@ -15,6 +15,44 @@ MESSAGE_TYPES = {
     'SUGGESTION_RESPONSE': 'suggestion_response',
     'SHARED_MESSAGE': 'shared_message',
     'MARK_MESSAGES_READ': 'mark_messages_read',
+    'RESYNC': 'resync',
+    'SNAPSHOT': 'snapshot',
+    'RECONNECT': 'reconnect',
+}
+
+# Short field ids of the MessagePack wire encoding (subprotocol
+# puzzle-chat.msgpack.v1). Append only: ids are part of the protocol.
+# Keys not listed here are sent as strings.
+WIRE_FIELD_IDS = {
+    'type': 0,
+    'message': 1,
+    'user_name': 2,
+    'sender': 3,
+    'timestamp': 4,
+    'message_id': 5,
+    'seq': 6,
+    'reply_text': 7,
+    'reply_author': 8,
+    'is_solution': 9,
+    'user_message': 10,
+    'ai_message': 11,
+    'ai_reply_content': 12,
+    'awareness_summary': 13,
+    'liked_by': 14,
+    'count': 15,
+    'mode': 16,
+    'idempotency_key': 17,
+    'replayed': 18,
+    'last_seq': 19,
+    'messages': 20,
+    'ai_messages': 21,
+    'winner': 22,
+    'final_answer': 23,
+    'winning_message': 24,
+    'request_type': 25,
+    'retry_after': 26,
+    'messageId': 27,
+    'responseType': 28,
 }
 
 # AI Models Configuration
@@ -62,17 +100,139 @@ OPENAI_CONFIG = {
     'RESPONSE_FORMAT_JSON': {'type': 'json_object'},
 }
 
-# Fixed Puzzle Configuration
+# Model routing: thresholds over a rolling window per model; when the requested
+# model is over any of them, tasks whose policy allows it move to AI_MODELS['FAST']
+MODEL_ROUTING = {
+    'ENABLED': True,
+    'WINDOW_SECONDS': 60,
+    'MIN_SAMPLES': 5,
+    'MAX_ERROR_RATE': 0.2,
+    'MAX_P90_LATENCY': 8.0,  # seconds
+    'MAX_IN_FLIGHT': 20,
+}
+
+# Per-task routing policy; the judge and solution checks need precision
+MODEL_TASK_POLICIES = {
+    'judge': {'downgrade': False},
+    'solution_check': {'downgrade': False},
+    'suggestion': {'downgrade': True},
+    'hint': {'downgrade': True},
+    'summary': {'downgrade': True},
+}
+
+# The only answers the judge gives to a question
+JUDGE_VERDICTS = ('是', '否', '是也不是', '與此無關')
+
+# Approximate list prices in USD per 1M tokens (input, cached input, output),
+# used by the usage_report command to estimate cost
+AI_MODEL_PRICES = {
+    'gpt-4o': (2.50, 1.25, 10.00),
+    'gpt-4.1': (2.00, 0.50, 8.00),
+    'gpt-4-turbo': (10.00, 10.00, 30.00),
+    'gpt-4': (30.00, 30.00, 60.00),
+    'gpt-3.5-turbo': (0.50, 0.50, 1.50),
+}
+
+# Fixed Puzzle Configuration: the built-in puzzle, used by rooms without an
+# assignment unless the catalog has its own row for DEFAULT_SLUG
 FIXED_PUZZLE = {
     "question": "一名男子在餐廳吃完午餐，服務生拿來了帳單。他開了一張金額相符的支票，但突然將支票翻過來，在背面寫了幾句話恭喜餐廳老闆。為什麼？",
     "answer": """這名男子是一位世界聞名的人。他發現了一個巧妙的支付方式：在支付帳單時，他會開一張支票，然後在支票的背面，寫下幾句話並附上他獨特的簽名。他知道，對於餐廳老闆來說，一張帶有他親筆簽名的支票，其收藏價值，遠遠超過了帳單上的金額。因此，老闆會很樂意地收下這張支票並將其收藏，而不會拿去兌現。這成了一種雙贏的交換。"""
 }
 
+# Puzzle catalog (chat.services.puzzle_catalog): compiled per-puzzle assets are
+# kept in an in-process LRU of MAX_ASSETS puzzles for ASSET_TTL seconds
+PUZZLE_CATALOG = {
+    'DEFAULT_SLUG': 'default',
+    'MAX_ASSETS': 16,
+    'ASSET_TTL': 3600,
+    'INDEX_RETRY': 60,  # seconds before looking again for a puzzle's missing warm index
+    'PREFILTER_MIN_HITS': 2,  # curated solution keywords a chat message needs before the solution check runs (derived: 1)
+    'SIMILARITY_THRESHOLD': 0.8,  # bigram Jaccard for reusing a warm verdict of a near-identical question (JUDGE_WARM_FUZZY_MATCH)
+}
+
+# Local judge classifier (chat.services.judge_classifier, train_judge_model).
+# Shadow agreement is counted per CONFIDENCE_BUCKETS lower bound.
+JUDGE_CLASSIFIER = {
+    'NGRAM_MAX': 3,
+    'L2': 1e-3,
+    'EPOCHS': 500,
+    'LEARNING_RATE': 2.0,
+    'HOLDOUT': 0.2,  # share of distinct questions held out to calibrate and evaluate
+    'CONFIDENCE_BUCKETS': (0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99),
+    'RELOAD_INTERVAL': 300,
+}
+
 # Cache Configuration
 CACHE_CONFIG = {
     'AI_RESPONSE_TIMEOUT': 3600,  # 1 hour
     'USER_SESSION_TIMEOUT': 1800,  # 30 minutes
     'DEFAULT_TIMEOUT': 300,  # 5 minutes
+    'ROOM_LIFETIME_TIMEOUT': 21600,  # 6 hours, longer than any game
+    'JUDGE_WARM_TIMEOUT': 604800,  # 7 days, refreshed on every deploy
+    'IDEMPOTENCY_TIMEOUT': 600,  # 10 minutes, longer than any client retry
+    'IDEMPOTENCY_PENDING_TIMEOUT': 120,  # longest an action may stay in progress
+    'ROOM_EVENT_BUFFER_TIMEOUT': 900,  # 15 minutes of recent room events for resync
+}
+
+# Reconnect resync: a client that missed more events than MAX_REPLAY gets a
+# snapshot of the room instead of the individual events
+ROOM_RESYNC = {
+    'MAX_REPLAY': 200,
+    'SNAPSHOT_MESSAGES': 100,
+}
+
+# Room events that get a sequence number and are kept for resync; typing and
+# read receipts are ephemeral and are not replayed
+SEQUENCED_EVENT_TYPES = ('chat_message', 'shared_message', 'like_update', 'game_over')
+
+# Message types handled in a per-connection background task, so a slow AI call
+# neither blocks the consumer nor outlives a disconnect. persist=True keeps the
+# job running after the client leaves; otherwise it is cancelled.
+BACKGROUND_MESSAGE_TYPES = {
+    MESSAGE_TYPES['AI_MESSAGE']: {'persist': False},  # personal hint
+}
+
+# Message types that change state; a client retry carrying the same
+# idempotency key gets the original result instead of a second run
+IDEMPOTENT_MESSAGE_TYPES = (
+    MESSAGE_TYPES['CHAT_MESSAGE'],
+    MESSAGE_TYPES['AI_MESSAGE'],
+    MESSAGE_TYPES['LIKE_MESSAGE'],
+    MESSAGE_TYPES['SUGGESTION_RESPONSE'],
+)
+
+# Per-connection outbound queue. Past MAX_SIZE queued frames, ephemeral frames
+# are shed first; critical frames (and direct replies) are always delivered.
+# Frames with a coalesce slot replace a queued frame in the same slot.
+OUTBOUND_QUEUE = {
+    'MAX_SIZE': 64,
+}
+OUTBOUND_POLICIES = {
+    'typing_indicator': {'priority': 'ephemeral', 'coalesce': ('typing', 'user_name')},
+    'stop_typing_indicator': {'priority': 'ephemeral', 'coalesce': ('typing', 'user_name')},
+    'like_update': {'priority': 'normal', 'coalesce': ('like', 'message_id')},
+    'chat_message': {'priority': 'critical'},
+    'shared_message': {'priority': 'critical'},  # AI answers as partners see them
+    'game_over': {'priority': 'critical'},
+}
+
+# Graceful drain on shutdown (chat.services.drain). In-flight AI jobs get
+# DRAIN_DEADLINE_SECONDS; then every connection is told to reconnect and closed.
+DRAIN = {
+    'CLOSE_CODE': 4012,  # "service restart" (1012) in the application range, the only codes daphne can send
+    'WRITE_TIMEOUT': 2.0,  # seconds to deliver queued messages and frames before closing a connection
+}
+
+# Rate limits per message type: scope -> (max messages, window in seconds)
+RATE_LIMITS = {
+    MESSAGE_TYPES['AI_MESSAGE']: {'user': (6, 60), 'room': (20, 60)},
+    MESSAGE_TYPES['CHAT_MESSAGE']: {'user': (30, 60), 'room': (120, 60)},
+    MESSAGE_TYPES['LIKE_MESSAGE']: {'user': (60, 60), 'room': (240, 60)},
+    MESSAGE_TYPES['SUGGESTION_RESPONSE']: {'user': (30, 60)},
+    MESSAGE_TYPES['TYPING']: {'user': (120, 60), 'room': (600, 60)},
+    MESSAGE_TYPES['STOP_TYPING']: {'user': (120, 60), 'room': (600, 60)},
+    MESSAGE_TYPES['RESYNC']: {'user': (10, 60)},
 }
 
 # Error Messages
@@ -82,4 +242,5 @@ ERROR_MESSAGES = {
     'DATABASE_ERROR': 'Database operation failed',
     'AUTHENTICATION_ERROR': 'User authentication failed',
     'RATE_LIMIT_EXCEEDED': 'Too many requests, please try again later',
+    'SERVER_DRAINING': 'Server is restarting, please reconnect and try again',
 }
\ No newline at end of file
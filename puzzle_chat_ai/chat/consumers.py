@@ -2,13 +2,23 @@
 Refactored ChatConsumer with separation of concerns and improved architecture.
 """
 
+import asyncio
 import json
 import logging
+import time
 from channels.generic.websocket import AsyncWebsocketConsumer
 
-from .constants import MESSAGE_TYPES, DEFAULTS, ERROR_MESSAGES
+from .constants import MESSAGE_TYPES, DEFAULTS, DRAIN, ERROR_MESSAGES, BACKGROUND_MESSAGE_TYPES, IDEMPOTENT_MESSAGE_TYPES
 from .services.message_handler import MessageHandler
 from .services.db_service import db_service
+from .services.drain import drain
+from .services.idempotency import client_key, idempotency_store
+from .services.outbound import OutboundQueue
+from .services.puzzle_catalog import puzzle_catalog
+from .services.wire import DECODE_ERRORS, negotiate
+from .services.rate_limiter import rate_limiter
+from .services.task_tracker import ConnectionTasks
+from .services import metrics, tracing
 
 logger = logging.getLogger(__name__)
 
@@ -21,11 +31,26 @@ class ChatConsumer(AsyncWebsocketConsumer):
     
     async def connect(self):
         """Handle WebSocket connection."""
+        if not drain.accepting:
+            # The worker is shutting down; the client reconnects to another one
+            await self.close(code=DRAIN['CLOSE_CODE'])
+            return
+        self.tasks = ConnectionTasks(self.channel_name)
+        self.outbound = OutboundQueue(self._write, self.channel_name)
+        # JSON text frames unless the client offered the msgpack subprotocol
+        self.codec = negotiate(self.scope.get('subprotocols'))
         try:
             await self._parse_connection_params()
             await self._join_room()
             await self._create_user()
-            await self.accept()
+            # The room's puzzle and its compiled assets, resolved once per connection
+            self.puzzle = await puzzle_catalog.for_room(self.room_name)
+            await self.accept(subprotocol=self.codec.subprotocol)
+            # Frames are written by one task per connection, so a slow client never blocks event handlers
+            self.tasks.spawn(self.outbound.run(), name=f"outbound:{self.channel_name}")
+            self._connection_counted = True
+            drain.register(self)
+            metrics.connection_opened()
             logger.info(f"User {self.user_name} connected to room {self.room_name}")
         except Exception as e:
             logger.error(f"Connection failed: {e}")
@@ -33,93 +58,196 @@ class ChatConsumer(AsyncWebsocketConsumer):
     
     async def disconnect(self, close_code):
         """Handle WebSocket disconnection."""
+        drain.unregister(self)
+        if getattr(self, '_connection_counted', False):
+            self._connection_counted = False
+            metrics.connection_closed()
+        if hasattr(self, 'tasks'):
+            cancelled = self.tasks.close()
+            if cancelled:
+                logger.info(f"Cancelled {cancelled} background task(s) of {getattr(self, 'user_name', None)}")
         if hasattr(self, 'room_group_name'):
-            await self.channel_layer.group_discard(
-                self.room_group_name,
-                self.channel_name
-            )
+            try:
+                await self.channel_layer.group_discard(
+                    self.room_group_name,
+                    self.channel_name
+                )
+            except Exception:
+                metrics.channel_layer_failed('group_discard')
+                raise
             logger.info(f"User {self.user_name} disconnected from room {self.room_name}")
     
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """Handle incoming WebSocket messages."""
-        try:
-            data = json.loads(text_data)
-            message_type = data.get('type')
-            
-            if not message_type:
+        started = time.perf_counter()
+        message_type = None
+        with tracing.span('ws.receive', room=self.room_name, user=self.user_name) as trace:
+            try:
+                try:
+                    data = self.codec.decode(text_data if text_data is not None else bytes_data)
+                except json.JSONDecodeError:
+                    await self._send_error("Invalid JSON format")
+                    return
+                except DECODE_ERRORS:
+                    await self._send_error("Invalid MessagePack format")
+                    return
+                message_type = data.get('type')
+                trace.set_attribute('type', metrics.message_type_label(message_type))
+                
+                if not message_type:
+                    await self._send_error(ERROR_MESSAGES['INVALID_MESSAGE'])
+                    return
+                
+                # A retried action gets its original result instead of running twice
+                key = client_key(data) if message_type in IDEMPOTENT_MESSAGE_TYPES else None
+                if key is not None:
+                    record = idempotency_store.claim(self.room_name, self.user_name, key)
+                    if record is not None:
+                        trace.set_attribute('idempotent_replay', True)
+                        self.tasks.spawn(
+                            self._replay_or_run(message_type, data, key, record),
+                            name=f"replay:{message_type}:{self.user_name}"
+                        )
+                        return
+                
+                # Per-user / per-room budgets before any AI call or DB write
+                retry_after = rate_limiter.hit(message_type, self.user_name, self.room_name)
+                if retry_after is not None:
+                    trace.set_attribute('rate_limited', True)
+                    if key is not None:
+                        idempotency_store.release(self.room_name, self.user_name, key)
+                    await self._send_rate_limited(message_type, retry_after)
+                    return
+                
+                # Delegate to message handler; slow jobs run in the background
+                handler = MessageHandler(self)
+                policy = BACKGROUND_MESSAGE_TYPES.get(message_type)
+                if policy is not None:
+                    if not drain.accepting:
+                        # Shutting down: the client resends it with the same key after reconnecting
+                        drain.refuse(message_type, self.user_name)
+                        if key is not None:
+                            idempotency_store.release(self.room_name, self.user_name, key)
+                        await self._send_draining(message_type)
+                        return
+                    drain.track(self.tasks.spawn(
+                        self._handle_in_background(handler, message_type, data, started, key),
+                        persist=policy['persist'],
+                        name=f"{message_type}:{self.user_name}"
+                    ))
+                    started = None
+                    return
+                with idempotency_store.recording(self.room_name, self.user_name, key):
+                    await handler.handle_message(message_type, data)
+                
+            except Exception as e:
+                trace.record_error(e)
+                logger.error(f"Error processing message: {e}")
                 await self._send_error(ERROR_MESSAGES['INVALID_MESSAGE'])
-                return
-            
-            # Delegate to message handler
-            handler = MessageHandler(self)
-            await handler.handle_message(message_type, data)
-            
-        except json.JSONDecodeError:
-            await self._send_error("Invalid JSON format")
-        except Exception as e:
-            logger.error(f"Error processing message: {e}")
-            await self._send_error(ERROR_MESSAGES['INVALID_MESSAGE'])
+            finally:
+                if started is not None:
+                    metrics.observe_message(message_type, started)
+    
+    async def _handle_in_background(
+        self,
+        handler: MessageHandler,
+        message_type: str,
+        data: dict,
+        started: float,
+        key: str = None
+    ):
+        """Run a handler as a tracked task; it is cancelled on disconnect unless it persists."""
+        try:
+            with idempotency_store.recording(self.room_name, self.user_name, key):
+                await handler.handle_message(message_type, data)
+        except asyncio.CancelledError:
+            logger.info(f"{message_type} of {self.user_name} cancelled after disconnect")
+            raise
+        finally:
+            metrics.observe_message(message_type, started)
+    
+    async def _replay_or_run(self, message_type: str, data: dict, key: str, record: dict):
+        """Answer a duplicate from the stored result; run it after all if the original failed."""
+        if not await idempotency_store.replay(self, message_type, key, record):
+            with idempotency_store.recording(self.room_name, self.user_name, key):
+                await MessageHandler(self).handle_message(message_type, data)
+    
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        """
+        Queue a direct reply behind the frames already waiting; drop sends once
+        the client is gone (persistent jobs may still finish).
+        """
+        if getattr(self, 'tasks', None) is not None and self.tasks.closed:
+            return
+        if text_data is not None and not close and getattr(self, 'outbound', None) is not None:
+            if self.codec.binary:
+                text_data = self.codec.encode(json.loads(text_data))
+            self.outbound.put(text_data)
+            return
+        await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+    
+    async def send_frame(self, frame: dict):
+        """Encode a direct reply with the connection's codec and queue it."""
+        if self.tasks.closed:
+            return
+        self.outbound.put(self.codec.encode(frame))
+    
+    async def send_reconnect_hint(self):
+        """Tell the client to reconnect elsewhere once queued messages and frames are written, then close (drain)."""
+        if self.tasks.closed:
+            return
+        await drain.settle(self, DRAIN['WRITE_TIMEOUT'])
+        await self.send_frame({'type': MESSAGE_TYPES['RECONNECT'], 'reason': 'server_restart'})
+        await self.outbound.flush(DRAIN['WRITE_TIMEOUT'])
+        await self.close(code=DRAIN['CLOSE_CODE'])
+    
+    async def drain_settled(self, event):
+        """The drain's marker: everything queued before it has been handled."""
+        drain.settled(self.channel_name)
+    
+    async def _write(self, data):
+        """Write one queued frame to the socket (called by the outbound queue's writer)."""
+        if isinstance(data, bytes):
+            await super().send(bytes_data=data)
+        else:
+            await super().send(text_data=data)
     
     # WebSocket event handlers (called by channel layer)
     
     async def chat_message(self, event):
         """Send chat message to WebSocket."""
-        await self.send(text_data=json.dumps({
-            'type': MESSAGE_TYPES['CHAT_MESSAGE'],
-            **event
-        }))
+        await self._send_event(MESSAGE_TYPES['CHAT_MESSAGE'], event)
     
     async def ai_message(self, event):
         """Send AI message to WebSocket."""
-        await self.send(text_data=json.dumps({
-            'type': MESSAGE_TYPES['AI_MESSAGE'],
-            **event
-        }))
+        await self._send_event(MESSAGE_TYPES['AI_MESSAGE'], event)
     
     async def shared_message(self, event):
         """Send shared message to WebSocket."""
-        await self.send(text_data=json.dumps({
-            'type': MESSAGE_TYPES['SHARED_MESSAGE'],
-            **event
-        }))
+        await self._send_event(MESSAGE_TYPES['SHARED_MESSAGE'], event)
     
     async def like_update(self, event):
         """Send like update to WebSocket."""
-        await self.send(text_data=json.dumps({
-            'type': MESSAGE_TYPES['LIKE_MESSAGE'],
-            **event
-        }))
+        await self._send_event(MESSAGE_TYPES['LIKE_MESSAGE'], event)
     
     async def typing_indicator(self, event):
         """Send typing indicator to WebSocket."""
         # Don't send typing indicator to the sender
         if event.get('user_name') != self.user_name:
-            await self.send(text_data=json.dumps({
-                'type': MESSAGE_TYPES['TYPING'],
-                **event
-            }))
+            await self._send_event(MESSAGE_TYPES['TYPING'], event)
     
     async def stop_typing_indicator(self, event):
         """Send stop typing indicator to WebSocket."""
         if event.get('user_name') != self.user_name:
-            await self.send(text_data=json.dumps({
-                'type': MESSAGE_TYPES['STOP_TYPING'],
-                **event
-            }))
+            await self._send_event(MESSAGE_TYPES['STOP_TYPING'], event)
     
     async def game_over(self, event):
         """Send game over notification to WebSocket."""
-        await self.send(text_data=json.dumps({
-            'type': MESSAGE_TYPES['GAME_OVER'],
-            **event
-        }))
+        await self._send_event(MESSAGE_TYPES['GAME_OVER'], event)
     
     async def mark_messages_read(self, event):
         """Send mark messages read notification to WebSocket."""
-        await self.send(text_data=json.dumps({
-            'type': MESSAGE_TYPES['MARK_MESSAGES_READ'],
-            **event
-        }))
+        await self._send_event(MESSAGE_TYPES['MARK_MESSAGES_READ'], event)
     
     # Private helper methods
     
@@ -144,19 +272,51 @@ class ChatConsumer(AsyncWebsocketConsumer):
     
     async def _join_room(self):
         """Join the room group."""
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+        try:
+            await self.channel_layer.group_add(
+                self.room_group_name,
+                self.channel_name
+            )
+        except Exception:
+            metrics.channel_layer_failed('group_add')
+            raise
     
     async def _create_user(self):
         """Create user in database."""
         if self.user_name:
             await db_service.create_chat_user(self.user_name)
     
+    async def _send_event(self, message_type: str, event: dict):
+        """Forward a channel-layer event to the WebSocket, continuing its trace."""
+        with tracing.continue_from(event, 'ws.deliver', type=message_type, room=self.room_name):
+            payload = {'type': message_type, **event}
+            payload.pop(tracing.TRACE_ID_KEY, None)
+            payload.pop(tracing.TRACE_PARENT_KEY, None)
+            if self.tasks.closed:
+                return
+            # Broadcasts are subject to the queue's shedding and coalescing policy
+            self.outbound.put(self.codec.encode(payload), payload)
+    
+    async def _send_rate_limited(self, message_type: str, retry_after: int):
+        """Tell the client its message was dropped and when to retry."""
+        await self.send_frame({
+            'type': 'error',
+            'message': ERROR_MESSAGES['RATE_LIMIT_EXCEEDED'],
+            'request_type': message_type,
+            'retry_after': retry_after
+        })
+    
+    async def _send_draining(self, message_type: str):
+        """Tell the client its request was not started because the worker is shutting down."""
+        await self.send_frame({
+            'type': 'error',
+            'message': ERROR_MESSAGES['SERVER_DRAINING'],
+            'request_type': message_type
+        })
+    
     async def _send_error(self, error_message: str):
         """Send error message to client."""
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'error',
             'message': error_message
-        }))
\ No newline at end of file
+        })
\ No newline at end of file
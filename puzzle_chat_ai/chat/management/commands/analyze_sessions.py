@@ -0,0 +1,288 @@
+# chat/management/commands/analyze_sessions.py
+
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Case, Count, F, Q, Value, When, CharField
+
+from chat.constants import JUDGE_VERDICTS
+from chat.models import ChatMessage, AIChatMessage
+from chat.management.commands.import_data import find_export_files, read_header, detect_model
+
+# 裁判只會回答這四種，其他內容 (舊版的創作模式、錯誤訊息) 歸為 other
+VERDICTS = list(JUDGE_VERDICTS)
+OTHER_VERDICT = 'other'
+UNKNOWN_MODE = 'unknown'
+
+SUMMARY_COLUMNS = ['metric', 'mode', 'group', 'value']
+
+
+def load_pandas():
+    try:
+        import numpy as np
+        import pandas as pd
+    except ImportError:
+        raise CommandError("analyze_sessions requires numpy and pandas (pip install -r requirements.txt).")
+    return np, pd
+
+
+class Command(BaseCommand):
+    help = 'Computes experiment metrics (suggestion acceptance, verdicts, reply latency, questions per room) from the database or from *_export.csv files.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--source',
+            choices=['db', 'csv'],
+            default='db',
+            help='Read from the database (aggregates run in SQL) or from export CSV files (default: db).'
+        )
+        parser.add_argument(
+            '--paths',
+            nargs='+',
+            type=str,
+            default=['log'],
+            help='With --source csv: export files or directories to scan (default: log).'
+        )
+        parser.add_argument(
+            '--rooms',
+            nargs='+',
+            type=str,
+            help='Only analyse these rooms.'
+        )
+        parser.add_argument(
+            '--output',
+            type=str,
+            help='Write the summary table to this file; .parquet needs pyarrow, anything else is written as CSV.'
+        )
+
+    def handle(self, *args, **options):
+        np, pd = load_pandas()
+        self.np, self.pd = np, pd
+        started = time.monotonic()
+
+        if options['source'] == 'db':
+            acceptance, verdicts, rooms, questions, chats = self.load_from_db(options['rooms'])
+        else:
+            acceptance, verdicts, rooms, questions, chats = self.load_from_csv(options['paths'], options['rooms'])
+
+        latency = self.reply_latency(questions, chats)
+        summary = self.summarize(acceptance, verdicts, rooms, latency)
+
+        self.stdout.write(summary.to_string(index=False))
+        self.stdout.write(self.style.SUCCESS(
+            f"\nAnalysed {int(rooms['questions'].sum()) if len(rooms) else 0} questions in "
+            f"{rooms['room_name'].nunique() if len(rooms) else 0} rooms in {time.monotonic() - started:.2f}s."
+        ))
+
+        if options['output']:
+            self.write_output(summary, options['output'])
+
+    # --- Loading -------------------------------------------------------
+
+    def load_from_db(self, rooms):
+        """Counts are grouped in SQL; only the columns needed for reply latency are streamed."""
+        pd = self.pd
+        ai_messages = AIChatMessage.objects.all()
+        chat_messages = ChatMessage.objects.all()
+        if rooms:
+            ai_messages = ai_messages.filter(room_name__in=rooms)
+            chat_messages = chat_messages.filter(room_name__in=rooms)
+
+        acceptance = pd.DataFrame.from_records(
+            ai_messages.values('mode').annotate(
+                total=Count('id'),
+                sent=Count('id', filter=Q(suggestion_response='sent')),
+                dismissed=Count('id', filter=Q(suggestion_response='dismissed')),
+                no_action=Count('id', filter=Q(suggestion_response='no_action')),
+            ).order_by('mode'),
+            columns=['mode', 'total', 'sent', 'dismissed', 'no_action'],
+        )
+        verdicts = pd.DataFrame.from_records(
+            ai_messages.annotate(
+                verdict=Case(
+                    When(ai_message__in=VERDICTS, then=F('ai_message')),
+                    default=Value(OTHER_VERDICT),
+                    output_field=CharField(),
+                )
+            ).values('mode', 'verdict').annotate(n=Count('id')).order_by('mode', 'verdict'),
+            columns=['mode', 'verdict', 'n'],
+        )
+        room_counts = pd.DataFrame.from_records(
+            ai_messages.values('room_name', 'mode').annotate(questions=Count('id')).order_by('room_name'),
+            columns=['room_name', 'mode', 'questions'],
+        )
+
+        questions = pd.DataFrame.from_records(
+            ai_messages.values_list('room_name', 'user_name', 'mode', 'timestamp').iterator(chunk_size=5000),
+            columns=['room_name', 'user_name', 'mode', 'timestamp'],
+        )
+        chats = pd.DataFrame.from_records(
+            chat_messages.values_list('room_name', 'user_name', 'timestamp').iterator(chunk_size=5000),
+            columns=['room_name', 'user_name', 'timestamp'],
+        )
+        return acceptance, verdicts, room_counts, questions, chats
+
+    def load_from_csv(self, paths, rooms):
+        """Read only the needed columns of every export and aggregate them column-wise."""
+        pd = self.pd
+        frames = {AIChatMessage: [], ChatMessage: []}
+        for file_path in find_export_files(paths):
+            model = detect_model(read_header(file_path))
+            if model not in frames:
+                continue
+            wanted = {'id', 'room_name', 'user_name', 'timestamp'}
+            if model is AIChatMessage:
+                wanted |= {'mode', 'ai_message', 'suggestion_response'}
+            frame = pd.read_csv(
+                file_path,
+                encoding='utf-8-sig',
+                dtype=str,
+                keep_default_na=False,
+                usecols=lambda column: column in wanted,
+            )
+            frames[model].append(frame)
+            self.stdout.write(f"  - Loaded {len(frame)} rows from '{file_path}'")
+
+        if not frames[AIChatMessage]:
+            raise CommandError("No AI chat message exports found in the given paths.")
+
+        ai = pd.concat(frames[AIChatMessage], ignore_index=True).drop_duplicates(['room_name', 'id'])
+        chats = (
+            pd.concat(frames[ChatMessage], ignore_index=True).drop_duplicates(['room_name', 'id'])
+            if frames[ChatMessage] else pd.DataFrame(columns=['id', 'room_name', 'user_name', 'timestamp'])
+        )
+        # 舊版匯出沒有 mode / suggestion_response 欄位
+        for column in ('mode', 'suggestion_response'):
+            if column not in ai.columns:
+                ai[column] = ''
+        ai['mode'] = ai['mode'].replace('', UNKNOWN_MODE).fillna(UNKNOWN_MODE)
+        ai['suggestion_response'] = ai['suggestion_response'].fillna('')
+
+        if rooms:
+            ai = ai[ai['room_name'].isin(rooms)]
+            chats = chats[chats['room_name'].isin(rooms)]
+
+        response = ai['suggestion_response']
+        acceptance = (
+            ai.assign(
+                total=1,
+                sent=(response == 'sent').astype(int),
+                dismissed=(response == 'dismissed').astype(int),
+                no_action=(response == 'no_action').astype(int),
+            )
+            .groupby('mode', as_index=False)[['total', 'sent', 'dismissed', 'no_action']].sum()
+        )
+        verdicts = (
+            ai.assign(verdict=ai['ai_message'].where(ai['ai_message'].isin(VERDICTS), OTHER_VERDICT))
+            .groupby(['mode', 'verdict'], as_index=False).size()
+            .rename(columns={'size': 'n'})
+        )
+        room_counts = (
+            ai.groupby(['room_name', 'mode'], as_index=False).size()
+            .rename(columns={'size': 'questions'})
+        )
+
+        questions = ai[['room_name', 'user_name', 'mode', 'timestamp']].copy()
+        questions['timestamp'] = pd.to_datetime(questions['timestamp'], utc=True, format='ISO8601')
+        chats = chats[['room_name', 'user_name', 'timestamp']].copy()
+        chats['timestamp'] = pd.to_datetime(chats['timestamp'], utc=True, format='ISO8601')
+        return acceptance, verdicts, room_counts, questions, chats
+
+    # --- Metrics -------------------------------------------------------
+
+    def reply_latency(self, questions, chats):
+        """
+        Seconds from each AI question to the next chat message written by
+        someone else in the same room. Done with one merge_asof instead of a
+        per-question scan: chat messages are expanded to one row per other
+        asker in the room, then matched forward in time.
+        """
+        pd = self.pd
+        if questions.empty or chats.empty:
+            return pd.DataFrame(columns=['mode', 'latency'])
+
+        questions = questions.copy()
+        chats = chats.copy()
+        questions['timestamp'] = pd.to_datetime(questions['timestamp'], utc=True)
+        chats['timestamp'] = pd.to_datetime(chats['timestamp'], utc=True)
+
+        askers = questions[['room_name', 'user_name']].drop_duplicates().rename(columns={'user_name': 'asker'})
+        replies = chats.merge(askers, on='room_name')
+        replies = replies[replies['user_name'] != replies['asker']]
+        replies = replies.rename(columns={'timestamp': 'reply_at'})[['room_name', 'asker', 'reply_at']]
+
+        matched = pd.merge_asof(
+            questions.rename(columns={'user_name': 'asker'}).sort_values('timestamp'),
+            replies.sort_values('reply_at'),
+            left_on='timestamp',
+            right_on='reply_at',
+            by=['room_name', 'asker'],
+            direction='forward',
+            allow_exact_matches=False,
+        )
+        matched['latency'] = (matched['reply_at'] - matched['timestamp']).dt.total_seconds()
+        return matched[['mode', 'latency']].dropna()
+
+    def summarize(self, acceptance, verdicts, rooms, latency):
+        """Flatten all metrics into one long table: metric, mode, group, value."""
+        pd, np = self.pd, self.np
+        parts = []
+
+        if len(acceptance):
+            acceptance = acceptance.copy()
+            acceptance['mode'] = acceptance['mode'].replace('', UNKNOWN_MODE)
+            total = acceptance['total'].to_numpy(dtype=float)
+            answered = acceptance[['sent', 'dismissed', 'no_action']].sum(axis=1).to_numpy(dtype=float)
+            acceptance['acceptance_rate'] = np.divide(
+                acceptance['sent'].to_numpy(dtype=float), answered,
+                out=np.full_like(total, np.nan), where=answered > 0,
+            )
+            acceptance['dismiss_rate'] = np.divide(
+                acceptance['dismissed'].to_numpy(dtype=float), answered,
+                out=np.full_like(total, np.nan), where=answered > 0,
+            )
+            parts.append(
+                acceptance.melt(id_vars='mode', var_name='metric', value_name='value').assign(group='')
+            )
+
+        if len(verdicts):
+            verdicts = verdicts.copy()
+            verdicts['mode'] = verdicts['mode'].replace('', UNKNOWN_MODE)
+            verdicts['share'] = verdicts['n'] / verdicts.groupby('mode')['n'].transform('sum')
+            parts.append(verdicts.rename(columns={'verdict': 'group', 'n': 'value'}).assign(metric='verdict_count')[SUMMARY_COLUMNS])
+            parts.append(verdicts.rename(columns={'verdict': 'group', 'share': 'value'}).assign(metric='verdict_share')[SUMMARY_COLUMNS])
+
+        if len(latency):
+            stats = latency.groupby('mode')['latency'].agg(
+                reply_latency_count='count',
+                reply_latency_mean_s='mean',
+                reply_latency_median_s='median',
+                reply_latency_p90_s=lambda values: values.quantile(0.9),
+            ).reset_index()
+            parts.append(stats.melt(id_vars='mode', var_name='metric', value_name='value').assign(group=''))
+
+        if len(rooms):
+            rooms = rooms.copy()
+            rooms['mode'] = rooms['mode'].replace('', UNKNOWN_MODE)
+            parts.append(rooms.rename(columns={'room_name': 'group', 'questions': 'value'}).assign(metric='questions_per_room')[SUMMARY_COLUMNS])
+            per_mode = rooms.groupby('mode')['questions'].agg(questions_per_room_mean='mean', rooms='count').reset_index()
+            parts.append(per_mode.melt(id_vars='mode', var_name='metric', value_name='value').assign(group=''))
+
+        if not parts:
+            return pd.DataFrame(columns=SUMMARY_COLUMNS)
+        summary = pd.concat([part[SUMMARY_COLUMNS] for part in parts], ignore_index=True)
+        summary['value'] = summary['value'].astype(float).round(4)
+        return summary
+
+    def write_output(self, summary, path):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        if path.endswith('.parquet'):
+            try:
+                summary.to_parquet(path, index=False)
+            except ImportError:
+                raise CommandError("Writing Parquet requires pyarrow; use a .csv output path instead.")
+        else:
+            summary.to_csv(path, index=False, encoding='utf-8-sig')
+        self.stdout.write(self.style.SUCCESS(f"Summary written to '{path}'."))
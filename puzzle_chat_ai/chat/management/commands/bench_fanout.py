@@ -0,0 +1,344 @@
+# chat/management/commands/bench_fanout.py
+
+import asyncio
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from chat.constants import MESSAGE_TYPES
+from chat.management.commands.replay_sessions import WEBSOCKET_PATH, connection_query, percentile
+
+LAYER_BACKENDS = {
+    'inmemory': 'channels.layers.InMemoryChannelLayer',
+    'redis': 'channels_redis.core.RedisChannelLayer',
+    'redis_pubsub': 'channels_redis.pubsub.RedisPubSubChannelLayer',
+}
+
+DEFAULT_CONNECTIONS = 1000
+DEFAULT_ROOMS = 50
+DEFAULT_MESSAGES = 20
+LAG_INTERVAL = 0.01
+BENCH_ROOM_PREFIX = 'bench_'
+# socketserver 預設只排隊 5 個連線；大量同時連線時 fakeredis 會直接 reset
+FAKEREDIS_LISTEN_BACKLOG = 1024
+
+
+def current_rss_bytes():
+    """Resident set size right now (Linux /proc), or the peak RSS elsewhere."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True, cwd=settings.BASE_DIR
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize_ms(values):
+    """p50 / p90 / p99 / max / mean in milliseconds."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return {
+        'p50': round(percentile(ordered, 50) * 1000, 3),
+        'p90': round(percentile(ordered, 90) * 1000, 3),
+        'p99': round(percentile(ordered, 99) * 1000, 3),
+        'max': round(ordered[-1] * 1000, 3),
+        'mean': round(statistics.fmean(ordered) * 1000, 3),
+    }
+
+
+class LoopLagMonitor:
+    """Samples how late a short sleep wakes up; the overshoot is the event-loop lag."""
+
+    def __init__(self, interval=LAG_INTERVAL):
+        self.interval = interval
+        self.samples = []
+        self.task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - started - self.interval))
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+
+class BenchConnection:
+    """One WebsocketCommunicator plus a reader that timestamps every bench frame."""
+
+    def __init__(self, application, room_name, user_name, deliveries):
+        from channels.testing import WebsocketCommunicator
+        self.communicator = WebsocketCommunicator(application, f'{WEBSOCKET_PATH}?{connection_query(room_name, user_name)}')
+        self.deliveries = deliveries
+        self.reader = None
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=30)
+        if not connected:
+            raise ConnectionError('WebSocket connection rejected')
+        self.reader = asyncio.create_task(self._read_loop())
+
+    async def _read_loop(self):
+        while True:
+            try:
+                text = await self.communicator.receive_from(timeout=3600)
+            except asyncio.TimeoutError:
+                continue
+            received_at = time.perf_counter()
+            data = json.loads(text)
+            if 'bench_seq' in data:
+                self.deliveries.append((data['bench_seq'], received_at - data['sent_at'], received_at))
+
+    async def close(self):
+        if self.reader:
+            self.reader.cancel()
+        await self.communicator.disconnect()
+
+
+class Command(BaseCommand):
+    help = ('Opens many ChatConsumer connections across rooms and measures group_send fan-out latency, '
+            'events per second, memory per connection and event-loop lag for each channel layer.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--layers',
+            nargs='+',
+            choices=sorted(LAYER_BACKENDS),
+            default=['inmemory'],
+            help='Channel layers to benchmark (default: inmemory). Memory figures are cleanest with one layer per run.'
+        )
+        parser.add_argument(
+            '--redis_url',
+            type=str,
+            default=os.getenv('REDIS_URL', 'redis://localhost:6379'),
+            help='Redis server for the redis layers (default: $REDIS_URL or redis://localhost:6379).'
+        )
+        parser.add_argument(
+            '--fakeredis',
+            action='store_true',
+            help=(
+                'Start an in-process fakeredis TCP server for the redis layers instead of using --redis_url. '
+                f'It queues up to {FAKEREDIS_LISTEN_BACKLOG} pending connections; --connect_concurrency is capped to that.'
+            )
+        )
+        parser.add_argument('--connections', type=int, default=DEFAULT_CONNECTIONS, help='Total WebSocket connections.')
+        parser.add_argument('--rooms', type=int, default=DEFAULT_ROOMS, help='Rooms the connections are spread over.')
+        parser.add_argument('--messages', type=int, default=DEFAULT_MESSAGES, help='group_send calls per room.')
+        parser.add_argument(
+            '--rate',
+            type=float,
+            default=0.0,
+            help='Total group_send calls per second across all rooms (0 = as fast as possible).'
+        )
+        parser.add_argument('--connect_concurrency', type=int, default=100, help='Connections opened in parallel.')
+        parser.add_argument('--timeout', type=float, default=60.0, help='Seconds to wait for all deliveries.')
+        parser.add_argument('--output', type=str, help='Append the results to this JSON file.')
+
+    def handle(self, *args, **options):
+        if options['connections'] < options['rooms'] or options['rooms'] < 1:
+            raise CommandError('Need at least one room and at least one connection per room.')
+
+        fake_server = None
+        if options['fakeredis'] and any(layer != 'inmemory' for layer in options['layers']):
+            fake_server, options['redis_url'] = self.start_fakeredis()
+            if options['connect_concurrency'] > FAKEREDIS_LISTEN_BACKLOG:
+                self.stdout.write(self.style.WARNING(
+                    f"--connect_concurrency capped to {FAKEREDIS_LISTEN_BACKLOG} for the fakeredis server."
+                ))
+                options['connect_concurrency'] = FAKEREDIS_LISTEN_BACKLOG
+
+        results = []
+        try:
+            for layer in options['layers']:
+                self.stdout.write(f"\n=== {layer}: {options['connections']} connections in {options['rooms']} rooms ===")
+                layer_config = {'BACKEND': LAYER_BACKENDS[layer]}
+                if layer != 'inmemory':
+                    layer_config['CONFIG'] = {'hosts': [options['redis_url']]}
+                with override_settings(CHANNEL_LAYERS={'default': layer_config}):
+                    result = asyncio.run(self.run_layer(options))
+                result['layer'] = layer
+                results.append(result)
+                self.print_result(result)
+        finally:
+            if fake_server is not None:
+                fake_server.shutdown()
+
+        if options['output']:
+            self.write_output(options, results)
+
+    def start_fakeredis(self):
+        try:
+            from fakeredis import TcpFakeServer
+        except ImportError:
+            raise CommandError('--fakeredis requires fakeredis >= 2.24 with Lua support (pip install "fakeredis[lua]").')
+
+        class FakeRedisServer(TcpFakeServer):
+            request_queue_size = FAKEREDIS_LISTEN_BACKLOG
+
+        server = FakeRedisServer(('127.0.0.1', 0), server_type='redis')
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        host, port = server.server_address[:2]
+        return server, f'redis://{host}:{port}'
+
+    async def run_layer(self, options):
+        from channels.layers import get_channel_layer
+        from puzzle_chat_ai.asgi import application
+
+        channel_layer = get_channel_layer()
+        rooms = [f'{BENCH_ROOM_PREFIX}{index}' for index in range(options['rooms'])]
+        deliveries = []
+        connections = []
+        members = {room: 0 for room in rooms}
+
+        monitor = LoopLagMonitor()
+        monitor.start()
+
+        # 步驟一：建立連線並量測記憶體
+        rss_before = current_rss_bytes()
+        connect_started = time.perf_counter()
+        semaphore = asyncio.Semaphore(options['connect_concurrency'])
+        failures = 0
+
+        async def open_connection(index):
+            nonlocal failures
+            room = rooms[index % len(rooms)]
+            connection = BenchConnection(application, room, f'bench_user_{index}', deliveries)
+            async with semaphore:
+                try:
+                    await connection.connect()
+                except Exception:
+                    failures += 1
+                    return
+            connections.append(connection)
+            members[room] += 1
+
+        await asyncio.gather(*(open_connection(index) for index in range(options['connections'])))
+        connect_seconds = time.perf_counter() - connect_started
+        rss_after = current_rss_bytes()
+        lag_idle = list(monitor.samples)
+
+        # 步驟二：對每個房間 group_send，量測每位成員收到的延遲
+        expected = sum(members[room] for room in rooms) * options['messages']
+        interval = 1 / options['rate'] if options['rate'] else 0
+        send_started = time.perf_counter()
+        seq = 0
+        send_times = {}
+        for _ in range(options['messages']):
+            for room in rooms:
+                sent_at = time.perf_counter()
+                send_times[seq] = (sent_at, members[room])
+                await channel_layer.group_send(f'chat_{room}', {
+                    'type': MESSAGE_TYPES['CHAT_MESSAGE'],
+                    'user_name': 'bench',
+                    'message': 'x',
+                    'bench_seq': seq,
+                    'sent_at': sent_at,
+                })
+                seq += 1
+                if interval:
+                    await asyncio.sleep(max(0.0, send_started + seq * interval - time.perf_counter()))
+        send_seconds = time.perf_counter() - send_started
+
+        deadline = time.perf_counter() + options['timeout']
+        while len(deliveries) < expected and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        finished = time.perf_counter()
+
+        await monitor.stop()
+        for connection in connections:
+            await connection.close()
+
+        # 一則訊息的扇出完成時間：最後一位成員收到的時間減去送出時間
+        last_delivery = {}
+        for message_seq, _latency, received_at in deliveries:
+            last_delivery[message_seq] = max(received_at, last_delivery.get(message_seq, 0))
+        fanout_complete = [
+            last_delivery[message_seq] - sent_at
+            for message_seq, (sent_at, size) in send_times.items()
+            if message_seq in last_delivery and size
+        ]
+        delivery_seconds = (max(last_delivery.values()) if last_delivery else finished) - send_started
+
+        return {
+            'connections': len(connections),
+            'connect_failures': failures,
+            'rooms': len(rooms),
+            'group_sends': seq,
+            'expected_deliveries': expected,
+            'deliveries': len(deliveries),
+            'lost_deliveries': expected - len(deliveries),
+            'connect_seconds': round(connect_seconds, 3),
+            'send_seconds': round(send_seconds, 3),
+            'events_per_second': round(len(deliveries) / delivery_seconds, 1) if delivery_seconds > 0 else None,
+            'delivery_latency_ms': summarize_ms([latency for _seq, latency, _at in deliveries]),
+            'fanout_complete_ms': summarize_ms(fanout_complete),
+            'rss_bytes_before': rss_before,
+            'rss_bytes_after': rss_after,
+            'rss_bytes_per_connection': round((rss_after - rss_before) / len(connections)) if connections else None,
+            'loop_lag_idle_ms': summarize_ms(lag_idle),
+            'loop_lag_ms': summarize_ms(monitor.samples),
+        }
+
+    def print_result(self, result):
+        style = self.style.SUCCESS if not result['lost_deliveries'] else self.style.WARNING
+        self.stdout.write(style(
+            f"{result['deliveries']}/{result['expected_deliveries']} deliveries, "
+            f"{result['events_per_second']} events/s, "
+            f"{result['rss_bytes_per_connection']} bytes RSS/connection, "
+            f"{result['connect_failures']} connect failures"
+        ))
+        for key in ('delivery_latency_ms', 'fanout_complete_ms', 'loop_lag_ms'):
+            if result[key]:
+                values = ', '.join(f'{name}={value}' for name, value in result[key].items())
+                self.stdout.write(f"  {key}: {values}")
+
+    def write_output(self, options, results):
+        """Append one run to a JSON list so successive commits can be compared."""
+        run = {
+            'commit': git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'parameters': {key: options[key] for key in ('connections', 'rooms', 'messages', 'rate')},
+            'results': results,
+        }
+        path = options['output']
+        runs = []
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as existing:
+                runs = json.load(existing)
+        runs.append(run)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as output:
+            json.dump(runs, output, indent=2)
+        self.stdout.write(self.style.SUCCESS(f"\nResults appended to '{path}' ({len(runs)} run(s))."))
@@ -1,74 +1,217 @@
 # chat/management/commands/delete_room_data.py
 
+import fnmatch
+import time
+from datetime import timedelta
+
 from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
+from django.db.models import Count, Max
+from django.utils import timezone
 # ⭐ 導入您所有與房間相關的模型
-from chat.models import ChatMessage, AIChatMessage, ChatMessageSummary, AIChatMessageSummary
+from chat.models import ChatMessage, AIChatMessage, ChatMessageSummary, AIChatMessageSummary, PuzzleAssignment
+
+# ⭐ 列出所有需要被清理的模型 (刪除房間時一併解除題目指定)
+MODELS_TO_CLEAN = [
+    ChatMessage,
+    AIChatMessage,
+    ChatMessageSummary,
+    AIChatMessageSummary,
+    PuzzleAssignment
+]
+
+# 有時間戳記、可以用來判斷房間「最後活動時間」的模型
+TIMESTAMPED_MODELS = [ChatMessage, AIChatMessage]
+
+DEFAULT_BATCH_SIZE = 1000
+
 
 class Command(BaseCommand):
-    help = 'Deletes all data associated with a specific room name from all relevant models.'
+    help = 'Deletes all data associated with one or more rooms from all relevant models, in small id-range batches.'
 
     def add_arguments(self, parser):
-        # 定義 --room 參數，這是必須提供的
+        # 定義 --room 參數，可以一次指定多個房間
         parser.add_argument(
             '--room',
+            nargs='+',
             type=str,
-            help='The name of the room to delete data from.',
-            required=True
+            help='The name(s) of the room(s) to delete data from.'
+        )
+        parser.add_argument(
+            '--room_glob',
+            action='append',
+            type=str,
+            help='Select rooms whose name matches a shell-style pattern (e.g. "test_*"). Can be repeated.'
+        )
+        parser.add_argument(
+            '--older_than_days',
+            type=int,
+            help='Select rooms whose last chat/AI message is older than N days. '
+                 'Combined with --room/--room_glob it narrows that selection.'
+        )
+        parser.add_argument(
+            '--noinput', '--no-input',
+            action='store_false',
+            dest='interactive',
+            help='Do not prompt for confirmation.'
+        )
+        parser.add_argument(
+            '--dry_run',
+            action='store_true',
+            help='Only report how many records would be deleted.'
+        )
+        parser.add_argument(
+            '--batch_size',
+            type=int,
+            default=DEFAULT_BATCH_SIZE,
+            help=f'Maximum number of rows deleted per transaction (default: {DEFAULT_BATCH_SIZE}).'
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=0.0,
+            help='Seconds to pause between batches, to leave room for live traffic.'
         )
 
     def handle(self, *args, **options):
-        room_name = options['room']
-        
-        # ⭐ 列出所有需要被清理的模型
-        models_to_clean = [
-            ChatMessage, 
-            AIChatMessage, 
-            ChatMessageSummary, 
-            AIChatMessageSummary
-        ]
-
-        self.stdout.write(self.style.WARNING(f"--- PRE-DELETION CHECK FOR ROOM: '{room_name}' ---"))
-        self.stdout.write("This command will permanently delete data. Please review the counts below.")
+        if options['batch_size'] < 1:
+            raise CommandError('--batch_size must be at least 1.')
 
-        total_records_to_delete = 0
-        records_count_per_model = {}
+        rooms = self.select_rooms(options)
+        if not rooms:
+            self.stdout.write(self.style.SUCCESS("No rooms match the selection. Nothing to delete."))
+            return
+
+        self.stdout.write(self.style.WARNING(f"--- PRE-DELETION CHECK FOR {len(rooms)} ROOM(S): {', '.join(repr(r) for r in rooms)} ---"))
+        self.stdout.write("This command will permanently delete data. Please review the counts below.")
 
         # 步驟一：檢查並計算將要刪除的紀錄數量
-        for model in models_to_clean:
-            model_name = model._meta.model_name
-            # 檢查模型是否有 room_name 欄位
-            if hasattr(model, 'room_name'):
-                queryset = model.objects.filter(room_name=room_name)
-                count = queryset.count()
-                records_count_per_model[model_name] = count
+        counts = self.count_records(rooms)
+        total_records_to_delete = 0
+        for room in rooms:
+            for model in MODELS_TO_CLEAN:
+                model_name = model._meta.model_name
+                count = counts.get((model_name, room), 0)
                 total_records_to_delete += count
-                self.stdout.write(f"Found {count} records in '{model_name}' for room '{room_name}'.")
-        
+                if count:
+                    self.stdout.write(f"Found {count} records in '{model_name}' for room '{room}'.")
+
         if total_records_to_delete == 0:
-            self.stdout.write(self.style.SUCCESS("No data found for this room. Nothing to delete."))
+            self.stdout.write(self.style.SUCCESS("No data found for the selected rooms. Nothing to delete."))
+            return
+
+        if options['dry_run']:
+            self.stdout.write(self.style.NOTICE(f"\nDry run: {total_records_to_delete} records in {len(rooms)} room(s) would be deleted."))
             return
 
         # 步驟二：要求使用者進行最終確認
-        self.stdout.write(self.style.ERROR_OUTPUT(f"\nWARNING: You are about to delete a total of {total_records_to_delete} records from room '{room_name}'.\nThis action CANNOT be undone."))
-        
-        confirmation = input("Are you sure you want to proceed? Type 'yes' to continue: ")
+        if options['interactive']:
+            self.stdout.write(self.style.ERROR_OUTPUT(f"\nWARNING: You are about to delete a total of {total_records_to_delete} records from {len(rooms)} room(s).\nThis action CANNOT be undone."))
 
-        if confirmation.lower() != 'yes':
-            self.stdout.write(self.style.NOTICE("Deletion cancelled by user."))
-            return
+            confirmation = input("Are you sure you want to proceed? Type 'yes' to continue: ")
+
+            if confirmation.lower() != 'yes':
+                self.stdout.write(self.style.NOTICE("Deletion cancelled by user."))
+                return
+
+        # 步驟三：在確認後，以小批次執行刪除操作
+        deleted_total = 0
+        for room in rooms:
+            for model in MODELS_TO_CLEAN:
+                model_name = model._meta.model_name
+                if counts.get((model_name, room), 0) == 0:
+                    continue
+                self.stdout.write(f"Deleting {counts[(model_name, room)]} records from '{model_name}' for room '{room}'...")
+                try:
+                    deleted_total += self.delete_in_batches(model, room, options['batch_size'], options['sleep'])
+                except Exception as e:
+                    raise CommandError(
+                        f"An error occurred while deleting from '{model_name}' for room '{room}'. "
+                        f"Batches already committed stay deleted ({deleted_total} records so far); "
+                        f"re-run the command to finish. Error: {e}"
+                    )
+
+        self.stdout.write(self.style.SUCCESS(f"\nSuccessfully deleted {deleted_total} records from {len(rooms)} room(s)."))
 
-        # 步驟三：在確認後，執行刪除操作
-        try:
-            # 使用 transaction.atomic 確保所有刪除操作要麼全部成功，要麼全部失敗
+    def select_rooms(self, options):
+        """Resolve --room, --room_glob and --older_than_days into a sorted list of room names."""
+        explicit = options['room'] or []
+        patterns = options['room_glob'] or []
+        older_than_days = options['older_than_days']
+
+        if not explicit and not patterns and older_than_days is None:
+            raise CommandError('Select rooms with --room, --room_glob and/or --older_than_days.')
+
+        selected = set(explicit)
+        if patterns:
+            known_rooms = self.all_room_names()
+            for pattern in patterns:
+                selected.update(fnmatch.filter(known_rooms, pattern))
+
+        if older_than_days is not None:
+            stale = self.rooms_inactive_since(timezone.now() - timedelta(days=older_than_days))
+            # 只給了天數時，就選出所有過期的房間
+            selected = (selected & stale) if (explicit or patterns) else stale
+
+        return sorted(selected)
+
+    def all_room_names(self):
+        """Distinct room names across all models (served from the room_name indexes)."""
+        names = set()
+        for model in MODELS_TO_CLEAN:
+            names.update(model.objects.values_list('room_name', flat=True).distinct())
+        return names
+
+    def rooms_inactive_since(self, cutoff):
+        """Rooms whose most recent timestamped message is older than `cutoff`."""
+        last_activity = {}
+        for model in TIMESTAMPED_MODELS:
+            for row in model.objects.values('room_name').annotate(last=Max('timestamp')):
+                previous = last_activity.get(row['room_name'])
+                if previous is None or row['last'] > previous:
+                    last_activity[row['room_name']] = row['last']
+        return {room for room, last in last_activity.items() if last < cutoff}
+
+    def count_records(self, rooms):
+        """
+        One grouped COUNT(id) per model. With the (room_name, id) indexes these
+        are answered by index-only scans, without touching the message rows.
+        """
+        counts = {}
+        for model in MODELS_TO_CLEAN:
+            rows = (
+                model.objects.filter(room_name__in=rooms)
+                .values('room_name')
+                .annotate(total=Count('id'))
+                .order_by()
+            )
+            for row in rows:
+                counts[(model._meta.model_name, row['room_name'])] = row['total']
+        return counts
+
+    def delete_in_batches(self, model, room, batch_size, pause):
+        """
+        Delete one room's rows in bounded id ranges, each in its own short
+        transaction, so locks are held only for one batch at a time.
+        """
+        queryset = model.objects.filter(room_name=room)
+        deleted = 0
+        last_id = None
+        while True:
+            batch = queryset.order_by('id')
+            if last_id is not None:
+                batch = batch.filter(id__gt=last_id)
+            ids = list(batch.values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+
+            # 使用 transaction.atomic 確保單一批次要麼全部成功，要麼全部失敗
             with transaction.atomic():
-                for model_name, count in records_count_per_model.items():
-                    if count > 0:
-                        model = next(m for m in models_to_clean if m._meta.model_name == model_name)
-                        self.stdout.write(f"Deleting {count} records from '{model_name}'...")
-                        model.objects.filter(room_name=room_name).delete()
-            
-            self.stdout.write(self.style.SUCCESS(f"\nSuccessfully deleted all data for room '{room_name}'."))
-
-        except Exception as e:
-            raise CommandError(f'An error occurred during deletion. The operation was rolled back. Error: {e}')
\ No newline at end of file
+                count, _ = queryset.filter(id__gte=ids[0], id__lte=ids[-1]).delete()
+            deleted += count
+            last_id = ids[-1]
+            self.stdout.write(f"  ... {deleted} deleted (up to id {last_id})")
+
+            if pause:
+                time.sleep(pause)
+        return deleted
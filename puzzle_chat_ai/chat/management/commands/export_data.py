@@ -1,11 +1,305 @@
 # chat/management/commands/export_data.py
 
 import csv
+import gzip
+import io
 import os
 import json
+import sys
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone as dt_timezone
+
+import django
 from django.core.management.base import BaseCommand, CommandError
 from django.apps import apps
-from django.db.models import CharField # 引入 CharField 檢查字段類型
+from django.db import connection, connections
+from django.db.models import CharField, Q # 引入 CharField 檢查字段類型
+from django.utils import timezone
+
+APP_NAME = 'chat'
+
+# 列出所有我們想要匯出的模型
+ALL_MODELS = [
+    'ChatMessage',
+    'ChatMessageSummary',
+    'AIChatMessage',
+    'AIChatMessageSummary',
+]
+
+DEFAULT_CHUNK_SIZE = 2000
+DEFAULT_PROGRESS_EVERY = 50000
+
+# 沒有房間篩選時，水位線記錄在這個 key 底下
+ALL_ROOMS_KEY = '*'
+
+STATE_FILE_VERSION = 1
+
+
+def format_value(value):
+    """Format a single field value exactly like the historical *_export.csv files."""
+    if hasattr(value, 'isoformat'): # 處理 datetime
+        return value.isoformat()
+    if isinstance(value, (dict, list)): # 處理 JSONField
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+def get_export_fields(model):
+    """Concrete, non-relational fields in declaration order (the CSV header)."""
+    return [field for field in model._meta.get_fields() if not field.is_relation and field.concrete]
+
+
+def has_room_name_field(model):
+    for field in model._meta.get_fields():
+        if field.name == 'room_name' and isinstance(field, CharField): # 確保字段存在且是 CharField
+            return True
+    return False
+
+
+def has_timestamp_field(model):
+    return any(field.name == 'timestamp' for field in model._meta.get_fields())
+
+
+def supports_copy(conn):
+    """COPY ... TO STDOUT is only available on PostgreSQL through psycopg 3."""
+    if conn.vendor != 'postgresql':
+        return False
+    from django.db.backends.postgresql.psycopg_any import is_psycopg3
+    return is_psycopg3
+
+
+def parse_since(value):
+    """Parse --since into a watermark: an integer id or an ISO-8601 timestamp."""
+    if value is None:
+        return None
+    if value.isdigit():
+        return {'id': int(value)}
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f"--since must be an integer id or an ISO-8601 timestamp, got '{value}'.")
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment, dt_timezone.utc)
+    return {'timestamp': moment.isoformat()}
+
+
+def watermark_filter(model, watermark):
+    """Translate a watermark into a Q object; id wins over timestamp when both are known."""
+    if not watermark:
+        return Q()
+    if watermark.get('id') is not None:
+        return Q(pk__gt=watermark['id'])
+    if watermark.get('timestamp') and has_timestamp_field(model):
+        return Q(timestamp__gt=datetime.fromisoformat(watermark['timestamp']))
+    return Q()
+
+
+def build_queryset(model, fields, rooms, watermarks, since):
+    """
+    One queryset covering every requested room, so a multi-room export is a
+    single ordered scan per model. Each room carries its own watermark.
+    """
+    queryset = model.objects.all()
+    if rooms is None:
+        queryset = queryset.filter(watermark_filter(model, watermarks.get(ALL_ROOMS_KEY) or since))
+    else:
+        condition = Q()
+        for room in rooms:
+            condition |= Q(room_name=room) & watermark_filter(model, watermarks.get(room) or since)
+        queryset = queryset.filter(condition)
+    return queryset.order_by('pk').values_list(*[field.name for field in fields])
+
+
+def iter_rows_orm(queryset, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Stream rows as tuples through a server-side cursor (on PostgreSQL)."""
+    return queryset.iterator(chunk_size=chunk_size)
+
+
+def iter_rows_copy(conn, queryset, fields):
+    """Stream rows with COPY (SELECT ...) TO STDOUT, loading typed values on the client."""
+    select_sql, params = queryset.query.sql_with_params()
+    # varchar(100) -> varchar, 讓 psycopg 能依型別名稱還原為 Python 物件
+    type_names = [field.db_type(conn).split('(')[0] for field in fields]
+
+    with conn.cursor() as cursor:
+        with cursor.cursor.copy(f"COPY ({select_sql}) TO STDOUT", params) as copy:
+            copy.set_types(type_names)
+            for row in copy.rows():
+                yield row
+
+
+def open_export_file(file_path, use_gzip=False, mode='w'):
+    """
+    Open an export file with the UTF-8 BOM encoding used by every historical export.
+    When appending to an existing file the BOM is not written again.
+    """
+    encoding = 'utf-8-sig'
+    if mode == 'a' and os.path.exists(file_path) and os.path.getsize(file_path) > 0:
+        encoding = 'utf-8'
+    if use_gzip:
+        # 每次 append 都是一個新的 gzip member，zcat 會直接串接
+        return io.TextIOWrapper(gzip.open(file_path, mode + 'b'), encoding=encoding, newline='')
+    return open(file_path, mode, newline='', encoding=encoding)
+
+
+def export_path(job, model_name, room):
+    """Where rows of `room` go: flat files by default, per-room directories with --rooms."""
+    directory = job['output_dir']
+    if job['per_room_dirs'] and room is not None:
+        directory = os.path.join(directory, str(room))
+    os.makedirs(directory, exist_ok=True)
+
+    suffix = '.csv.gz' if job['gzip'] else '.csv'
+    if job['incremental'] and job['segment_mode'] == 'rotate':
+        segment = job['segments'].get(room if room is not None else ALL_ROOMS_KEY, 0) + 1
+        return os.path.join(directory, f"{model_name}_export.{segment:04d}{suffix}"), segment
+    return os.path.join(directory, f"{model_name}_export{suffix}"), None
+
+
+class _RoomWriter:
+    """Lazily opened CSV writer for one output file, tracking its new watermark."""
+
+    def __init__(self, job, model_name, room, header):
+        self.file_path, self.segment = export_path(job, model_name, room)
+        self.append = job['incremental'] and job['segment_mode'] == 'append'
+        self.original_size = os.path.getsize(self.file_path) if os.path.exists(self.file_path) else 0
+        self.existed = self.original_size > 0
+        self.file = open_export_file(self.file_path, job['gzip'], 'a' if self.append else 'w')
+        self.writer = csv.writer(self.file)
+        if not (self.append and self.existed):
+            # 寫入標頭
+            self.writer.writerow(header)
+        self.count = 0
+        self.last_id = None
+        self.last_timestamp = None
+
+    def close(self):
+        self.file.close()
+
+    def discard(self):
+        """Undo this run: new files are removed, appended files are truncated back to their old size."""
+        if self.append and self.existed:
+            os.truncate(self.file_path, self.original_size)
+        elif os.path.exists(self.file_path):
+            os.remove(self.file_path)
+
+
+def export_model(job):
+    """
+    Export one model to CSV. Runs either in-process or inside a pool worker,
+    so it only receives plain data and reports progress on stdout.
+
+    Returns a summary dict (including the new per-room watermarks) for the
+    parent to report and persist.
+    """
+    model = apps.get_model(app_label=APP_NAME, model_name=job['model_name'])
+    model_name = model._meta.model_name
+
+    fields = get_export_fields(model)
+    header = [field.name for field in fields]
+    room_filtered = job['rooms'] is not None and has_room_name_field(model)
+    rooms = job['rooms'] if room_filtered else None
+    watermarks = job['watermarks'].get(model_name, {})
+
+    queryset = build_queryset(model, fields, rooms, watermarks, job['since'])
+    conn = connections['default']
+    use_copy = job['use_copy'] and supports_copy(conn)
+    if use_copy:
+        rows = iter_rows_copy(conn, queryset, fields)
+    else:
+        rows = iter_rows_orm(queryset, job['chunk_size'])
+
+    pk_index = header.index(model._meta.pk.name)
+    room_index = header.index('room_name') if rooms is not None else None
+    timestamp_index = header.index('timestamp') if 'timestamp' in header else None
+
+    started = time.monotonic()
+    count = 0
+    progress_every = job['progress_every']
+    writers = {}
+
+    try:
+        # 寫入資料
+        for row in rows:
+            room = row[room_index] if room_index is not None else None
+            room_writer = writers.get(room)
+            if room_writer is None:
+                room_writer = writers[room] = _RoomWriter(job, model_name, room, header)
+            room_writer.writer.writerow([format_value(value) for value in row])
+            room_writer.count += 1
+            room_writer.last_id = row[pk_index]
+            if timestamp_index is not None:
+                room_writer.last_timestamp = max(filter(None, [room_writer.last_timestamp, row[timestamp_index]]))
+            count += 1
+            if progress_every and count % progress_every == 0:
+                sys.stdout.write(f"    - {model_name}: {count} records written...\n")
+                sys.stdout.flush()
+    except BaseException:
+        # 匯出中斷時不要留下半份檔案
+        for room_writer in writers.values():
+            room_writer.close()
+            room_writer.discard()
+        raise
+
+    for room_writer in writers.values():
+        room_writer.close()
+
+    files = []
+    new_watermarks = {}
+    segments = {}
+    for room, room_writer in writers.items():
+        key = room if room is not None else ALL_ROOMS_KEY
+        files.append((room_writer.file_path, room_writer.count))
+        new_watermarks[key] = {
+            'id': room_writer.last_id,
+            'timestamp': room_writer.last_timestamp.isoformat() if room_writer.last_timestamp else None,
+        }
+        if room_writer.segment is not None:
+            segments[key] = room_writer.segment
+
+    return {
+        'model_name': model_name,
+        'files': files,
+        'count': count,
+        'room_filtered': room_filtered,
+        'watermarks': new_watermarks,
+        'segments': segments,
+        'method': 'copy' if use_copy else 'cursor',
+        'elapsed': time.monotonic() - started,
+    }
+
+
+def _init_worker():
+    """Pool initializer: make sure Django is ready and never reuse the parent's DB sockets."""
+    django.setup()
+    connections.close_all()
+
+
+def load_state(path):
+    """Read the watermark state file; a missing file means nothing was exported yet."""
+    if not path or not os.path.exists(path):
+        return {'version': STATE_FILE_VERSION, 'watermarks': {}, 'segments': {}}
+    try:
+        with open(path, encoding='utf-8') as state_file:
+            state = json.load(state_file)
+    except (OSError, json.JSONDecodeError) as e:
+        raise CommandError(f"Could not read state file '{path}': {e}")
+    state.setdefault('watermarks', {})
+    state.setdefault('segments', {})
+    return state
+
+
+def save_state(path, state):
+    """Write the state file atomically so an interrupted run never corrupts it."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as state_file:
+        json.dump(state, state_file, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
 
 class Command(BaseCommand):
     help = 'Exports data from specified models or all models in the chat app to CSV files, optionally filtering by room_name.' # 修改幫助信息
@@ -32,96 +326,169 @@ class Command(BaseCommand):
             help='Filter data by a specific room_name (only applies to models with a "room_name" field).',
             required=False # 非必需參數
         )
+        # 一次匯出多個房間，每個房間一個子資料夾
+        parser.add_argument(
+            '--rooms',
+            nargs='+',
+            type=str,
+            help='Export several rooms in one pass into per-room directories (<output_dir>/<room>/).'
+        )
+        parser.add_argument(
+            '--since',
+            type=str,
+            help='Only export rows with an id (integer) or timestamp (ISO-8601) greater than this value.'
+        )
+        parser.add_argument(
+            '--state_file',
+            type=str,
+            help='JSON file holding the last exported watermark per room and model. '
+                 'Only newer rows are exported and the file is updated after a successful run.'
+        )
+        parser.add_argument(
+            '--segment_mode',
+            choices=['append', 'rotate'],
+            default='append',
+            help='Incremental exports either append to the existing files or write numbered segments (default: append).'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Number of processes exporting models in parallel (default: 1, in-process).'
+        )
+        parser.add_argument(
+            '--gzip',
+            action='store_true',
+            help='Write gzip-compressed *_export.csv.gz files.'
+        )
+        parser.add_argument(
+            '--chunk_size',
+            type=int,
+            default=DEFAULT_CHUNK_SIZE,
+            help='Rows fetched per round trip when streaming through a server-side cursor.'
+        )
+        parser.add_argument(
+            '--no_copy',
+            action='store_true',
+            help='Disable the PostgreSQL COPY fast path and always stream through the ORM.'
+        )
+        parser.add_argument(
+            '--progress_every',
+            type=int,
+            default=DEFAULT_PROGRESS_EVERY,
+            help='Report progress every N rows (0 disables progress lines).'
+        )
 
     def handle(self, *args, **options):
-        app_name = 'chat' #
         model_names_to_export = options['model'] #
         output_dir = options['output_dir'] #
         room_name_filter = options['room_name'] # 獲取 room_name 參數值
+        rooms = options['rooms']
+        workers = max(1, options['workers'])
+        since = parse_since(options['since'])
+        state_file = options['state_file']
+
+        if room_name_filter and rooms:
+            raise CommandError("Use either --room_name or --rooms, not both.")
 
         # 確保輸出目錄存在
         os.makedirs(output_dir, exist_ok=True) #
 
-        # 列出所有我們想要匯出的模型
-        all_models = [
-            'ChatMessage',
-            'ChatMessageSummary',
-            'AIChatMessage',
-            'AIChatMessageSummary',
-        ] #
-
         # 如果使用者沒有指定模型，就匯出全部
         if not model_names_to_export: #
-            models_to_process = all_models #
+            models_to_process = ALL_MODELS #
         else:
             # 檢查使用者指定的模型是否存在
             for model_name in model_names_to_export: #
-                if model_name not in all_models: #
+                if model_name not in ALL_MODELS: #
                     raise CommandError(f"Model '{model_name}' not found or not supported for export.") #
             models_to_process = model_names_to_export #
 
         self.stdout.write(self.style.SUCCESS(f"Starting export for models: {', '.join(models_to_process)}")) #
         if room_name_filter: #
             self.stdout.write(self.style.SUCCESS(f"Filtering by room_name: '{room_name_filter}'")) #
+        if rooms:
+            self.stdout.write(self.style.SUCCESS(f"Exporting rooms into per-room directories: {', '.join(rooms)}"))
+
+        incremental = since is not None or state_file is not None
+        state = load_state(state_file)
+        if incremental:
+            self.stdout.write(self.style.SUCCESS(
+                f"Incremental export ({options['segment_mode']}) "
+                f"from {'state file ' + repr(state_file) if state_file else 'the --since watermark'}."
+            ))
 
-        # 循環處理每一個需要匯出的模型
-        for model_name in models_to_process: #
+        jobs = []
+        for model_name in models_to_process:
             try:
-                model = apps.get_model(app_label=app_name, model_name=model_name) #
-                self.export_model_to_csv(model, output_dir, room_name_filter) # 傳遞 room_name_filter
+                model = apps.get_model(app_label=APP_NAME, model_name=model_name) #
             except LookupError: #
-                self.stderr.write(self.style.ERROR(f"Model '{model_name}' not found in app '{app_name}'.")) #
-            except Exception as e: #
-                self.stderr.write(self.style.ERROR(f"An error occurred while exporting '{model_name}': {e}")) #
-
-    def export_model_to_csv(self, model, output_dir, room_name_filter=None): # 接收 room_name_filter 參數，並設為 None 預設值
-        model_name = model._meta.model_name #
-        file_path = os.path.join(output_dir, f"{model_name}_export.csv") #
-
-        self.stdout.write(f"  - Exporting model '{model_name}' to '{file_path}'...") #
+                self.stderr.write(self.style.ERROR(f"Model '{model_name}' not found in app '{APP_NAME}'.")) #
+                continue
+            if (room_name_filter or rooms) and not has_room_name_field(model):
+                self.stdout.write(self.style.WARNING(f"    - Warning: Model '{model._meta.model_name}' does not have a 'room_name' field or it's not a CharField. Room name filter will be ignored for this model.")) #
+            if since and 'timestamp' in since and not has_timestamp_field(model):
+                self.stdout.write(self.style.WARNING(f"    - Warning: Model '{model._meta.model_name}' has no 'timestamp' field; --since timestamp is ignored for rooms without a stored watermark."))
+            jobs.append({
+                'model_name': model_name,
+                'output_dir': output_dir,
+                'rooms': rooms or ([room_name_filter] if room_name_filter else None),
+                'per_room_dirs': bool(rooms),
+                'incremental': incremental,
+                'since': since,
+                'watermarks': state['watermarks'],
+                'segments': state['segments'].get(model._meta.model_name, {}),
+                'segment_mode': options['segment_mode'],
+                'gzip': options['gzip'],
+                'chunk_size': options['chunk_size'],
+                'use_copy': not options['no_copy'],
+                'progress_every': options['progress_every'],
+            })
 
-        # 自動獲取模型的所有欄位名稱
-        field_names = [field.name for field in model._meta.get_fields() if not field.is_relation] #
+        results = []
+        if workers == 1 or len(jobs) <= 1:
+            for job in jobs:
+                self.stdout.write(f"  - Exporting model '{job['model_name']}'...") #
+                try:
+                    results.append(self.report_result(export_model(job)))
+                except Exception as e: #
+                    self.stderr.write(self.style.ERROR(f"An error occurred while exporting '{job['model_name']}': {e}")) #
+        else:
+            # 平行匯出：子行程必須建立自己的資料庫連線
+            connection.close()
+            connections.close_all()
+            context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+            with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), mp_context=context, initializer=_init_worker) as pool:
+                futures = {pool.submit(export_model, job): job for job in jobs}
+                self.stdout.write(f"  - Exporting {len(jobs)} models with {min(workers, len(jobs))} workers...")
+                for future in as_completed(futures):
+                    job = futures[future]
+                    try:
+                        results.append(self.report_result(future.result()))
+                    except Exception as e: #
+                        self.stderr.write(self.style.ERROR(f"An error occurred while exporting '{job['model_name']}': {e}")) #
 
-        # 查詢資料庫獲取所有資料
-        queryset = model.objects.all() #
+        if state_file:
+            # 只有成功匯出的模型才推進水位線
+            for result in results:
+                state['watermarks'].setdefault(result['model_name'], {}).update(result['watermarks'])
+                state['segments'].setdefault(result['model_name'], {}).update(result['segments'])
+            state['version'] = STATE_FILE_VERSION
+            state['updated_at'] = timezone.now().isoformat()
+            save_state(state_file, state)
+            self.stdout.write(self.style.SUCCESS(f"Watermarks saved to '{state_file}'."))
 
-        # 判斷模型是否有 'room_name' 字段，並應用過濾器
-        if room_name_filter: #
-            # 檢查模型是否有 room_name 字段
-            has_room_name_field = False #
-            for field in model._meta.get_fields(): #
-                if field.name == 'room_name' and isinstance(field, CharField): # 確保字段存在且是 CharField
-                    has_room_name_field = True #
-                    break #
-
-            if has_room_name_field: #
-                queryset = queryset.filter(room_name=room_name_filter) # 應用過濾
-                self.stdout.write(self.style.SUCCESS(f"    - Applied room_name filter for '{room_name_filter}' on model '{model_name}'.")) #
-            else:
-                self.stdout.write(self.style.WARNING(f"    - Warning: Model '{model_name}' does not have a 'room_name' field or it's not a CharField. Room name filter will be ignored for this model.")) #
-
-        if not queryset.exists(): #
+    def report_result(self, result):
+        model_name = result['model_name']
+        if result['room_filtered']:
+            self.stdout.write(self.style.SUCCESS(f"    - Applied room_name filter on model '{model_name}'.")) #
+        if result['count'] == 0:
             self.stdout.write(self.style.WARNING(f"    - Model '{model_name}' has no data to export (or no data matching the filter). Skipping.")) # 修改提示信息
-            return #
-
-        with open(file_path, 'w', newline='', encoding='utf-8-sig') as csvfile: #
-            writer = csv.writer(csvfile) #
-
-            # 寫入標頭
-            writer.writerow(field_names) #
-
-            # 寫入資料
-            for instance in queryset: #
-                row = [] #
-                for field in field_names: #
-                    value = getattr(instance, field) #
-                    # 對特殊類型進行處理
-                    if hasattr(value, 'isoformat'): # 處理 datetime
-                        value = value.isoformat() #
-                    elif isinstance(value, dict) or isinstance(value, list): # 處理 JSONField
-                        value = json.dumps(value, ensure_ascii=False) #
-                    row.append(value) #
-                writer.writerow(row) #
-
-        self.stdout.write(self.style.SUCCESS(f"    - Successfully exported {queryset.count()} records.")) #
\ No newline at end of file
+            return result
+        for file_path, count in result['files']:
+            self.stdout.write(f"    - {count} records -> '{file_path}'")
+        self.stdout.write(self.style.SUCCESS(
+            f"    - Successfully exported {result['count']} records from '{model_name}' "
+            f"in {result['elapsed']:.2f}s ({result['method']})."
+        )) #
+        return result
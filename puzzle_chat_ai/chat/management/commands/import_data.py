@@ -0,0 +1,386 @@
+# chat/management/commands/import_data.py
+
+import csv
+import gzip
+import json
+import os
+import re
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import DateTimeField, JSONField, Max, Min, Count
+from django.utils import timezone
+
+from chat.management.commands.export_data import APP_NAME, ALL_MODELS, get_export_fields
+
+# 匯出檔名：chatmessage_export.csv、aichatmessage_export.0003.csv.gz、log/NN/ai_chatmessage_export.csv ...
+EXPORT_FILE_PATTERN = re.compile(r'_export(\.\d+)?\.csv(\.gz)?$')
+
+DEFAULT_CHUNK_SIZE = 2000
+DEFAULT_ROOM_SUFFIX = '_imported'
+
+
+def find_export_files(paths):
+    """Expand files and directories into a sorted list of export CSV files."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _dirs, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in names if EXPORT_FILE_PATTERN.search(name))
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            raise CommandError(f"Path '{path}' does not exist.")
+    return sorted(files)
+
+
+def open_csv(file_path):
+    """Open an export for reading; utf-8-sig drops the BOM the exporter writes."""
+    if file_path.endswith('.gz'):
+        return gzip.open(file_path, 'rt', newline='', encoding='utf-8-sig')
+    return open(file_path, newline='', encoding='utf-8-sig')
+
+
+def read_header(file_path):
+    with open_csv(file_path) as csvfile:
+        return next(csv.reader(csvfile), [])
+
+
+def detect_model(header):
+    """
+    Pick the model whose fields overlap the header the most. Old exports
+    carry columns that were removed since (ai_user_summary, send_in_mode_c)
+    and lack columns added since (seq), so an exact match is not required;
+    only a missing column that the import cannot fill with a default counts
+    against a model.
+    """
+    columns = set(header)
+    scored = []
+    for model_name in ALL_MODELS:
+        model = apps.get_model(app_label=APP_NAME, model_name=model_name)
+        fields = get_export_fields(model)
+        field_names = {field.name for field in fields}
+        required = {field.name for field in fields if not (field.null or field.has_default())}
+        scored.append((len(columns & field_names) - len(required - columns), model))
+    scored.sort(key=lambda item: item[0], reverse=True)
+    if 'id' not in columns or 'room_name' not in columns or scored[0][0] == scored[1][0]:
+        return None
+    return scored[0][1]
+
+
+def make_parsers(model, header):
+    """Column index -> (field name, parser) for every column the model knows about."""
+    fields = {field.name: field for field in get_export_fields(model)}
+    parsers = {}
+    for index, column in enumerate(header):
+        field = fields.get(column)
+        if field is None:
+            continue
+        if column == model._meta.pk.name:
+            parse = int
+        elif isinstance(field, DateTimeField):
+            parse = datetime.fromisoformat
+        elif isinstance(field, JSONField):
+            parse = lambda value, field=field: json.loads(value) if value else field.get_default()
+        elif field.get_internal_type() in ('IntegerField', 'BigIntegerField', 'SmallIntegerField'):
+            parse = lambda value, field=field: int(value) if value else field.get_default()
+        else:
+            parse = str
+        parsers[index] = (column, parse)
+    return parsers
+
+
+def content_fields(model, parsers):
+    """
+    Fields that identify a row by content: every parsed column except the id,
+    the room and JSON fields (likes keep changing after the export).
+    """
+    return tuple(
+        name for name, _ in parsers.values()
+        if name not in (model._meta.pk.name, 'room_name')
+        and not isinstance(model._meta.get_field(name), JSONField)
+    )
+
+
+def content_key(values, fields):
+    """Comparable content of a parsed CSV row or a database row; empty and NULL are the same."""
+    key = []
+    for name in fields:
+        value = values.get(name)
+        if value is None:
+            value = ''
+        elif isinstance(value, datetime) and timezone.is_naive(value):
+            value = timezone.make_aware(value)
+        key.append(value)
+    return tuple(key)
+
+
+def iter_chunks(file_path, parsers, chunk_size):
+    """Yield lists of {field: value} dicts, `chunk_size` rows at a time."""
+    with open_csv(file_path) as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader, None)
+        chunk = []
+        for row in reader:
+            chunk.append({name: parse(row[index]) for index, (name, parse) in parsers.items() if index < len(row)})
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def scan_rooms(file_path, header):
+    """First, cheap pass: per room, the id range and row count found in the file."""
+    id_index = header.index('id')
+    room_index = header.index('room_name')
+    rooms = {}
+    with open_csv(file_path) as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader, None)
+        for row in reader:
+            row_id = int(row[id_index])
+            low, high, count = rooms.get(row[room_index], (row_id, row_id, 0))
+            rooms[row[room_index]] = (min(low, row_id), max(high, row_id), count + 1)
+    return rooms
+
+
+@contextmanager
+def preserve_auto_now(model):
+    """Keep the exported timestamps instead of letting auto_now_add stamp the import time."""
+    switched = []
+    for field in model._meta.concrete_fields:
+        if getattr(field, 'auto_now_add', False) or getattr(field, 'auto_now', False):
+            switched.append((field, field.auto_now, field.auto_now_add))
+            field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in switched:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+class Command(BaseCommand):
+    help = 'Imports *_export.csv files (e.g. log/NN/) back into the chat models, preserving ids and timestamps.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths',
+            nargs='+',
+            type=str,
+            help='Export CSV files (optionally .gz) or directories to scan for *_export.csv files.'
+        )
+        parser.add_argument(
+            '--chunk_size',
+            type=int,
+            default=DEFAULT_CHUNK_SIZE,
+            help=f'Rows inserted per bulk_create / transaction (default: {DEFAULT_CHUNK_SIZE}).'
+        )
+        parser.add_argument(
+            '--room_suffix',
+            type=str,
+            default=DEFAULT_ROOM_SUFFIX,
+            help='Suffix used to rename a room that already holds different data, e.g. "7" -> "7_imported1".'
+        )
+        parser.add_argument(
+            '--no_remap',
+            action='store_true',
+            help='Import into the original room names even if they already hold other data.'
+        )
+        parser.add_argument(
+            '--dry_run',
+            action='store_true',
+            help='Only report what would be imported.'
+        )
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk_size must be at least 1.')
+
+        files = find_export_files(options['paths'])
+        if not files:
+            self.stdout.write(self.style.WARNING("No *_export.csv files found. Nothing to import."))
+            return
+
+        # 步驟一：辨識每個檔案屬於哪個模型，並統計每個房間的 id 範圍
+        plan = []
+        room_ranges = {}
+        self.sources = {}
+        self.signatures = {}
+        for file_path in files:
+            header = read_header(file_path)
+            model = detect_model(header)
+            if model is None:
+                self.stderr.write(self.style.ERROR(f"Cannot tell which model '{file_path}' belongs to (header: {header}). Skipping."))
+                continue
+            ignored = [column for column in header if column not in {f.name for f in get_export_fields(model)}]
+            if ignored:
+                self.stdout.write(self.style.WARNING(f"  - '{file_path}': ignoring unknown columns {', '.join(ignored)}."))
+            rooms = scan_rooms(file_path, header)
+            for room, (low, high, count) in rooms.items():
+                key = (model, room)
+                previous = room_ranges.get(key)
+                if previous:
+                    low, high, count = min(low, previous[0]), max(high, previous[1]), count + previous[2]
+                room_ranges[key] = (low, high, count)
+            plan.append((file_path, model, header))
+            self.sources.setdefault(model, []).append((file_path, header))
+            self.stdout.write(f"  - '{file_path}' -> {model.__name__} ({sum(c for _, _, c in rooms.values())} rows, {len(rooms)} rooms)")
+
+        # 步驟二：房間名稱衝突時改名，重複匯入時會選到同一個名稱
+        room_map = self.plan_room_names(room_ranges, options)
+        for room, target in sorted(room_map.items()):
+            if room != target:
+                self.stdout.write(self.style.WARNING(f"  - Room '{room}' already holds other data; importing it as '{target}'."))
+
+        if options['dry_run']:
+            self.stdout.write(self.style.NOTICE("Dry run: nothing was written."))
+            return
+
+        # 步驟三：分批寫入
+        touched_models = set()
+        totals = {'inserted': 0, 'skipped': 0, 'reassigned': 0}
+        started = time.monotonic()
+        for file_path, model, header in plan:
+            stats = self.import_file(file_path, model, header, room_map, options['chunk_size'])
+            touched_models.add(model)
+            for key in totals:
+                totals[key] += stats[key]
+            self.stdout.write(self.style.SUCCESS(
+                f"    - '{file_path}': {stats['inserted']} inserted, {stats['skipped']} already present, "
+                f"{stats['reassigned']} given new ids."
+            ))
+
+        self.reset_sequences(touched_models)
+        self.stdout.write(self.style.SUCCESS(
+            f"\nImported {totals['inserted']} records ({totals['skipped']} already present, "
+            f"{totals['reassigned']} with new ids) in {time.monotonic() - started:.2f}s."
+        ))
+
+    def plan_room_names(self, room_ranges, options):
+        """Map every room found in the files to the room name it will be imported as."""
+        rooms = sorted({room for _model, room in room_ranges})
+        if options['no_remap']:
+            return {room: room for room in rooms}
+
+        room_map = {}
+        for room in rooms:
+            candidate, attempt = room, 0
+            while self.room_collides(candidate, room, room_ranges):
+                attempt += 1
+                candidate = f"{room}{options['room_suffix']}{attempt}"
+            room_map[room] = candidate
+        return room_map
+
+    def room_collides(self, target, room, room_ranges):
+        """
+        A target room collides when the database holds rows in it that did not
+        come from these files: more rows than the file has, or rows outside the
+        file's id range whose content is not in the file. Rows from an earlier
+        import of the same files never collide, including rows that were given
+        new ids, which keeps re-imports idempotent.
+        """
+        for (model, source_room), (low, high, count) in room_ranges.items():
+            if source_room != room:
+                continue
+            rows = model.objects.filter(room_name=target)
+            existing = rows.aggregate(low=Min('id'), high=Max('id'), total=Count('id'))
+            if not existing['total']:
+                continue
+            if existing['total'] > count:
+                return True
+            if existing['low'] < low or existing['high'] > high:
+                fields, signatures = self.file_signatures(model, room)
+                outside = rows.exclude(id__range=(low, high)).values(*fields)
+                if any(content_key(values, fields) not in signatures for values in outside.iterator()):
+                    return True
+        return False
+
+    def file_signatures(self, model, room):
+        """(content fields, content keys) of the rows of `room` in this run's files, read once per room."""
+        if (model, room) not in self.signatures:
+            parsed = [(file_path, make_parsers(model, header)) for file_path, header in self.sources[model]]
+            # 欄位取所有檔案共有的欄位，舊版匯出檔可能少了幾欄
+            fields = tuple(sorted(set.intersection(*(set(content_fields(model, parsers)) for _, parsers in parsed))))
+            signatures = set()
+            for file_path, parsers in parsed:
+                for chunk in iter_chunks(file_path, parsers, DEFAULT_CHUNK_SIZE):
+                    signatures.update(content_key(values, fields) for values in chunk if values['room_name'] == room)
+            self.signatures[(model, room)] = (fields, signatures)
+        return self.signatures[(model, room)]
+
+    def import_file(self, file_path, model, header, room_map, chunk_size):
+        parsers = make_parsers(model, header)
+        fields = content_fields(model, parsers)
+        has_timestamp = 'timestamp' in fields
+        stats = {'inserted': 0, 'skipped': 0, 'reassigned': 0}
+
+        for chunk in iter_chunks(file_path, parsers, chunk_size):
+            for values in chunk:
+                values['room_name'] = room_map.get(values['room_name'], values['room_name'])
+
+            existing = dict(model.objects.filter(id__in=[values['id'] for values in chunk]).values_list('id', 'room_name'))
+            new_rows, moved_rows = [], []
+            for values in chunk:
+                current_room = existing.get(values['id'])
+                if current_room is None:
+                    new_rows.append(values)
+                elif current_room == values['room_name']:
+                    stats['skipped'] += 1
+                else:
+                    # 同一個 id 已被其他房間使用：保留內容，改用新的 id
+                    moved_rows.append(values)
+
+            if moved_rows:
+                # 以內容 (房間與 id 以外的欄位) 判斷是否在先前的匯入中已經改配 id 寫入過
+                candidates = model.objects.filter(room_name__in={values['room_name'] for values in moved_rows})
+                if has_timestamp:
+                    candidates = candidates.filter(timestamp__in=[values['timestamp'] for values in moved_rows])
+                seen = {
+                    (values['room_name'], content_key(values, fields))
+                    for values in candidates.values('room_name', *fields).iterator()
+                }
+                remaining = []
+                for values in moved_rows:
+                    if (values['room_name'], content_key(values, fields)) in seen:
+                        stats['skipped'] += 1
+                    else:
+                        remaining.append(values)
+                moved_rows = remaining
+
+            # 以寫入前後的筆數計算實際寫入的列，衝突而略過的列不算
+            rooms = {values['room_name'] for values in chunk}
+            before = model.objects.filter(room_name__in=rooms).count()
+            with transaction.atomic(), preserve_auto_now(model):
+                model.objects.bulk_create(
+                    [model(**values) for values in new_rows], batch_size=chunk_size, ignore_conflicts=True
+                )
+            if moved_rows:
+                # 先把序列移到剛寫入的 id 之後，新配的 id 才不會撞上它們
+                self.reset_sequences([model])
+                objects = []
+                for values in moved_rows:
+                    values = dict(values)
+                    values.pop('id')
+                    objects.append(model(**values))
+                with transaction.atomic(), preserve_auto_now(model):
+                    model.objects.bulk_create(objects, batch_size=chunk_size)
+            inserted = model.objects.filter(room_name__in=rooms).count() - before
+            stats['inserted'] += inserted
+            stats['skipped'] += len(new_rows) + len(moved_rows) - inserted
+            stats['reassigned'] += len(moved_rows)
+        return stats
+
+    def reset_sequences(self, models):
+        """Explicit ids do not advance PostgreSQL sequences; move them past the imported ids."""
+        statements = connection.ops.sequence_reset_sql(no_style(), list(models))
+        if not statements:
+            return
+        with connection.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
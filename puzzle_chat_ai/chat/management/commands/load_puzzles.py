@@ -0,0 +1,90 @@
+# chat/management/commands/load_puzzles.py
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from chat.models import Puzzle
+from chat.services.puzzle_catalog import puzzle_catalog
+
+REQUIRED_FIELDS = ('slug', 'question', 'answer')
+
+
+def read_puzzles(path):
+    """Puzzles from a JSON file holding a list of puzzles or {"puzzles": [...]}."""
+    try:
+        with open(path, encoding='utf-8') as puzzle_file:
+            data = json.load(puzzle_file)
+    except (OSError, json.JSONDecodeError) as e:
+        raise CommandError(f"Cannot read puzzles from '{path}': {e}")
+    puzzles = data.get('puzzles') if isinstance(data, dict) else data
+    if not isinstance(puzzles, list):
+        raise CommandError(f"'{path}' must contain a list of puzzles.")
+    for index, puzzle in enumerate(puzzles):
+        missing = [field for field in REQUIRED_FIELDS if not isinstance(puzzle, dict) or not puzzle.get(field)]
+        if missing:
+            raise CommandError(f"Puzzle #{index} in '{path}' is missing {', '.join(missing)}.")
+    return puzzles
+
+
+class Command(BaseCommand):
+    help = ('Loads puzzles into the catalog from JSON files (created or updated by slug) and assigns rooms to '
+            'puzzles. Running servers pick up edited puzzles within PUZZLE_CATALOG["ASSET_TTL"] seconds.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths',
+            nargs='*',
+            type=str,
+            help='JSON files with objects of slug, question, answer and optional title and solution_keywords.'
+        )
+        parser.add_argument(
+            '--assign',
+            nargs='+',
+            default=[],
+            metavar='ROOM=SLUG',
+            help='Rooms to assign to a puzzle; a room with messages cannot switch puzzles.'
+        )
+        parser.add_argument('--dry_run', action='store_true', help='Validate the files without writing anything.')
+
+    def handle(self, *args, **options):
+        if not options['paths'] and not options['assign']:
+            raise CommandError('Give at least one puzzle file or --assign.')
+
+        puzzles = [puzzle for path in options['paths'] for puzzle in read_puzzles(path)]
+        assignments = []
+        for item in options['assign']:
+            room_name, _, slug = item.partition('=')
+            if not room_name or not slug:
+                raise CommandError(f"Invalid assignment '{item}', expected ROOM=SLUG.")
+            assignments.append((room_name, slug))
+
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING(
+                f"Dry run: {len(puzzles)} puzzles and {len(assignments)} assignments not written."
+            ))
+            return
+
+        with transaction.atomic():
+            for puzzle in puzzles:
+                _, created = Puzzle.objects.update_or_create(slug=puzzle['slug'], defaults={
+                    'title': puzzle.get('title', ''),
+                    'question': puzzle['question'],
+                    'answer': puzzle['answer'],
+                    'solution_keywords': puzzle.get('solution_keywords', []),
+                })
+                self.stdout.write(f"  - {'created' if created else 'updated'} puzzle '{puzzle['slug']}'")
+
+            for room_name, slug in assignments:
+                try:
+                    puzzle_catalog.assign(room_name, slug)
+                except Puzzle.DoesNotExist:
+                    raise CommandError(f"Unknown puzzle '{slug}'.")
+                except ValueError as e:
+                    raise CommandError(str(e))
+                self.stdout.write(f"  - room '{room_name}' plays '{slug}'")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Loaded {len(puzzles)} puzzles and {len(assignments)} room assignments."
+        ))
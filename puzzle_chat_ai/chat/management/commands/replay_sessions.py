@@ -0,0 +1,449 @@
+# chat/management/commands/replay_sessions.py
+
+import asyncio
+import csv
+import json
+import os
+import time
+from collections import defaultdict
+from datetime import datetime
+from urllib.parse import quote
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.constants import MESSAGE_TYPES
+from chat.models import ChatMessage, AIChatMessage
+from chat.management.commands.import_data import find_export_files, open_csv, read_header, detect_model
+
+WEBSOCKET_PATH = '/ws/socket-server/'
+DEFAULT_URL = f'ws://127.0.0.1:8000{WEBSOCKET_PATH}'
+DEFAULT_ROOM_PREFIX = 'replay_'
+DEFAULT_TIMEOUT = 30.0
+PERCENTILES = (50, 90, 95, 99)
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def connection_query(room_name, user_name):
+    # 與 static/scripts.js 相同：參數直接放進網址，不另外編碼
+    return f'userName={user_name}&roomName={room_name}'
+
+
+def load_sessions(paths, rooms=None, skip_ai=False):
+    """
+    Read chat / AI exports into one timeline per room:
+    {room: [(timestamp, user_name, message_type, payload, extra), ...]} sorted by time.
+    """
+    sessions = defaultdict(list)
+    for file_path in find_export_files(paths):
+        model = detect_model(read_header(file_path))
+        if model not in (ChatMessage, AIChatMessage):
+            continue
+        if model is AIChatMessage and skip_ai:
+            continue
+        with open_csv(file_path) as csvfile:
+            for row in csv.DictReader(csvfile):
+                if rooms and row['room_name'] not in rooms:
+                    continue
+                timestamp = datetime.fromisoformat(row['timestamp'])
+                if model is ChatMessage:
+                    payload = {
+                        'type': MESSAGE_TYPES['CHAT_MESSAGE'],
+                        'message': row['message'],
+                        'replyText': row.get('reply_message', ''),
+                        'replyAuthor': row.get('reply_author', ''),
+                    }
+                    extra = {'liked_by': json.loads(row.get('liked_by') or '[]')}
+                else:
+                    payload = {
+                        'type': MESSAGE_TYPES['AI_MESSAGE'],
+                        'message': row['message'],
+                        'mode': row.get('mode') or 'A',
+                    }
+                    extra = {'suggestion_response': row.get('suggestion_response', '')}
+                sessions[row['room_name']].append((timestamp, row['user_name'], payload['type'], payload, extra))
+
+    # 同一個房間可能出現在多個 log 目錄 (例如 log/02 與 log/03)，以 (時間, 使用者, 內容) 去重
+    timelines = {}
+    for room, events in sessions.items():
+        unique = {(event[0], event[1], event[3]['message']): event for event in events}
+        timelines[room] = sorted(unique.values(), key=lambda event: event[0])
+    return timelines
+
+
+class Stats:
+    """Latency samples and outcome counters per message type."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.sent = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.timeouts = defaultdict(int)
+        self.connect_failures = 0
+        self.started = time.monotonic()
+        self.finished = None
+
+    def record(self, message_type, latency):
+        self.latencies[message_type].append(latency)
+
+    def report(self):
+        elapsed = (self.finished or time.monotonic()) - self.started
+        types = {}
+        for message_type in sorted(set(self.sent) | set(self.latencies)):
+            if message_type == 'unsolicited':
+                continue
+            samples = sorted(self.latencies[message_type])
+            sent = self.sent[message_type]
+            types[message_type] = {
+                'sent': sent,
+                'completed': len(samples),
+                'errors': self.errors[message_type],
+                'timeouts': self.timeouts[message_type],
+                'error_rate': (self.errors[message_type] + self.timeouts[message_type]) / sent if sent else 0.0,
+                'throughput_per_s': len(samples) / elapsed if elapsed else 0.0,
+                'latency_ms': {
+                    f'p{pct}': round(percentile(samples, pct) * 1000, 2) if samples else None
+                    for pct in PERCENTILES
+                },
+                'latency_max_ms': round(samples[-1] * 1000, 2) if samples else None,
+            }
+        return {
+            'elapsed_s': round(elapsed, 3),
+            'messages_sent': sum(self.sent.values()),
+            'messages_per_s': round(sum(self.sent.values()) / elapsed, 2) if elapsed else 0.0,
+            'connect_failures': self.connect_failures,
+            'unsolicited_errors': self.errors['unsolicited'],
+            'types': types,
+        }
+
+
+class ReplayClient:
+    """
+    One replayed user. A background reader resolves pending requests when the
+    matching broadcast or reply arrives; an 'error' frame fails the oldest one.
+    """
+
+    def __init__(self, transport, user_name, stats, timeout):
+        self.transport = transport
+        self.user_name = user_name
+        # 經過真實 socket 時，非 ASCII 的名字會以百分比編碼的形式回到 consumer
+        self.names = {user_name, quote(user_name)}
+        self.stats = stats
+        self.timeout = timeout
+        self.pending = {}
+        self.order = []
+        self.reader = None
+
+    async def start(self):
+        await self.transport.connect()
+        self.reader = asyncio.create_task(self._read_loop())
+
+    async def close(self):
+        if self.reader:
+            self.reader.cancel()
+        await self.transport.close()
+
+    async def request(self, payload, key):
+        """Send `payload` and wait for the frame identified by `key`; returns that frame or None."""
+        message_type = payload['type']
+        entry = (asyncio.get_running_loop().create_future(), time.monotonic(), message_type)
+        # 同一個人可能重複問同一句話，相同 key 依送出順序排隊
+        self.pending.setdefault(key, []).append(entry)
+        self.order.append(entry)
+        self.stats.sent[message_type] += 1
+        await self.transport.send(json.dumps(payload))
+        try:
+            return await asyncio.wait_for(asyncio.shield(entry[0]), self.timeout)
+        except asyncio.TimeoutError:
+            self.stats.timeouts[message_type] += 1
+            return None
+        finally:
+            self._forget(key, entry)
+
+    async def send(self, payload):
+        """Fire-and-forget messages (suggestion_response has no reply)."""
+        self.stats.sent[payload['type']] += 1
+        await self.transport.send(json.dumps(payload))
+
+    async def _read_loop(self):
+        while True:
+            data = json.loads(await self.transport.receive())
+            message_type = data.get('type')
+            if message_type == MESSAGE_TYPES['CHAT_MESSAGE'] and data.get('user_name') in self.names:
+                self._resolve(('chat', data.get('message')), data)
+            elif message_type == MESSAGE_TYPES['AI_MESSAGE'] and data.get('sender') in self.names:
+                self._resolve(('ai', data.get('user_message')), data)
+            elif message_type in (MESSAGE_TYPES['LIKE_MESSAGE'], 'like_update'):
+                # ChatConsumer.like_update 的 **event 會蓋掉 type，實際收到的是 'like_update'
+                self._resolve(('like', data.get('message_id')), data)
+            elif message_type == 'error':
+                waiting = [entry for entry in self.order if not entry[0].done()]
+                if waiting:
+                    future, _sent_at, sent_type = waiting[0]
+                    self.stats.errors[sent_type] += 1
+                    future.set_result(None)
+                else:
+                    self.stats.errors['unsolicited'] += 1
+
+    def _resolve(self, key, data):
+        for future, sent_at, message_type in self.pending.get(key, ()):
+            if not future.done():
+                self.stats.record(message_type, time.monotonic() - sent_at)
+                future.set_result(data)
+                return
+
+    def _forget(self, key, entry):
+        queue = self.pending.get(key)
+        if queue and entry in queue:
+            queue.remove(entry)
+            if not queue:
+                del self.pending[key]
+        if entry in self.order:
+            self.order.remove(entry)
+
+
+class CommunicatorTransport:
+    """Drives ChatConsumer in-process through channels.testing.WebsocketCommunicator."""
+
+    def __init__(self, application, room_name, user_name):
+        from channels.testing import WebsocketCommunicator
+        self.communicator = WebsocketCommunicator(application, f'{WEBSOCKET_PATH}?{connection_query(room_name, user_name)}')
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect()
+        if not connected:
+            raise ConnectionError('WebSocket connection rejected')
+
+    async def send(self, text):
+        await self.communicator.send_to(text_data=text)
+
+    async def receive(self):
+        while True:
+            try:
+                return await self.communicator.receive_from(timeout=3600)
+            except asyncio.TimeoutError:
+                continue
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class SocketTransport:
+    """Real WebSocket connection to a running daphne, through aiohttp."""
+
+    def __init__(self, session, url, room_name, user_name):
+        self.session = session
+        self.url = f'{url}?{connection_query(room_name, user_name)}'
+        self.ws = None
+
+    async def connect(self):
+        self.ws = await self.session.ws_connect(self.url)
+
+    async def send(self, text):
+        await self.ws.send_str(text)
+
+    async def receive(self):
+        return await self.ws.receive_str()
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+
+
+class Command(BaseCommand):
+    help = 'Replays recorded sessions (*_export.csv) against ChatConsumer and reports per-type latency percentiles, throughput and error rates.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths',
+            nargs='*',
+            type=str,
+            default=['log'],
+            help='Export CSV files or directories holding them (default: log).'
+        )
+        parser.add_argument(
+            '--rooms',
+            nargs='+',
+            type=str,
+            help='Only replay these recorded rooms.'
+        )
+        parser.add_argument(
+            '--copies',
+            type=int,
+            default=1,
+            help='Replay every recorded room this many times concurrently, as separate rooms.'
+        )
+        parser.add_argument(
+            '--speed',
+            type=float,
+            default=1.0,
+            help='Time acceleration: 1 = real time, 60 = one recorded minute per second, 0 = no waiting.'
+        )
+        parser.add_argument(
+            '--max_gap',
+            type=float,
+            default=None,
+            help='Cap any recorded pause between two messages at this many (recorded) seconds.'
+        )
+        parser.add_argument(
+            '--target',
+            choices=['inprocess', 'socket'],
+            default='inprocess',
+            help='Drive the consumer in-process (WebsocketCommunicator) or over real sockets (--url).'
+        )
+        parser.add_argument(
+            '--url',
+            type=str,
+            default=DEFAULT_URL,
+            help=f'WebSocket endpoint for --target socket (default: {DEFAULT_URL}).'
+        )
+        parser.add_argument(
+            '--room_prefix',
+            type=str,
+            default=DEFAULT_ROOM_PREFIX,
+            help=f'Prefix for replayed room names, so they can be removed with delete_room_data --room_glob "{DEFAULT_ROOM_PREFIX}*".'
+        )
+        parser.add_argument(
+            '--skip_ai',
+            action='store_true',
+            help='Do not replay AI questions (avoids calling the AI provider).'
+        )
+        parser.add_argument(
+            '--timeout',
+            type=float,
+            default=DEFAULT_TIMEOUT,
+            help=f'Seconds to wait for the reply to one message (default: {DEFAULT_TIMEOUT}).'
+        )
+        parser.add_argument(
+            '--output',
+            type=str,
+            help='Write the report as JSON to this file.'
+        )
+
+    def handle(self, *args, **options):
+        if options['copies'] < 1:
+            raise CommandError('--copies must be at least 1.')
+        if options['speed'] < 0:
+            raise CommandError('--speed cannot be negative.')
+
+        timelines = load_sessions(options['paths'], options['rooms'], options['skip_ai'])
+        if not timelines:
+            raise CommandError('No recorded messages found in the given paths.')
+
+        total = sum(len(events) for events in timelines.values())
+        self.stdout.write(
+            f"Replaying {total} messages from {len(timelines)} room(s) x {options['copies']} "
+            f"at speed {options['speed'] or 'max'} against {options['target']}..."
+        )
+
+        stats = asyncio.run(self.replay(timelines, options))
+        report = stats.report()
+        report['options'] = {key: options[key] for key in ('copies', 'speed', 'max_gap', 'target', 'skip_ai')}
+        report['rooms'] = len(timelines) * options['copies']
+        self.print_report(report)
+
+        if options['output']:
+            directory = os.path.dirname(os.path.abspath(options['output']))
+            os.makedirs(directory, exist_ok=True)
+            with open(options['output'], 'w', encoding='utf-8') as output:
+                json.dump(report, output, indent=2, ensure_ascii=False)
+            self.stdout.write(self.style.SUCCESS(f"Report written to '{options['output']}'."))
+
+    async def replay(self, timelines, options):
+        stats = Stats()
+        session = None
+        if options['target'] == 'socket':
+            import aiohttp
+            session = aiohttp.ClientSession()
+            make_transport = lambda room, user: SocketTransport(session, options['url'], room, user)
+        else:
+            from puzzle_chat_ai.asgi import application
+            make_transport = lambda room, user: CommunicatorTransport(application, room, user)
+
+        try:
+            await asyncio.gather(*(
+                self.replay_room(f"{options['room_prefix']}{room}_{copy}", events, make_transport, stats, options)
+                for room, events in timelines.items()
+                for copy in range(options['copies'])
+            ))
+        finally:
+            stats.finished = time.monotonic()
+            if session is not None:
+                await session.close()
+        return stats
+
+    async def replay_room(self, room_name, events, make_transport, stats, options):
+        clients = {}
+        for user_name in sorted({event[1] for event in events}):
+            client = ReplayClient(make_transport(room_name, user_name), user_name, stats, options['timeout'])
+            try:
+                await client.start()
+            except Exception as e:
+                stats.connect_failures += 1
+                self.stderr.write(self.style.ERROR(f"  - {user_name}@{room_name}: connect failed: {e}"))
+                continue
+            clients[user_name] = client
+
+        speed, max_gap = options['speed'], options['max_gap']
+        started = time.monotonic()
+        offset = 0.0
+        previous = events[0][0]
+        in_flight = []
+        try:
+            for timestamp, user_name, message_type, payload, extra in events:
+                gap = (timestamp - previous).total_seconds()
+                offset += min(gap, max_gap) if max_gap is not None else gap
+                previous = timestamp
+                if speed:
+                    delay = started + offset / speed - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                client = clients.get(user_name)
+                if client is None:
+                    continue
+                in_flight.append(asyncio.create_task(self.replay_event(client, clients, message_type, payload, extra)))
+            await asyncio.gather(*in_flight)
+        finally:
+            for client in clients.values():
+                await client.close()
+
+    async def replay_event(self, client, clients, message_type, payload, extra):
+        if message_type == MESSAGE_TYPES['CHAT_MESSAGE']:
+            reply = await client.request(payload, ('chat', payload['message']))
+            if reply and reply.get('message_id'):
+                # 按讚在紀錄中沒有時間，訊息送達後由按讚的人立即送出
+                for liker in extra['liked_by']:
+                    if liker in clients:
+                        await clients[liker].request(
+                            {'type': MESSAGE_TYPES['LIKE_MESSAGE'], 'messageId': reply['message_id']},
+                            ('like', reply['message_id']),
+                        )
+        else:
+            reply = await client.request(payload, ('ai', payload['message']))
+            if reply and reply.get('message_id') and extra['suggestion_response'] in ('sent', 'dismissed'):
+                await client.send({
+                    'type': MESSAGE_TYPES['SUGGESTION_RESPONSE'],
+                    'messageId': reply['message_id'],
+                    'responseType': extra['suggestion_response'],
+                })
+
+    def print_report(self, report):
+        self.stdout.write(self.style.SUCCESS(
+            f"\nSent {report['messages_sent']} messages in {report['elapsed_s']}s "
+            f"({report['messages_per_s']}/s) across {report['rooms']} room(s); "
+            f"{report['connect_failures']} connection failure(s)."
+        ))
+        header = f"{'type':<20}{'sent':>8}{'done':>8}{'err%':>8}" + ''.join(f"{f'p{pct} ms':>11}" for pct in PERCENTILES)
+        self.stdout.write(header)
+        for message_type, row in report['types'].items():
+            latency = row['latency_ms']
+            self.stdout.write(
+                f"{message_type:<20}{row['sent']:>8}{row['completed']:>8}{row['error_rate'] * 100:>7.1f}%"
+                + ''.join(f"{latency[f'p{pct}'] if latency[f'p{pct}'] is not None else '-':>11}" for pct in PERCENTILES)
+            )
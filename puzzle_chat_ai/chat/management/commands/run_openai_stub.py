@@ -0,0 +1,78 @@
+# chat/management/commands/run_openai_stub.py
+
+import json
+
+from aiohttp import web
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.openai_stub import create_app, DEFAULT_STUB_CONFIG
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8001
+
+
+class Command(BaseCommand):
+    help = 'Runs a local OpenAI-compatible /v1/chat/completions stand-in with latency and fault injection.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', type=str, default=DEFAULT_HOST)
+        parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+        parser.add_argument(
+            '--latency_distribution',
+            choices=['fixed', 'uniform', 'normal', 'lognormal', 'exponential'],
+            default=DEFAULT_STUB_CONFIG['latency_distribution'],
+            help='Shape of the response delay.'
+        )
+        parser.add_argument(
+            '--latency_ms',
+            type=float,
+            default=DEFAULT_STUB_CONFIG['latency_ms'],
+            help='Mean delay (median for lognormal) in milliseconds.'
+        )
+        parser.add_argument(
+            '--latency_jitter_ms',
+            type=float,
+            default=DEFAULT_STUB_CONFIG['latency_jitter_ms'],
+            help='Spread in milliseconds: half-width (uniform), standard deviation (normal); for lognormal, sigma = jitter / latency.'
+        )
+        parser.add_argument('--rate_429', type=float, default=0.0, help='Fraction of requests answered with 429.')
+        parser.add_argument('--rate_500', type=float, default=0.0, help='Fraction of requests answered with 500.')
+        parser.add_argument('--rate_timeout', type=float, default=0.0, help='Fraction of requests that hang for --timeout_seconds.')
+        parser.add_argument('--timeout_seconds', type=float, default=DEFAULT_STUB_CONFIG['timeout_seconds'])
+        parser.add_argument('--stream_chunk_ms', type=float, default=DEFAULT_STUB_CONFIG['stream_chunk_ms'], help='Delay between SSE chunks.')
+        parser.add_argument('--stream_chunk_chars', type=int, default=DEFAULT_STUB_CONFIG['stream_chunk_chars'], help='Characters per SSE chunk.')
+        parser.add_argument(
+            '--verdict_weights',
+            type=str,
+            help='JSON object of judge verdict -> weight, e.g. \'{"是": 1, "否": 1}\'.'
+        )
+        parser.add_argument('--seed', type=int, help='Seed for reproducible latency and fault sequences.')
+
+    def handle(self, *args, **options):
+        if options['rate_429'] + options['rate_500'] + options['rate_timeout'] > 1:
+            raise CommandError('--rate_429 + --rate_500 + --rate_timeout cannot exceed 1.')
+
+        verdict_weights = None
+        if options['verdict_weights']:
+            try:
+                verdict_weights = json.loads(options['verdict_weights'])
+            except json.JSONDecodeError as e:
+                raise CommandError(f"--verdict_weights is not valid JSON: {e}")
+
+        app = create_app(
+            latency_distribution=options['latency_distribution'],
+            latency_ms=options['latency_ms'],
+            latency_jitter_ms=options['latency_jitter_ms'],
+            rate_429=options['rate_429'],
+            rate_500=options['rate_500'],
+            rate_timeout=options['rate_timeout'],
+            timeout_seconds=options['timeout_seconds'],
+            stream_chunk_ms=options['stream_chunk_ms'],
+            stream_chunk_chars=options['stream_chunk_chars'],
+            verdict_weights=verdict_weights,
+            seed=options['seed'],
+        )
+        url = f"http://{options['host']}:{options['port']}/v1/chat/completions"
+        self.stdout.write(self.style.SUCCESS(f"OpenAI stub listening on {url}"))
+        self.stdout.write(f"Set OPENAI_API_URL={url} for the app; request counters at /stats.")
+        web.run_app(app, host=options['host'], port=options['port'], print=None)
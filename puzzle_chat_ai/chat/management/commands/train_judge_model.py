@@ -0,0 +1,110 @@
+# chat/management/commands/train_judge_model.py
+
+import os
+import random
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.constants import JUDGE_CLASSIFIER
+from chat.management.commands.warm_judge_cache import VerdictHistoryMixin
+from chat.services import judge_classifier
+from chat.services.puzzle_catalog import puzzle_catalog
+
+
+class Command(VerdictHistoryMixin, BaseCommand):
+    help = ('Trains the local judge classifier of a puzzle on historical judge verdicts and saves it where '
+            'the server loads it (JUDGE_CLASSIFIER_DIR/<puzzle>.npz).')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--source',
+            choices=['db', 'csv', 'both'],
+            default='both',
+            help='Read history from the database, from export CSV files, or both (default: both).'
+        )
+        parser.add_argument(
+            '--paths',
+            nargs='+',
+            type=str,
+            default=['log'],
+            help='Export files or directories to scan for CSV history (default: log).'
+        )
+        parser.add_argument('--puzzle', type=str, default=puzzle_catalog.default_slug, help='Puzzle slug to train for.')
+        parser.add_argument('--output', type=str, help='Model file (default: JUDGE_CLASSIFIER_DIR/<puzzle>.npz).')
+        parser.add_argument('--ngram_max', type=int, default=JUDGE_CLASSIFIER['NGRAM_MAX'], help='Longest character n-gram.')
+        parser.add_argument('--epochs', type=int, default=JUDGE_CLASSIFIER['EPOCHS'], help='Gradient descent steps.')
+        parser.add_argument('--l2', type=float, default=JUDGE_CLASSIFIER['L2'], help='L2 regularisation strength.')
+        parser.add_argument(
+            '--holdout',
+            type=float,
+            default=JUDGE_CLASSIFIER['HOLDOUT'],
+            help='Share of distinct questions held out for calibration and the report (default: 0.2).'
+        )
+        parser.add_argument('--seed', type=int, default=0, help='Random seed of the held-out split.')
+        parser.add_argument('--dry_run', action='store_true', help='Train and report without saving the model.')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        slug = options['puzzle']
+        if slug not in puzzle_catalog.slugs():
+            raise CommandError(f"Unknown puzzle '{slug}'.")
+        if not 0 < options['holdout'] < 1:
+            raise CommandError('--holdout must be between 0 and 1.')
+
+        answers, _ = self.collect_verdicts(options['source'], options['paths'])
+        examples = [
+            (canonical, verdict, count)
+            for canonical, counts in answers[slug].items()
+            for verdict, count in counts.items()
+        ]
+        questions = sorted({canonical for canonical, _, _ in examples})
+        if len(questions) < 10:
+            raise CommandError(f"Only {len(questions)} distinct questions for '{slug}'; not enough to train on.")
+
+        # 以「不同的問題」切分，同一題的各種答案不會同時出現在訓練與驗證
+        random.Random(options['seed']).shuffle(questions)
+        held_out = set(questions[:max(1, int(len(questions) * options['holdout']))])
+        train_set = [example for example in examples if example[0] not in held_out]
+        holdout_set = [example for example in examples if example[0] in held_out]
+
+        params = {'ngram_max': options['ngram_max'], 'l2': options['l2'], 'epochs': options['epochs'], 'puzzle_slug': slug}
+        model = judge_classifier.train(train_set, **params)
+        model.temperature = judge_classifier.fit_temperature(model, holdout_set)
+        self.report(model, train_set, holdout_set)
+
+        # 校準後以全部資料重新訓練，溫度沿用
+        temperature = model.temperature
+        model = judge_classifier.train(examples, **params)
+        model.temperature = temperature
+
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING("Dry run: model not saved."))
+            return
+        path = options['output'] or judge_classifier.model_path(slug)
+        model.save(path)
+        self.stdout.write(self.style.SUCCESS(
+            f"Saved '{slug}' model ({len(model.vocabulary)} n-grams, temperature {temperature}, "
+            f"{os.path.getsize(path) / 1024:.1f} KiB) to {path} in {time.monotonic() - started:.2f}s."
+        ))
+
+    def report(self, model, train_set, holdout_set):
+        """Held-out accuracy, and coverage / accuracy of local answers per confidence threshold."""
+        majority = max(model.labels, key=lambda label: sum(c for _, v, c in train_set if v == label))
+        weights = np.array([count for _, _, count in holdout_set], dtype=np.float32)
+        predictions = [model.predict(canonical) for canonical, _, _ in holdout_set]
+        correct = np.array([verdict == truth for (verdict, _), (_, truth, _) in zip(predictions, holdout_set)])
+        confidence = np.array([value for _, value in predictions])
+        baseline = np.array([truth == majority for _, truth, _ in holdout_set])
+
+        self.stdout.write(
+            f"{len(train_set)} training / {len(holdout_set)} held-out examples; "
+            f"held-out accuracy {np.average(correct, weights=weights):.1%} "
+            f"(always '{majority}': {np.average(baseline, weights=weights):.1%}), temperature {model.temperature}"
+        )
+        self.stdout.write("  threshold  answered locally  accuracy of local answers")
+        for threshold in JUDGE_CLASSIFIER['CONFIDENCE_BUCKETS']:
+            local = confidence >= threshold
+            accuracy = f"{np.average(correct[local], weights=weights[local]):.1%}" if local.any() else '-'
+            self.stdout.write(f"  {threshold:<9}  {np.average(local, weights=weights):<16.1%}  {accuracy}")
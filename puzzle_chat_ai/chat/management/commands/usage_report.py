@@ -0,0 +1,110 @@
+# chat/management/commands/usage_report.py
+
+from django.core.management.base import BaseCommand
+from django.db.models import Avg, Count, Max, Sum
+
+from chat.constants import AI_MODEL_PRICES
+from chat.models import AIUsage
+from chat.services.usage import recorder
+
+GROUP_FIELDS = ['room_name', 'user_name', 'mode', 'purpose', 'model', 'status']
+
+
+def estimate_cost(model, prompt_tokens, cached_tokens, completion_tokens):
+    """USD estimate from AI_MODEL_PRICES; None for models without a price."""
+    prices = AI_MODEL_PRICES.get(model)
+    if prices is None:
+        return None
+    input_price, cached_price, output_price = prices
+    uncached = max(0, prompt_tokens - cached_tokens)
+    return (uncached * input_price + cached_tokens * cached_price + completion_tokens * output_price) / 1_000_000
+
+
+class Command(BaseCommand):
+    help = 'Summarises recorded OpenAI token usage, latency and estimated cost grouped by room, user, mode, prompt path or model.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--group_by',
+            nargs='+',
+            choices=GROUP_FIELDS,
+            default=['mode', 'purpose', 'model'],
+            help='Fields to group by (default: mode purpose model).'
+        )
+        parser.add_argument(
+            '--rooms',
+            nargs='+',
+            type=str,
+            help='Only report these rooms.'
+        )
+
+    def handle(self, *args, **options):
+        # 先寫出本行程內尚未寫入的紀錄
+        recorder.flush_sync()
+
+        group_by = list(options['group_by'])
+        # 成本需要模型價格，因此一律依模型細分後再合併
+        query_fields = group_by if 'model' in group_by else group_by + ['model']
+
+        queryset = AIUsage.objects.all()
+        if options['rooms']:
+            queryset = queryset.filter(room_name__in=options['rooms'])
+
+        rows = (
+            queryset.values(*query_fields)
+            .annotate(
+                calls=Count('id'),
+                prompt_tokens=Sum('prompt_tokens'),
+                cached_tokens=Sum('cached_tokens'),
+                completion_tokens=Sum('completion_tokens'),
+                avg_latency_ms=Avg('latency_ms'),
+                max_latency_ms=Max('latency_ms'),
+            )
+        )
+
+        groups = {}
+        for row in rows:
+            key = tuple(row[field] or '-' for field in group_by)
+            group = groups.setdefault(key, {
+                'calls': 0, 'prompt_tokens': 0, 'cached_tokens': 0, 'completion_tokens': 0,
+                'latency_total': 0.0, 'max_latency_ms': 0, 'cost': 0.0, 'unpriced': False,
+            })
+            group['calls'] += row['calls']
+            group['prompt_tokens'] += row['prompt_tokens']
+            group['cached_tokens'] += row['cached_tokens']
+            group['completion_tokens'] += row['completion_tokens']
+            group['latency_total'] += row['avg_latency_ms'] * row['calls']
+            group['max_latency_ms'] = max(group['max_latency_ms'], row['max_latency_ms'])
+            cost = estimate_cost(row['model'], row['prompt_tokens'], row['cached_tokens'], row['completion_tokens'])
+            if cost is None:
+                group['unpriced'] = True
+            else:
+                group['cost'] += cost
+
+        if not groups:
+            self.stdout.write(self.style.WARNING("No AI usage recorded."))
+            return
+
+        header = group_by + ['calls', 'prompt', 'cached', 'completion', 'avg_ms', 'max_ms', 'cost_usd']
+        lines = [header]
+        total_cost = 0.0
+        # 依成本由高到低排序，最花錢的路徑排最前面
+        for key, group in sorted(groups.items(), key=lambda item: item[1]['cost'], reverse=True):
+            total_cost += group['cost']
+            lines.append(list(key) + [
+                group['calls'],
+                group['prompt_tokens'],
+                group['cached_tokens'],
+                group['completion_tokens'],
+                round(group['latency_total'] / group['calls']),
+                group['max_latency_ms'],
+                f"{group['cost']:.4f}" + ('*' if group['unpriced'] else ''),
+            ])
+
+        widths = [max(len(str(line[index])) for line in lines) for index in range(len(header))]
+        for line in lines:
+            self.stdout.write('  '.join(str(value).ljust(width) for value, width in zip(line, widths)))
+
+        self.stdout.write(self.style.SUCCESS(f"\nEstimated total cost: ${total_cost:.4f}"))
+        if any(group['unpriced'] for group in groups.values()):
+            self.stdout.write("* includes models without a price in AI_MODEL_PRICES (not counted).")
@@ -0,0 +1,227 @@
+# chat/management/commands/warm_judge_cache.py
+
+import asyncio
+import csv
+import json
+import time
+from collections import Counter, defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.constants import AI_TEMPERATURES, JUDGE_VERDICTS, OPENAI_CONFIG
+from chat.models import AIChatMessage
+from chat.management.commands.import_data import find_export_files, open_csv, read_header, detect_model
+from chat.services import usage
+from chat.services.ai_service import ai_service
+from chat.services.puzzle_catalog import puzzle_catalog
+from chat.services.verdict_cache import canonicalize, verdict_memo
+
+DEFAULT_TOP_K = 500
+# 問過一次或裁判答案分歧的問題不預載：錯的預載答案會一直被沿用
+DEFAULT_MIN_COUNT = 2
+DEFAULT_MIN_SHARE = 0.75
+JUDGE_MODEL = 'gpt-4.1'
+
+
+class VerdictHistoryMixin:
+    """Reads historical judge verdicts from the database and export CSVs, grouped by puzzle."""
+
+    def collect_verdicts(self, source, paths):
+        """
+        Returns (answers, examples): answers[slug][canonical] is a Counter of
+        verdicts, examples[slug][canonical] one original wording.
+        """
+        # 房間依指定的題目分開統計；沒有指定的房間屬於預設題目
+        self.assignments = puzzle_catalog.assignments()
+        answers = defaultdict(lambda: defaultdict(Counter))
+        examples = defaultdict(dict)
+        if source in ('db', 'both'):
+            self.count_db(answers, examples)
+        if source in ('csv', 'both'):
+            self.count_csv(answers, examples, paths)
+        return answers, examples
+
+    def puzzle_of(self, room_name):
+        return self.assignments.get(room_name, puzzle_catalog.default_slug)
+
+    def count_db(self, answers, examples):
+        rows = (
+            AIChatMessage.objects.filter(ai_message__in=JUDGE_VERDICTS)
+            .values_list('room_name', 'message', 'ai_message')
+            .iterator(chunk_size=2000)
+        )
+        count = 0
+        for room_name, message, answer in rows:
+            canonical = canonicalize(message)
+            if canonical:
+                slug = self.puzzle_of(room_name)
+                answers[slug][canonical][answer] += 1
+                examples[slug].setdefault(canonical, message)
+                count += 1
+        self.stdout.write(f"  - {count} verdicts from the database")
+
+    def count_csv(self, answers, examples, paths):
+        seen = set()
+        for file_path in find_export_files(paths):
+            if detect_model(read_header(file_path)) is not AIChatMessage:
+                continue
+            count = 0
+            with open_csv(file_path) as csvfile:
+                for row in csv.DictReader(csvfile):
+                    # 同一份紀錄可能出現在多個匯出檔中
+                    row_key = (row.get('room_name'), row.get('id'))
+                    if row_key in seen:
+                        continue
+                    seen.add(row_key)
+                    answer = row.get('ai_message')
+                    canonical = canonicalize(row.get('message'))
+                    if canonical and answer in JUDGE_VERDICTS:
+                        slug = self.puzzle_of(row.get('room_name'))
+                        answers[slug][canonical][answer] += 1
+                        examples[slug].setdefault(canonical, row['message'])
+                        count += 1
+            self.stdout.write(f"  - {count} verdicts from '{file_path}'")
+
+
+class Command(VerdictHistoryMixin, BaseCommand):
+    help = ('Preloads the verdict cache with the most frequent historical judge questions and their majority '
+            'verdicts, per puzzle, optionally re-checking each one with the judge first.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--source',
+            choices=['db', 'csv', 'both'],
+            default='both',
+            help='Read history from the database, from export CSV files, or both (default: both).'
+        )
+        parser.add_argument(
+            '--paths',
+            nargs='+',
+            type=str,
+            default=['log'],
+            help='Export files or directories to scan for CSV history (default: log).'
+        )
+        parser.add_argument(
+            '--puzzle',
+            nargs='+',
+            type=str,
+            help='Puzzle slugs to warm (default: every puzzle in the catalog).'
+        )
+        parser.add_argument('--top_k', type=int, default=DEFAULT_TOP_K, help='How many questions to preload per puzzle.')
+        parser.add_argument(
+            '--min_count',
+            type=int,
+            default=DEFAULT_MIN_COUNT,
+            help=f'Skip questions asked fewer times than this (default: {DEFAULT_MIN_COUNT}).'
+        )
+        parser.add_argument(
+            '--min_share',
+            type=float,
+            default=DEFAULT_MIN_SHARE,
+            help=f'Skip questions whose majority verdict has a smaller share of the answers (default: {DEFAULT_MIN_SHARE}).'
+        )
+        parser.add_argument(
+            '--revalidate',
+            action='store_true',
+            help='Ask the judge again and only keep questions where it agrees with the majority verdict.'
+        )
+        parser.add_argument('--concurrency', type=int, default=4, help='Parallel judge calls with --revalidate.')
+        parser.add_argument('--rate', type=float, default=2.0, help='Judge calls per second with --revalidate.')
+        parser.add_argument('--dry_run', action='store_true', help='Show what would be loaded without writing the cache.')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        known = puzzle_catalog.slugs()
+        slugs = options['puzzle'] or known
+        unknown = sorted(set(slugs) - set(known))
+        if unknown:
+            raise CommandError(f"Unknown puzzle(s): {', '.join(unknown)}")
+        # 每題保留一個原始問法，重新驗證時送給裁判
+        answers, examples = self.collect_verdicts(options['source'], options['paths'])
+
+        for slug in slugs:
+            self.warm_puzzle(slug, answers[slug], examples[slug], options)
+        self.stdout.write(f"Done in {time.monotonic() - started:.2f}s.")
+
+    def warm_puzzle(self, slug, answers, examples, options):
+        if not answers:
+            self.stdout.write(self.style.WARNING(f"[{slug}] No historical judge verdicts found."))
+            return
+
+        # 依被問次數排序，取前 K 題；答案取多數決，且多數答案要佔明顯多數
+        ranked = sorted(answers.items(), key=lambda item: sum(item[1].values()), reverse=True)
+        selected, split = {}, 0
+        for canonical, counts in ranked[:options['top_k']]:
+            asked = sum(counts.values())
+            if asked < options['min_count']:
+                continue
+            answer, votes = counts.most_common(1)[0]
+            if votes / asked < options['min_share']:
+                split += 1
+                continue
+            selected[canonical] = answer
+        covered = sum(sum(answers[canonical].values()) for canonical in selected)
+        total = sum(sum(counts.values()) for counts in answers.values())
+        self.stdout.write(
+            f"[{slug}] {len(answers)} distinct questions, {total} asked in total; "
+            f"top {len(selected)} cover {covered / total:.1%} of them ({split} skipped for split verdicts)."
+        )
+
+        if options['revalidate']:
+            selected = asyncio.run(self.revalidate(
+                puzzle_catalog.get(slug), selected, examples, options['concurrency'], options['rate']
+            ))
+
+        if options['dry_run']:
+            for canonical, answer in list(selected.items())[:20]:
+                self.stdout.write(f"  {answer}\t{canonical}")
+            self.stdout.write(self.style.WARNING(f"[{slug}] Dry run: {len(selected)} verdicts not written."))
+            return
+
+        loaded = verdict_memo.preload(slug, selected)
+        self.stdout.write(self.style.SUCCESS(f"[{slug}] Preloaded {loaded} verdicts into the verdict cache."))
+
+    async def revalidate(self, puzzle, selected, examples, concurrency, rate):
+        """Re-ask the judge with bounded concurrency and a start rate of `rate` calls per second."""
+        if concurrency < 1 or rate <= 0:
+            raise CommandError('--concurrency and --rate must be positive.')
+        semaphore = asyncio.Semaphore(concurrency)
+        interval = 1 / rate
+        loop = asyncio.get_running_loop()
+        next_start = loop.time()
+        lock = asyncio.Lock()
+        kept, disagreed, failed = {}, 0, 0
+
+        async def check(canonical, answer):
+            nonlocal next_start, disagreed, failed
+            async with semaphore:
+                async with lock:
+                    delay = next_start - loop.time()
+                    next_start = max(next_start, loop.time()) + interval
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                with usage.attribute(purpose='judge_warmup'):
+                    response = await ai_service.get_ai_response(
+                        puzzle.prompts['judge'].render(user_question=examples[canonical]),
+                        model=JUDGE_MODEL,
+                        temperature=AI_TEMPERATURES['PRECISE'],
+                        use_cache=False,
+                        response_format=OPENAI_CONFIG['RESPONSE_FORMAT_JSON']
+                    )
+            try:
+                verdict = json.loads(response).get('answer') if response else None
+            except (json.JSONDecodeError, AttributeError):
+                verdict = None
+            if verdict is None:
+                failed += 1
+            elif verdict == answer:
+                kept[canonical] = answer
+            else:
+                disagreed += 1
+
+        await asyncio.gather(*(check(canonical, answer) for canonical, answer in selected.items()))
+        await usage.recorder.flush()
+        self.stdout.write(
+            f"Re-validated {len(selected)} questions: {len(kept)} agreed, {disagreed} disagreed, {failed} failed."
+        )
+        return kept
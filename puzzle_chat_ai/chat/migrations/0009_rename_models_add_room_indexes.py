@@ -0,0 +1,41 @@
+# Generated by Django 5.1.5 on 2026-10-19 05:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_ai_chatmessage_suggestion_response'),
+    ]
+
+    operations = [
+        migrations.RenameModel(
+            old_name='ai_ChatMessage',
+            new_name='AIChatMessage',
+        ),
+        migrations.RenameModel(
+            old_name='ai_ChatMessage_summary',
+            new_name='AIChatMessageSummary',
+        ),
+        migrations.RenameModel(
+            old_name='chatMessage_summary',
+            new_name='ChatMessageSummary',
+        ),
+        migrations.AddIndex(
+            model_name='aichatmessage',
+            index=models.Index(fields=['room_name', 'id'], name='ai_msg_room_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='aichatmessagesummary',
+            index=models.Index(fields=['room_name', 'id'], name='ai_msg_sum_room_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['room_name', 'id'], name='chat_msg_room_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessagesummary',
+            index=models.Index(fields=['room_name', 'id'], name='chat_msg_sum_room_id_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.5 on 2026-10-19 06:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_rename_models_add_room_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AIUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('timestamp', models.DateTimeField(auto_now_add=True)),
+                ('room_name', models.CharField(blank=True, default='', max_length=255)),
+                ('user_name', models.CharField(blank=True, default='', max_length=100)),
+                ('mode', models.CharField(blank=True, default='', max_length=1)),
+                ('purpose', models.CharField(blank=True, default='', max_length=32)),
+                ('model', models.CharField(max_length=64)),
+                ('status', models.CharField(max_length=16)),
+                ('prompt_tokens', models.PositiveIntegerField(default=0)),
+                ('completion_tokens', models.PositiveIntegerField(default=0)),
+                ('cached_tokens', models.PositiveIntegerField(default=0)),
+                ('latency_ms', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['room_name', 'id'], name='ai_usage_room_id_idx')],
+            },
+        ),
+    ]
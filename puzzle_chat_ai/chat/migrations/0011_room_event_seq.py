@@ -0,0 +1,31 @@
+# Generated by Django 5.1.5 on 2026-10-19 06:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_aiusage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aichatmessage',
+            name='seq',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='seq',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='aichatmessage',
+            index=models.Index(fields=['room_name', 'seq'], name='ai_msg_room_seq_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['room_name', 'seq'], name='chat_msg_room_seq_idx'),
+        ),
+    ]
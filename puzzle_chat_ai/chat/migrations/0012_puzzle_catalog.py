@@ -0,0 +1,35 @@
+# Generated by Django 5.1.5 on 2026-10-19 06:29
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_room_event_seq'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Puzzle',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slug', models.SlugField(max_length=64, unique=True)),
+                ('title', models.CharField(blank=True, default='', max_length=200)),
+                ('question', models.TextField()),
+                ('answer', models.TextField()),
+                ('solution_keywords', models.JSONField(blank=True, default=list)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PuzzleAssignment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room_name', models.CharField(max_length=255, unique=True)),
+                ('assigned_at', models.DateTimeField(auto_now_add=True)),
+                ('puzzle', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='assignments', to='chat.puzzle')),
+            ],
+        ),
+    ]
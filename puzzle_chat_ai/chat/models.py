@@ -14,6 +14,15 @@ class ChatMessage(models.Model):
     reply_author = models.CharField(max_length=100, blank=True, null=True, default="")
     timestamp = models.DateTimeField(auto_now_add=True)
     liked_by = models.JSONField(default=list, blank=True)
+    # 房間內的事件序號，重連時依此補送漏掉的訊息
+    seq = models.BigIntegerField(null=True, blank=True)
+
+    class Meta:
+        # 依房間分批處理 (匯出、刪除) 時可以只走索引
+        indexes = [
+            models.Index(fields=['room_name', 'id'], name='chat_msg_room_id_idx'),
+            models.Index(fields=['room_name', 'seq'], name='chat_msg_room_seq_idx'),
+        ]
 
 
 
@@ -22,6 +31,11 @@ class ChatMessageSummary(models.Model):
     summary_idx=models.IntegerField(default=0)
     summary_message=models.TextField(default="")
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['room_name', 'id'], name='chat_msg_sum_room_id_idx'),
+        ]
+
 
 class AIChatMessage(models.Model):
     room_name = models.CharField(max_length=255, default="default_room")
@@ -42,14 +56,70 @@ class AIChatMessage(models.Model):
         blank=True
     )
     # ⭐ END: NEW FIELD
+    seq = models.BigIntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['room_name', 'id'], name='ai_msg_room_id_idx'),
+            models.Index(fields=['room_name', 'seq'], name='ai_msg_room_seq_idx'),
+        ]
 
 class AIChatMessageSummary(models.Model):
     room_name = models.CharField(max_length=100, default="default_room") # 新增
     user_name = models.CharField(max_length=100)
     summary = models.TextField(default="")
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['room_name', 'id'], name='ai_msg_sum_room_id_idx'),
+        ]
+
     
     
+class AIUsage(models.Model):
+    # 每一次 OpenAI 呼叫的 token 用量，用於估算配額與成本
+    timestamp = models.DateTimeField(auto_now_add=True)
+    room_name = models.CharField(max_length=255, blank=True, default="")
+    user_name = models.CharField(max_length=100, blank=True, default="")
+    mode = models.CharField(max_length=1, blank=True, default="")
+    purpose = models.CharField(max_length=32, blank=True, default="")
+    model = models.CharField(max_length=64)
+    status = models.CharField(max_length=16)
+    prompt_tokens = models.PositiveIntegerField(default=0)
+    completion_tokens = models.PositiveIntegerField(default=0)
+    cached_tokens = models.PositiveIntegerField(default=0)
+    latency_ms = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['room_name', 'id'], name='ai_usage_room_id_idx'),
+        ]
+
+
+class Puzzle(models.Model):
+    # 謎題目錄：每個房間可指定不同的題目 (見 PuzzleAssignment)
+    slug = models.SlugField(max_length=64, unique=True)
+    title = models.CharField(max_length=200, blank=True, default="")
+    question = models.TextField()
+    answer = models.TextField()
+    # 謎底關鍵詞；留空時由謎底自動產生，用來預先篩選需要檢查答案的訊息
+    solution_keywords = models.JSONField(default=list, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.slug
+
+
+class PuzzleAssignment(models.Model):
+    # 房間使用的題目；沒有指定的房間使用預設題目
+    room_name = models.CharField(max_length=255, unique=True)
+    puzzle = models.ForeignKey(Puzzle, on_delete=models.PROTECT, related_name='assignments')
+    assigned_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.room_name} -> {self.puzzle}"
+
+
 class ChatUser(models.Model):
     user_name = models.CharField(max_length=100)
 
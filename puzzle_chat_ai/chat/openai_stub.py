@@ -0,0 +1,224 @@
+"""
+Local stand-in for the OpenAI chat completions API.
+
+Serves /v1/chat/completions (plain JSON and SSE streaming) with configurable
+latency and fault injection, so the AI path can be benchmarked and tested
+offline. Point the app at it with OPENAI_API_URL.
+"""
+
+import asyncio
+import hashlib
+import json
+import random
+import time
+import uuid
+from collections import Counter
+
+from aiohttp import web
+
+
+# 裁判回答的分佈，大致依照 log/ 中實際的比例
+DEFAULT_VERDICT_WEIGHTS = {
+    '否': 0.38,
+    '與此無關': 0.28,
+    '是': 0.19,
+    '是也不是': 0.15,
+}
+
+# 玩家的話同時包含這些詞時視為猜中謎底
+DEFAULT_SOLVE_KEYWORDS = ['簽名', '收藏']
+
+DEFAULT_STUB_CONFIG = {
+    'latency_distribution': 'fixed',  # fixed / uniform / normal / lognormal / exponential
+    'latency_ms': 300.0,
+    'latency_jitter_ms': 0.0,
+    'rate_429': 0.0,
+    'rate_500': 0.0,
+    'rate_timeout': 0.0,
+    'timeout_seconds': 60.0,
+    'stream_chunk_ms': 20.0,
+    'stream_chunk_chars': 4,
+    'verdict_weights': DEFAULT_VERDICT_WEIGHTS,
+    'solve_keywords': DEFAULT_SOLVE_KEYWORDS,
+    'seed': None,
+}
+
+
+def sample_latency(config, rng):
+    """Seconds to wait before answering, drawn from the configured distribution."""
+    mean = config['latency_ms'] / 1000
+    jitter = config['latency_jitter_ms'] / 1000
+    distribution = config['latency_distribution']
+    if distribution == 'uniform':
+        value = rng.uniform(mean - jitter, mean + jitter)
+    elif distribution == 'normal':
+        value = rng.gauss(mean, jitter)
+    elif distribution == 'lognormal':
+        # latency_ms 是中位數，sigma = jitter / latency，產生長尾
+        value = mean * rng.lognormvariate(0, jitter / mean) if jitter and mean else mean
+    elif distribution == 'exponential':
+        value = rng.expovariate(1 / mean) if mean else 0
+    else:
+        value = mean
+    return max(0.0, value)
+
+
+def last_user_content(messages):
+    for message in reversed(messages):
+        if message.get('role') == 'user':
+            return str(message.get('content', ''))
+    return ''
+
+
+def system_content(messages):
+    return '\n'.join(str(m.get('content', '')) for m in messages if m.get('role') == 'system')
+
+
+def pick_verdict(question, weights):
+    """Same question, same verdict: the choice is seeded by a hash of the question."""
+    digest = int(hashlib.sha256(question.encode('utf-8')).hexdigest()[:8], 16)
+    point = (digest / 0xFFFFFFFF) * sum(weights.values())
+    for verdict, weight in weights.items():
+        point -= weight
+        if point <= 0:
+            return verdict
+    return next(reversed(weights))
+
+
+def canned_content(body, config):
+    """Build a reply in the shape each caller expects."""
+    messages = body.get('messages') or []
+    question = last_user_content(messages)
+    system_prompt = system_content(messages)
+    solved = all(keyword in question for keyword in config['solve_keywords'])
+    wants_json = (body.get('response_format') or {}).get('type') == 'json_object'
+
+    if wants_json and 'is_correct' in system_prompt:
+        # AIService.check_puzzle_solution
+        return json.dumps({'is_correct': solved, 'explanation': 'stub'}, ensure_ascii=False)
+    if wants_json:
+        # evaluate_user_guess：reasoning / evaluation / answer
+        if solved:
+            return json.dumps({'reasoning': 'stub', 'evaluation': 'solved', 'answer': '恭喜你猜中了！'}, ensure_ascii=False)
+        verdict = pick_verdict(question, config['verdict_weights'])
+        return json.dumps({'reasoning': 'stub', 'evaluation': 'query', 'answer': verdict}, ensure_ascii=False)
+    # 建議訊息與其他自由文字
+    return f"我剛才確認到一個線索：{question[:40]}。關於這點你有什麼想法嗎？"
+
+
+def approximate_usage(body, content):
+    """Rough token counts (about two characters per token for mixed Chinese/English)."""
+    prompt_chars = sum(len(str(m.get('content', ''))) for m in body.get('messages') or [])
+    prompt_tokens = max(1, prompt_chars // 2)
+    completion_tokens = max(1, len(content) // 2)
+    return {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': prompt_tokens + completion_tokens,
+        'prompt_tokens_details': {'cached_tokens': 0},
+    }
+
+
+def error_response(status, message, error_type, headers=None):
+    return web.json_response(
+        {'error': {'message': message, 'type': error_type, 'code': None}},
+        status=status,
+        headers=headers,
+    )
+
+
+async def chat_completions(request):
+    app = request.app
+    config = app['config']
+    rng = app['rng']
+    stats = app['stats']
+    stats['requests'] += 1
+
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        stats['400'] += 1
+        return error_response(400, 'Invalid JSON body', 'invalid_request_error')
+
+    await asyncio.sleep(sample_latency(config, rng))
+
+    roll = rng.random()
+    if roll < config['rate_429']:
+        stats['429'] += 1
+        return error_response(429, 'Rate limit reached (stub)', 'rate_limit_exceeded', headers={'Retry-After': '1'})
+    roll -= config['rate_429']
+    if roll < config['rate_500']:
+        stats['500'] += 1
+        return error_response(500, 'Internal server error (stub)', 'server_error')
+    roll -= config['rate_500']
+    if roll < config['rate_timeout']:
+        # 不回應，讓客戶端自己的逾時機制觸發
+        stats['timeout'] += 1
+        await asyncio.sleep(config['timeout_seconds'])
+        return error_response(504, 'Upstream timeout (stub)', 'timeout')
+
+    content = canned_content(body, config)
+    model = body.get('model', 'stub')
+    completion_id = f"chatcmpl-stub-{uuid.uuid4().hex[:12]}"
+    created = int(time.time())
+
+    if body.get('stream'):
+        stats['stream'] += 1
+        return await stream_completion(request, config, completion_id, created, model, content)
+
+    stats['200'] += 1
+    return web.json_response({
+        'id': completion_id,
+        'object': 'chat.completion',
+        'created': created,
+        'model': model,
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': content},
+            'finish_reason': 'stop',
+        }],
+        'usage': approximate_usage(body, content),
+    })
+
+
+async def stream_completion(request, config, completion_id, created, model, content):
+    """Server-sent events in the chat.completion.chunk format, ending with [DONE]."""
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+    await response.prepare(request)
+
+    def chunk(delta, finish_reason=None):
+        payload = {
+            'id': completion_id,
+            'object': 'chat.completion.chunk',
+            'created': created,
+            'model': model,
+            'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+        }
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode('utf-8')
+
+    size = max(1, int(config['stream_chunk_chars']))
+    await response.write(chunk({'role': 'assistant', 'content': ''}))
+    for start in range(0, len(content), size):
+        await asyncio.sleep(config['stream_chunk_ms'] / 1000)
+        await response.write(chunk({'content': content[start:start + size]}))
+    await response.write(chunk({}, 'stop'))
+    await response.write(b"data: [DONE]\n\n")
+    await response.write_eof()
+    return response
+
+
+async def stub_stats(request):
+    return web.json_response(dict(request.app['stats']))
+
+
+def create_app(**overrides):
+    """aiohttp application for the stub; keyword arguments override DEFAULT_STUB_CONFIG."""
+    config = {**DEFAULT_STUB_CONFIG, **{k: v for k, v in overrides.items() if v is not None}}
+    app = web.Application()
+    app['config'] = config
+    app['rng'] = random.Random(config['seed'])
+    app['stats'] = Counter()
+    app.router.add_post('/v1/chat/completions', chat_completions)
+    app.router.add_post('/chat/completions', chat_completions)
+    app.router.add_get('/stats', stub_stats)
+    return app
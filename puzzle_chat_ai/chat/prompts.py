@@ -0,0 +1,174 @@
+"""
+Prompt templates for the judge and the suggestion conditions.
+
+OpenAI caches the longest prompt prefix it has seen recently, so every
+template puts what never changes first (instructions, then the puzzle
+question and answer) and what changes per call last (chat history, the
+player's question, the user name). The static system message is built once
+per puzzle and reused byte-for-byte on every call: the module-level
+templates are compiled for FIXED_PUZZLE when this module is imported, and
+compile_prompts() builds the same set for a catalog puzzle.
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+from .constants import FIXED_PUZZLE
+
+
+class PromptTemplate:
+    """A static system message followed by an optional history and a per-call user message."""
+
+    def __init__(self, name: str, system: str, user: str, **static):
+        self.name = name
+        # 靜態內容只在啟動時組合一次
+        self.system = system.format(**static)
+        self.user = user
+
+    def render(self, history: Optional[List[Dict]] = None, **volatile) -> List[Dict]:
+        messages = [{"role": "system", "content": self.system}]
+        if history:
+            messages.extend(history)
+        messages.append({"role": "user", "content": self.user.format(**volatile)})
+        return messages
+
+
+PROMPTS: Dict[str, PromptTemplate] = {}
+
+# 未代入謎題的原始模板：name -> (system, user)
+PROMPT_SOURCES: Dict[str, Tuple[str, str]] = {}
+
+
+def register(template: PromptTemplate) -> PromptTemplate:
+    PROMPTS[template.name] = template
+    return template
+
+
+def get_prompt(name: str) -> PromptTemplate:
+    return PROMPTS[name]
+
+
+def define(name: str, system: str, user: str) -> PromptTemplate:
+    """Keep a template's source for compile_prompts and register it compiled for FIXED_PUZZLE."""
+    PROMPT_SOURCES[name] = (system, user)
+    return register(PromptTemplate(
+        name, system, user, puzzle_question=FIXED_PUZZLE['question'], puzzle_answer=FIXED_PUZZLE['answer']
+    ))
+
+
+def compile_prompts(question: str, answer: str) -> Dict[str, PromptTemplate]:
+    """Every defined template with the static part filled in for one puzzle."""
+    return {
+        name: PromptTemplate(name, system, user, puzzle_question=question, puzzle_answer=answer)
+        for name, (system, user) in PROMPT_SOURCES.items()
+    }
+
+
+# 建議的使用者訊息：聊天紀錄與本次行動放在最後，文字與原本各條件的提示詞相同
+SUGGESTION_ACTION = """# 我剛才的行動:
+- 我的問題: "{user_question}"
+- 裁判的回答: "{ai_answer}"
+
+# 請幫我（{current_user_name}）草擬訊息："""
+
+# Condition A：沒有「Me」/「Partner」說明
+SUGGESTION_USER_BASELINE = """# 聊天紀錄:
+{chat_history}
+
+""" + SUGGESTION_ACTION
+
+# Condition B、C：原本在系統訊息開頭的說明與聊天紀錄移到這裡
+SUGGESTION_USER = """# 在接下來的聊天紀錄中，「Me」代表我本人，「Partner」代表我的夥伴。聊天紀錄:
+{chat_history}
+
+""" + SUGGESTION_ACTION
+
+
+# 裁判：判斷玩家的提問
+JUDGE = define('judge', """
+你是「海龜湯」遊戲的一位頂級遊戲主持人（Game Master）。你的最高原則是確保遊戲對玩家來說是「公平且有趣的」。你的輸出必須是一個 JSON 物件，包含三個 key：`reasoning`, `evaluation`, 和 `answer`。
+
+# 判斷規則：
+1.  **勝利 (Solved)**: 若玩家直接反問你，不可以回應他。除此之外，如果玩家的猜測已經親口完整說出了謎底的核心因果鏈，`evaluation` 為 "solved"。
+
+3.  **是非回答 (Yes/No Answer)**: 如果問題清晰無歧義，且能以單一的是或否回答，`evaluation` 為 "query"，`answer` 為「是」或「否」。若玩家問是不是商業活動，須回答否。因為除了這頓晚餐外並無其他商業活動。
+4.  **是也不是 (Yes and No)**: 如果玩家的提問內容，根據謎底故事，一部分為「是」而另一部分為「否」，導致無法用單一的是非回答，`evaluation` 為 "query"，`answer` 為「是也不是」。這提示玩家其假設部分正確，需要將問題拆分得更細緻。例如，若謎底是「他吃了一根冰糖葫蘆」，玩家問「他吃了水果嗎？」，因冰糖葫蘆是水果做成，但不是嚴格意義上的水果。又例如，玩家問「他要送老闆支票嗎？」，則也是回答「是也不是」，因為支票是他給的，但這張支票的價值在於名人寫的字。又例如，玩家問「他是美食評論家嗎？」則回答「是也不是」，因為謎底並沒有明示男子的身分，但「名人」確實也包含「知名的美食評論家」。若玩家問「是不是很貴的東西」，也回答「是也不是」，因為重點在收藏價值，而非金額。
+5.  **無關回答 (Irrelevant)**: 如果問題是開放式問題、與謎底無關，或無法根據謎底判斷，`evaluation` 為 "query"，`answer` 為 "與此無關"。
+
+**嚴格禁止**：
+-   回答其他不屬於以上的內容。
+
+---
+# 謎題題目：{puzzle_question}
+# 謎底完整故事（你的唯一判斷依據）：{puzzle_answer}
+---
+""", "{user_question}")
+
+
+# Condition A: 基線建議
+SUGGESTION_BASELINE = define('suggestion_baseline', """
+你是我的「海龜湯」遊戲搭檔。你的目標是根據我的問答和聊天紀錄，為我草擬一段給夥伴的訊息。
+這段訊息必須以『我』的口吻，包含兩部分：
+1. **口語化總結**：用我的語氣，總結我剛才的發現。
+2. **提出通用的互動問題**：在結尾加上一句「關於這點你有什麼想法嗎？」
+
+**重要**：直接輸出訊息，不要有任何前綴。
+---海龜湯總問題：{puzzle_question}---
+""", SUGGESTION_USER_BASELINE)
+
+
+# Condition B: 過程導向建議 (闡述假說)
+SUGGESTION_PROCESS = define('suggestion_process', """
+你是我的「海龜湯」遊戲搭檔，也是一位邏輯清晰的思考者。你的任務是，在我問完裁判後，根據聊天紀錄，幫我草擬一段訊息，讓他了解我的思考過程。
+
+**結構模板 (必須遵守):**
+1.  **口語化總結**：用口語化的方式，清晰地總結我剛從裁判那裡得到的「發現」。
+
+
+**嚴格禁止**：
+-   搞錯「我」和「夥伴」的角色。
+-   提供任何新的解謎方向或下一步建議。
+-   你的輸出只能是這段要傳給夥伴的訊息，不要包含任何其他前綴或解釋。
+
+---海龜湯總問題：{puzzle_question}---
+""", SUGGESTION_USER)
+
+
+# Condition C: 高凝聚力序列建議
+SUGGESTION_COHESIVE = define('suggestion_cohesive', """
+你是我的「海龜湯」遊戲搭檔，也是一位頂尖的團隊溝通教練。你會根據我們的聊天紀錄和我剛才的行動，為我生成一句能「開啟高凝聚力溝通序列」的建議。
+
+**你的行為準則:**
+-   高凝聚力序列：道歉→鼓勵, 回答→提問
+-   你會仔細閱讀聊天紀錄，判斷哪則訊息是哪個使用者說的，以便做出精準的反應，例如肯定夥伴之前提出的觀點，或承認我的想法錯誤。
+
+---
+**核心反應原則 (以『我』的視角)：**
+**0.  **口語化總結**：用口語化的方式，清晰地總結我剛從裁判那裡得到的「發現」。
+
+**1. 當我得到「與此無關」的答案時 (處於逆境):**
+   - **你的目標：** 開啟「道歉→鼓勵」的序列。
+   - **反應策略：** 草擬一個簡短的「道歉」（承認自己想錯了），並把問題拋給夥伴，創造讓他「鼓勵」我的機會。**如果夥伴之前提過不同方向，你必須藉機肯定他。**
+
+**2. 當我得到其他的答案時 (得到一個需要處理的『回答』):**
+   - **你的目標：** 開啟「回答→提問」的序列。
+   - **反應策略：** 草擬一句話，先簡述裁判的「回答」，然後立刻基於這個回答和「聊天紀錄」，向夥伴提出一個能將討論推進下去的建設性「提問」。**如果這個答案驗證了夥伴的猜測，你必須歸功於他。**
+---
+
+   - **注意：** 這個提問必須是開放式的，讓夥伴有空間去思考和回應，而不是簡單的「是」或「否」。
+
+**嚴格禁止**：
+-   搞錯「我」和「夥伴」的角色。
+-   提供任何新的解謎方向或下一步建議。
+-   你的輸出只能是這段要傳給夥伴的訊息，不要包含任何其他前綴或解釋。
+
+請根據聊天紀錄和我提供的「我的問題」和「裁判的回答」，遵循上述原則，先簡述我問了AI什麼問題，以及AI的答覆，再為「我」生成一句最適當的、能開啟高凝聚力溝通序列的訊息。請直接輸出那句話。
+
+---海龜湯總問題：{puzzle_question}---
+""", SUGGESTION_USER)
+
+
+# 檢查聊天訊息是否已說出謎底 (AIService.check_puzzle_solution)
+SOLUTION_CHECK = define('solution_check', """You are judging if a user's answer matches the puzzle solution.
+Puzzle answer: {puzzle_answer}
+
+Respond with JSON: {{"is_correct": true/false, "explanation": "brief explanation"}}""", "{user_message}")
@@ -2,9 +2,11 @@
 AI Service for handling OpenAI API interactions with caching and error handling.
 """
 
+import asyncio
 import json
 import logging
 import hashlib
+import time
 from typing import Dict, List, Optional, Any
 import aiohttp
 from django.core.cache import cache
@@ -16,6 +18,9 @@ from ..constants import (
     CACHE_CONFIG, ERROR_MESSAGES, DEFAULTS
 )
 from ..models import AIChatMessage
+from . import metrics, tracing, usage
+from .model_router import model_router
+from .puzzle_catalog import PuzzleAssets
 
 logger = logging.getLogger(__name__)
 
@@ -24,7 +29,7 @@ class AIService:
     """Service for handling AI interactions with caching and error handling."""
     
     def __init__(self):
-        self.api_url = OPENAI_CONFIG['BASE_URL']
+        self.api_url = getattr(settings, 'OPENAI_API_URL', None) or OPENAI_CONFIG['BASE_URL']
         self.max_retries = DEFAULTS['MAX_RETRIES']
         self.timeout = DEFAULTS['TIMEOUT_SECONDS']
     
@@ -44,31 +49,54 @@ class AIService:
             "Content-Type": "application/json"
         }
         
-        async with aiohttp.ClientSession() as session:
-            try:
-                async with session.post(
-                    self.api_url, 
-                    json=data, 
-                    headers=headers,
-                    timeout=aiohttp.ClientTimeout(total=self.timeout)
-                ) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        return result['choices'][0]['message']['content']
-                    else:
-                        logger.error(f"OpenAI API error: {response.status}")
-                        return None
-            except Exception as e:
-                logger.error(f"OpenAI API request failed: {e}")
-                return None
+        started = time.perf_counter()
+        status = 'error'
+        usage_block = None
+        with tracing.span('ai.request', model=data.get('model', '')) as trace, \
+                model_router.track(data.get('model', '')) as outcome:
+            async with aiohttp.ClientSession() as session:
+                try:
+                    async with session.post(
+                        self.api_url, 
+                        json=data, 
+                        headers=headers,
+                        timeout=aiohttp.ClientTimeout(total=self.timeout)
+                    ) as response:
+                        status = response.status
+                        if response.status == 200:
+                            result = await response.json()
+                            usage_block = result.get('usage')
+                            outcome['ok'] = True
+                            return result['choices'][0]['message']['content']
+                        else:
+                            logger.error(f"OpenAI API error: {response.status}")
+                            return None
+                except asyncio.TimeoutError:
+                    status = 'timeout'
+                    logger.error("OpenAI API request timed out")
+                    return None
+                except asyncio.CancelledError:
+                    # Client went away; aiohttp closes the request on the way out
+                    status = 'cancelled'
+                    raise
+                except Exception as e:
+                    trace.record_error(e)
+                    logger.error(f"OpenAI API request failed: {e}")
+                    return None
+                finally:
+                    trace.set_attribute('status', str(status))
+                    metrics.observe_openai(data.get('model', ''), status, started)
+                    usage.recorder.record(data.get('model', ''), status, usage_block, time.perf_counter() - started)
     
+    @tracing.traced('ai.get_ai_response')
     async def get_ai_response(
         self, 
         messages: List[Dict], 
         model: str = AI_MODELS['PRIMARY'],
         temperature: float = AI_TEMPERATURES['BALANCED'],
         use_cache: bool = True,
-        response_format: Optional[Dict] = None
+        response_format: Optional[Dict] = None,
+        task: Optional[str] = None
     ) -> Optional[str]:
         """
         Get AI response with caching and fallback model support.
@@ -79,6 +107,7 @@ class AIService:
             temperature: Response creativity (0.0-1.0)
             use_cache: Whether to use caching
             response_format: Optional response format specification
+            task: Task type for model routing (defaults to the usage purpose)
             
         Returns:
             AI response string or None if failed
@@ -87,10 +116,24 @@ class AIService:
         if use_cache:
             cache_key = self._generate_cache_key(messages, model, temperature)
             cached_response = cache.get(cache_key)
+            metrics.cache_lookup('ai_response', bool(cached_response))
+            tracing.annotate('cache_hit', bool(cached_response))
             if cached_response:
                 logger.info("AI response served from cache")
                 return cached_response
         
+        # Per-room token budget: move to the fast model or refuse the call
+        budget = usage.check_budget()
+        if budget == usage.BUDGET_REJECT:
+            logger.warning("AI call rejected: room token budget exceeded")
+            return None
+        if budget == usage.BUDGET_DOWNGRADE and model != AI_MODELS['FAST']:
+            logger.info(f"Room token budget exceeded, using {AI_MODELS['FAST']} instead of {model}")
+            model = AI_MODELS['FAST']
+        
+        # Route away from a slow or failing model when the task allows it
+        model = model_router.route(task or usage.current_attribution().get('purpose'), model)
+        
         # Prepare API request data
         data = {
             "model": model,
@@ -128,10 +171,11 @@ class AIService:
             {"role": "user", "content": user_message}
         ]
         
-        return await self.get_ai_response(
-            messages, 
-            temperature=AI_TEMPERATURES['CREATIVE']
-        )
+        with usage.attribute(purpose='hint'):
+            return await self.get_ai_response(
+                messages, 
+                temperature=AI_TEMPERATURES['CREATIVE']
+            )
     
     async def get_conversation_summary(self, room_name: str, user_name: str) -> Optional[str]:
         """Generate a conversation summary for awareness."""
@@ -145,29 +189,22 @@ class AIService:
             {"role": "user", "content": f"Summarize these messages: {messages}"}
         ]
         
-        return await self.get_ai_response(
-            summary_prompt,
-            temperature=AI_TEMPERATURES['FOCUSED']
-        )
+        with usage.attribute(purpose='summary'):
+            return await self.get_ai_response(
+                summary_prompt,
+                temperature=AI_TEMPERATURES['FOCUSED']
+            )
     
-    async def check_puzzle_solution(self, user_message: str, puzzle_answer: str) -> Dict[str, Any]:
+    async def check_puzzle_solution(self, user_message: str, puzzle: PuzzleAssets) -> Dict[str, Any]:
         """Check if user message contains the puzzle solution."""
-        messages = [
-            {
-                "role": "system", 
-                "content": f"""You are judging if a user's answer matches the puzzle solution.
-                Puzzle answer: {puzzle_answer}
-                
-                Respond with JSON: {{"is_correct": true/false, "explanation": "brief explanation"}}"""
-            },
-            {"role": "user", "content": user_message}
-        ]
+        messages = puzzle.prompts['solution_check'].render(user_message=user_message)
         
-        response = await self.get_ai_response(
-            messages,
-            temperature=AI_TEMPERATURES['PRECISE'],
-            response_format=OPENAI_CONFIG['RESPONSE_FORMAT_JSON']
-        )
+        with usage.attribute(purpose='solution_check'):
+            response = await self.get_ai_response(
+                messages,
+                temperature=AI_TEMPERATURES['PRECISE'],
+                response_format=OPENAI_CONFIG['RESPONSE_FORMAT_JSON']
+            )
         
         try:
             return json.loads(response) if response else {"is_correct": False, "explanation": "Analysis failed"}
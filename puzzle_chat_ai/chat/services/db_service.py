@@ -3,13 +3,14 @@ Database service for optimized async database operations.
 """
 
 import logging
-from typing import List, Optional, Dict, Any
-from asgiref.sync import sync_to_async
+from typing import List, Optional, Dict, Any, Iterable, Tuple
 from django.db import models
 from django.core.cache import cache
 
 from ..models import ChatMessage, ChatUser, AIChatMessage
 from ..constants import CACHE_CONFIG, DEFAULTS
+from . import metrics, tracing
+from .metrics import timed_sync_to_async
 
 logger = logging.getLogger(__name__)
 
@@ -18,59 +19,78 @@ class DatabaseService:
     """Service for optimized database operations with caching."""
     
     @staticmethod
+    @tracing.traced('db.create_chat_user')
     async def create_chat_user(user_name: str) -> Optional['ChatUser']:
         """Create a new chat user asynchronously."""
         try:
-            return await sync_to_async(ChatUser.objects.create)(user_name=user_name)
+            return await timed_sync_to_async('create_chat_user', ChatUser.objects.create)(user_name=user_name)
         except Exception as e:
             logger.error(f"Failed to create user {user_name}: {e}")
             return None
     
     @staticmethod
+    @tracing.traced('db.create_chat_message')
     async def create_chat_message(
         room_name: str,
         user_name: str,
         message: str,
         reply_message: str = "",
-        reply_author: str = ""
+        reply_author: str = "",
+        seq: Optional[int] = None
     ) -> Optional['ChatMessage']:
         """Create a new chat message asynchronously."""
         try:
-            return await sync_to_async(ChatMessage.objects.create)(
+            return await timed_sync_to_async('create_chat_message', ChatMessage.objects.create)(
                 room_name=room_name,
                 user_name=user_name,
                 message=message,
                 reply_message=reply_message,
-                reply_author=reply_author
+                reply_author=reply_author,
+                seq=seq
             )
         except Exception as e:
             logger.error(f"Failed to create chat message: {e}")
             return None
     
     @staticmethod
+    @tracing.traced('db.create_ai_message')
     async def create_ai_message(
         room_name: str,
         user_name: str,
         message: str,
         ai_message: str,
         mode: str = 'A',
-        awareness_summary: str = ""
+        awareness_summary: str = "",
+        seq: Optional[int] = None
     ) -> Optional['AIChatMessage']:
         """Create a new AI message asynchronously."""
         try:
-            return await sync_to_async(AIChatMessage.objects.create)(
+            return await timed_sync_to_async('create_ai_message', AIChatMessage.objects.create)(
                 room_name=room_name,
                 user_name=user_name,
                 message=message,
                 ai_message=ai_message,
                 mode=mode,
-                awareness_summary=awareness_summary
+                awareness_summary=awareness_summary,
+                seq=seq
             )
         except Exception as e:
             logger.error(f"Failed to create AI message: {e}")
             return None
     
     @staticmethod
+    @tracing.traced('db.assign_seq')
+    async def assign_seq(message: models.Model, seq: Optional[int]) -> None:
+        """Store the room event sequence number a saved message was broadcast with."""
+        if seq is None:
+            return
+        try:
+            await timed_sync_to_async('assign_seq', type(message).objects.filter(pk=message.pk).update)(seq=seq)
+        except Exception as e:
+            logger.error(f"Failed to store sequence {seq} of message {message.pk}: {e}")
+    
+    @staticmethod
+    @tracing.traced('db.get_room_messages')
     async def get_room_messages(
         room_name: str, 
         limit: int = 50,
@@ -81,12 +101,13 @@ class DatabaseService:
         
         if use_cache:
             cached_messages = cache.get(cache_key)
+            metrics.cache_lookup('room_messages', bool(cached_messages))
             if cached_messages:
                 return cached_messages
         
         try:
             # Use select_related to avoid N+1 queries if there are foreign keys
-            messages = await sync_to_async(list)(
+            messages = await timed_sync_to_async('get_room_messages', list)(
                 ChatMessage.objects.filter(room_name=room_name)
                 .order_by('-timestamp')[:limit]
             )
@@ -100,6 +121,7 @@ class DatabaseService:
             return []
     
     @staticmethod
+    @tracing.traced('db.get_ai_messages')
     async def get_ai_messages(
         room_name: str,
         user_name: Optional[str] = None,
@@ -115,7 +137,7 @@ class DatabaseService:
             if limit:
                 queryset = queryset[:limit]
             
-            return await sync_to_async(list)(
+            return await timed_sync_to_async('get_ai_messages', list)(
                 queryset.order_by('-timestamp')
             )
         except Exception as e:
@@ -123,6 +145,27 @@ class DatabaseService:
             return []
     
     @staticmethod
+    @tracing.traced('db.get_messages_by_seq')
+    async def get_messages_by_seq(
+        room_name: str,
+        seqs: Iterable[int]
+    ) -> Tuple[List['ChatMessage'], List['AIChatMessage']]:
+        """Get the chat and AI messages carrying the given room event sequence numbers."""
+        seqs = list(seqs)
+        try:
+            chat_messages = await timed_sync_to_async('get_messages_by_seq', list)(
+                ChatMessage.objects.filter(room_name=room_name, seq__in=seqs)
+            )
+            ai_messages = await timed_sync_to_async('get_messages_by_seq', list)(
+                AIChatMessage.objects.filter(room_name=room_name, seq__in=seqs)
+            )
+            return chat_messages, ai_messages
+        except Exception as e:
+            logger.error(f"Failed to get messages by sequence: {e}")
+            return [], []
+    
+    @staticmethod
+    @tracing.traced('db.update_message_likes')
     async def update_message_likes(
         message_id: int,
         user_name: str,
@@ -130,7 +173,7 @@ class DatabaseService:
     ) -> Dict[str, Any]:
         """Update message likes optimistically."""
         try:
-            message = await sync_to_async(ChatMessage.objects.get)(id=message_id)
+            message = await timed_sync_to_async('get_chat_message', ChatMessage.objects.get)(id=message_id)
             
             liked_by = message.liked_by or []
             
@@ -145,7 +188,7 @@ class DatabaseService:
                 liked_by.remove(user_name)
             
             message.liked_by = liked_by
-            await sync_to_async(message.save)(update_fields=['liked_by'])
+            await timed_sync_to_async('update_message_likes', message.save)(update_fields=['liked_by'])
             
             return {
                 'success': True,
@@ -160,15 +203,16 @@ class DatabaseService:
             return {'success': False, 'error': str(e)}
     
     @staticmethod
+    @tracing.traced('db.update_ai_suggestion_response')
     async def update_ai_suggestion_response(
         message_id: int,
         response_type: str
     ) -> bool:
         """Update AI suggestion response status."""
         try:
-            message = await sync_to_async(AIChatMessage.objects.get)(id=message_id)
+            message = await timed_sync_to_async('get_ai_message', AIChatMessage.objects.get)(id=message_id)
             message.suggestion_response = response_type
-            await sync_to_async(message.save)(update_fields=['suggestion_response'])
+            await timed_sync_to_async('update_suggestion_response', message.save)(update_fields=['suggestion_response'])
             return True
         except AIChatMessage.DoesNotExist:
             logger.error(f"AI Message {message_id} not found")
@@ -178,15 +222,18 @@ class DatabaseService:
             return False
     
     @staticmethod
+    @tracing.traced('db.get_user_count')
     async def get_user_count(room_name: str) -> int:
         """Get active user count for a room (with caching)."""
         cache_key = f"user_count:{room_name}"
         count = cache.get(cache_key)
+        metrics.cache_lookup('user_count', count is not None)
         
         if count is None:
             try:
                 # This is a simplified count - in reality you'd track active connections
-                count = await sync_to_async(
+                count = await timed_sync_to_async(
+                    'get_user_count',
                     ChatUser.objects.filter(user_name__icontains=room_name).count
                 )()
                 cache.set(cache_key, count, CACHE_CONFIG['DEFAULT_TIMEOUT'])
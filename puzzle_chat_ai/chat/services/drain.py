@@ -0,0 +1,174 @@
+"""
+Graceful drain of in-flight AI work when a worker shuts down.
+
+Rolling a daphne worker used to cancel every application instance at once:
+judge and suggestion calls died half-way, the player got nothing and the
+AIChatMessage row was never written. On SIGTERM the worker now drains first
+(daphne through puzzle_chat_ai.server, other servers through the ASGI
+lifespan app in puzzle_chat_ai.lifespan):
+
+1. New AI jobs are refused and their idempotency key is released, so the
+   client's resend after reconnecting runs them on another worker. New
+   connections are turned away.
+2. Jobs already accepted run to completion, for up to
+   DRAIN_DEADLINE_SECONDS. Jobs still running then are cancelled and
+   counted as abandoned.
+3. Buffered usage rows are written.
+4. Every connection first handles what the channel layer already queued for
+   it (e.g. the broadcast of a job that just finished), then is sent a
+   `reconnect` frame and closed with DRAIN['CLOSE_CODE'] (4012, service
+   restart).
+
+AI calls open an aiohttp session per request inside the job, so once the
+jobs are finished or cancelled no HTTP session is left open.
+"""
+
+import asyncio
+import logging
+import signal
+import time
+import weakref
+from typing import Dict, Optional, Set
+
+from django.conf import settings
+
+from . import metrics, usage
+
+logger = logging.getLogger(__name__)
+
+
+class Drain:
+    """Tracks this process's AI jobs and connections, and drains them on shutdown."""
+
+    def __init__(self, deadline: Optional[float] = None):
+        self.deadline = deadline if deadline is not None else getattr(settings, 'DRAIN_DEADLINE_SECONDS', 25.0)
+        self.draining = False
+        self._jobs: Set[asyncio.Task] = set()
+        self._connections = weakref.WeakSet()
+        self._task: Optional[asyncio.Task] = None
+        self._settling: Dict[str, asyncio.Event] = {}
+
+    @property
+    def accepting(self) -> bool:
+        return not self.draining
+
+    def track(self, task: asyncio.Task) -> asyncio.Task:
+        """Register an accepted AI job; a drain waits for it."""
+        self._jobs.add(task)
+        task.add_done_callback(self._jobs.discard)
+        return task
+
+    def refuse(self, message_type: str, user_name: str) -> None:
+        metrics.drained_job('refused')
+        logger.info(f"Draining: refused {message_type} of {user_name}")
+
+    def register(self, consumer) -> None:
+        """A connection to send the reconnect hint to; it needs `send_reconnect_hint()`."""
+        self._connections.add(consumer)
+
+    def unregister(self, consumer) -> None:
+        self._connections.discard(consumer)
+
+    async def settle(self, consumer, timeout: float) -> None:
+        """
+        Wait until `consumer` has handled the channel-layer messages queued for
+        it before this call; a channel's messages are delivered in order. The
+        consumer passes the `drain.settled` marker on to `settled()`.
+        """
+        channel_name = consumer.channel_name
+        settled = self._settling[channel_name] = asyncio.Event()
+        try:
+            await consumer.channel_layer.send(channel_name, {'type': 'drain.settled'})
+            await asyncio.wait_for(settled.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Draining: {channel_name} did not handle its queued messages in {timeout}s")
+        except Exception as e:
+            logger.error(f"Draining: failed to settle {channel_name}: {e}")
+        finally:
+            self._settling.pop(channel_name, None)
+
+    def settled(self, channel_name: str) -> None:
+        event = self._settling.get(channel_name)
+        if event is not None:
+            event.set()
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    async def drain(self, deadline: Optional[float] = None) -> None:
+        """Drain once; later calls wait for the drain already running."""
+        if self._task is None:
+            self.draining = True
+            self._task = asyncio.ensure_future(self._drain(self.deadline if deadline is None else deadline))
+        await asyncio.shield(self._task)
+
+    async def _drain(self, deadline: float) -> None:
+        started = time.monotonic()
+        jobs = set(self._jobs)
+        logger.warning(f"Draining: {len(jobs)} AI job(s) in flight, {len(self._connections)} connection(s)")
+
+        abandoned = set()
+        if jobs:
+            _, abandoned = await asyncio.wait(jobs, timeout=deadline)
+            for task in abandoned:
+                task.cancel()
+            if abandoned:
+                # 讓被取消的工作收尾 (記錄用量、釋放 idempotency key)
+                await asyncio.wait(abandoned, timeout=1)
+        metrics.drained_job('finished', len(jobs) - len(abandoned))
+        metrics.drained_job('abandoned', len(abandoned))
+
+        try:
+            flushed = await usage.recorder.flush_all()
+        except Exception as e:
+            logger.error(f"Draining: failed to flush usage rows: {e}")
+            flushed = 0
+
+        connections = list(self._connections)
+        results = await asyncio.gather(
+            *(consumer.send_reconnect_hint() for consumer in connections), return_exceptions=True
+        )
+        for error in results:
+            if isinstance(error, Exception):
+                logger.error(f"Draining: failed to close a connection: {error}")
+
+        logger.warning(
+            f"Drained in {time.monotonic() - started:.2f}s: {len(jobs) - len(abandoned)} job(s) finished, "
+            f"{len(abandoned)} abandoned, {flushed} usage row(s) written, {len(connections)} connection(s) closed"
+        )
+
+    def install_signal_handler(self, signum: int = signal.SIGTERM) -> None:
+        """
+        Drain on `signum` in the running event loop, then pass the signal on to
+        the handler installed before (the server's own shutdown). Must be
+        called from the main thread.
+        """
+        loop = asyncio.get_running_loop()
+        previous = signal.getsignal(signum)
+
+        def handle(received, frame):
+            loop.call_soon_threadsafe(self._drain_then, previous, received, frame)
+
+        try:
+            signal.signal(signum, handle)
+        except ValueError as e:
+            logger.error(f"Cannot install the drain signal handler: {e}")
+
+    def _drain_then(self, previous, signum: int, frame) -> None:
+        def done(_):
+            if callable(previous):
+                previous(signum, frame)
+            elif previous == signal.SIG_DFL:
+                signal.signal(signum, signal.SIG_DFL)
+                signal.raise_signal(signum)
+
+        asyncio.ensure_future(self.drain()).add_done_callback(done)
+
+    def reset(self) -> None:
+        """Accept work again (after a drain that did not end the process, e.g. in tests)."""
+        self.draining = False
+        self._task = None
+
+
+# Global drain instance
+drain = Drain()
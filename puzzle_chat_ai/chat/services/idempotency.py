@@ -0,0 +1,182 @@
+"""
+Idempotency keys for client actions.
+
+The client attaches a fresh `idempotency_key` to every state-changing message
+and re-sends the same message with the same key after a reconnect. The first
+message with a key claims it in the Django cache (Redis in production, shared
+by all workers) and runs. A later message with that key does not run again: it
+gets the frames the first run sent to its author, or, when the first run is
+still in progress (an AI call that outlived the old connection), waits for it
+to finish. A failed or cancelled run releases its key, so the retry runs.
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from django.core.cache import cache
+
+from ..constants import CACHE_CONFIG
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_KEY_FIELD = 'idempotency_key'
+MAX_KEY_LENGTH = 64
+
+STATE_PENDING = 'pending'
+STATE_DONE = 'done'
+
+_recording: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar(
+    'idempotency_recording', default=None
+)
+
+
+def client_key(data: Dict[str, Any]) -> Optional[str]:
+    """The idempotency key of an incoming message, or None when it has no usable one."""
+    key = data.get(IDEMPOTENCY_KEY_FIELD)
+    if not isinstance(key, str) or not key or len(key) > MAX_KEY_LENGTH:
+        return None
+    return key
+
+
+def current_key() -> Optional[str]:
+    """The key of the action being recorded in this context, if any."""
+    recording = _recording.get()
+    return recording['key'] if recording else None
+
+
+def capture(frame: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Stamp the current key on a frame going to the action's author and keep a
+    copy for replay. A no-op outside `IdempotencyStore.recording`.
+    """
+    recording = _recording.get()
+    if recording is not None:
+        frame[IDEMPOTENCY_KEY_FIELD] = recording['key']
+        recording['frames'].append(dict(frame))
+    return frame
+
+
+def fail() -> None:
+    """Mark the current action as failed; its key is released so a retry runs again."""
+    recording = _recording.get()
+    if recording is not None:
+        recording['failed'] = True
+
+
+class IdempotencyStore:
+    """Short-lived (room, user, key) -> result frames store with a pending marker while the action runs."""
+
+    def __init__(
+        self,
+        timeout: int = CACHE_CONFIG['IDEMPOTENCY_TIMEOUT'],
+        pending_timeout: int = CACHE_CONFIG['IDEMPOTENCY_PENDING_TIMEOUT'],
+        poll_interval: float = 0.5
+    ):
+        self.timeout = timeout
+        self.pending_timeout = pending_timeout
+        self.poll_interval = poll_interval
+
+    def _key(self, room_name: str, user_name: str, key: str) -> str:
+        return f"idempotency:{room_name}:{user_name}:{key}"
+
+    def claim(self, room_name: str, user_name: str, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Try to claim `key` for a new run. Returns None when the caller should
+        run the action, otherwise the existing record ({'state', 'frames'}).
+        """
+        cache_key = self._key(room_name, user_name, key)
+        try:
+            if cache.add(cache_key, {'state': STATE_PENDING, 'frames': []}, self.pending_timeout):
+                return None
+            return cache.get(cache_key)
+        except Exception as e:
+            # 快取故障時照常處理，寧可重複也不要擋掉訊息
+            logger.error(f"Idempotency store unavailable: {e}")
+            return None
+
+    def complete(self, room_name: str, user_name: str, key: str, frames: List[Dict[str, Any]]) -> None:
+        try:
+            cache.set(self._key(room_name, user_name, key), {'state': STATE_DONE, 'frames': frames}, self.timeout)
+        except Exception as e:
+            logger.error(f"Failed to store idempotent result for {user_name}: {e}")
+
+    def release(self, room_name: str, user_name: str, key: str) -> None:
+        try:
+            cache.delete(self._key(room_name, user_name, key))
+        except Exception as e:
+            logger.error(f"Failed to release idempotency key for {user_name}: {e}")
+
+    async def wait(self, room_name: str, user_name: str, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Wait for a pending action to finish. Returns its finished record, or
+        None when it failed or its pending marker expired.
+        """
+        cache_key = self._key(room_name, user_name, key)
+        deadline = time.monotonic() + self.pending_timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                record = cache.get(cache_key)
+            except Exception as e:
+                logger.error(f"Idempotency store unavailable: {e}")
+                return None
+            if record is None or record['state'] == STATE_DONE:
+                return record
+        return None
+
+    @contextmanager
+    def recording(self, room_name: str, user_name: str, key: Optional[str]):
+        """
+        Run an already claimed action: frames passed to `capture` inside are
+        stored as its result on success; on failure or cancellation the key is
+        released. Does nothing when `key` is None.
+        """
+        if key is None:
+            yield
+            return
+        recording = {'key': key, 'frames': [], 'failed': False}
+        token = _recording.set(recording)
+        try:
+            yield
+        except BaseException:
+            self.release(room_name, user_name, key)
+            raise
+        else:
+            if recording['failed']:
+                self.release(room_name, user_name, key)
+            else:
+                self.complete(room_name, user_name, key, recording['frames'])
+        finally:
+            _recording.reset(token)
+
+    async def replay(self, consumer, message_type: str, key: str, record: Dict[str, Any]) -> bool:
+        """
+        Send a duplicate's original result frames to `consumer`, waiting first
+        if the original is still running. Returns False when there is no
+        result to replay and the caller should run the action itself.
+        """
+        if record['state'] == STATE_PENDING:
+            record = await self.wait(consumer.room_name, consumer.user_name, key)
+            if record is None:
+                # 原本的處理失敗或逾時：重新取得 key 後由呼叫端重跑
+                record = self.claim(consumer.room_name, consumer.user_name, key)
+                if record is None:
+                    return False
+                if record['state'] != STATE_DONE:
+                    # 另一個重送已經接手
+                    return True
+
+        metrics.idempotent_replay(message_type)
+        for frame in record['frames']:
+            await consumer.send(text_data=json.dumps({**frame, 'replayed': True}))
+        return True
+
+
+# Global idempotency store instance
+idempotency_store = IdempotencyStore()
@@ -0,0 +1,272 @@
+"""
+Local judge classifier in front of the LLM judge.
+
+The train_judge_model command fits a multinomial logistic regression on the
+character n-grams of canonical questions (NumPy only) from a puzzle's
+historical verdicts. A temperature fitted on held-out questions calibrates
+its softmax. The model is stored as <JUDGE_CLASSIFIER_DIR>/<puzzle slug>.npz:
+float16 weights and the n-gram vocabulary as one string, compressed and
+without pickle.
+
+LocalJudge runs in JUDGE_CLASSIFIER_MODE:
+- off: no model is loaded.
+- shadow: every judge question is predicted but still goes to the LLM. The
+  agreement is counted by confidence bucket and logged, to pick a threshold.
+- on: the prediction is the answer when its calibrated confidence reaches
+  JUDGE_CLASSIFIER_THRESHOLD; otherwise the LLM answers and agreement is
+  recorded as in shadow mode.
+
+A question that mentions enough of the solution (PuzzleAssets.might_solve)
+always goes to the LLM, since only the LLM judge can declare a puzzle solved.
+"""
+
+import logging
+import os
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from django.conf import settings
+
+from ..constants import JUDGE_CLASSIFIER, JUDGE_VERDICTS
+from . import metrics
+from .verdict_cache import QUERY_EVALUATION, canonicalize
+
+logger = logging.getLogger(__name__)
+
+MODE_OFF = 'off'
+MODE_SHADOW = 'shadow'
+MODE_ON = 'on'
+
+_SEPARATOR = '\n'
+
+
+def ngrams(canonical: str, ngram_max: int) -> set:
+    """Every character n-gram of length 1..ngram_max."""
+    return {
+        canonical[start:start + size]
+        for size in range(1, ngram_max + 1)
+        for start in range(len(canonical) - size + 1)
+    }
+
+
+def softmax(logits: np.ndarray) -> np.ndarray:
+    shifted = logits - logits.max(axis=-1, keepdims=True)
+    exp = np.exp(shifted)
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+class JudgeModel:
+    """Linear softmax classifier over character n-grams of a canonical question."""
+
+    def __init__(
+        self,
+        vocabulary: Sequence[str],
+        weights: np.ndarray,
+        bias: np.ndarray,
+        labels: Sequence[str],
+        ngram_max: int,
+        temperature: float = 1.0,
+        puzzle_slug: str = ''
+    ):
+        self.vocabulary = list(vocabulary)
+        self.index = {gram: position for position, gram in enumerate(self.vocabulary)}
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.bias = np.asarray(bias, dtype=np.float32)
+        self.labels = tuple(labels)
+        self.ngram_max = ngram_max
+        self.temperature = temperature
+        self.puzzle_slug = puzzle_slug
+
+    def feature_ids(self, canonical: str) -> List[int]:
+        return [self.index[gram] for gram in ngrams(canonical, self.ngram_max) if gram in self.index]
+
+    def matrix(self, canonicals: Iterable[str]) -> np.ndarray:
+        """Binary n-gram features, each row scaled to unit length."""
+        canonicals = list(canonicals)
+        features = np.zeros((len(canonicals), len(self.vocabulary)), dtype=np.float32)
+        for row, canonical in enumerate(canonicals):
+            ids = self.feature_ids(canonical)
+            if ids:
+                features[row, ids] = 1 / np.sqrt(len(ids))
+        return features
+
+    def logits(self, features: np.ndarray) -> np.ndarray:
+        return features @ self.weights + self.bias
+
+    def predict(self, question: str) -> Tuple[str, float]:
+        """(verdict, calibrated confidence) for one question."""
+        ids = self.feature_ids(canonicalize(question))
+        logits = self.bias.copy()
+        if ids:
+            logits += self.weights[ids].sum(axis=0) / np.sqrt(len(ids))
+        probabilities = softmax(logits / self.temperature)
+        best = int(probabilities.argmax())
+        return self.labels[best], float(probabilities[best])
+
+    def save(self, path: str) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'wb') as model_file:
+            np.savez_compressed(
+                model_file,
+                vocabulary=np.array(_SEPARATOR.join(self.vocabulary)),
+                labels=np.array(_SEPARATOR.join(self.labels)),
+                weights=self.weights.astype(np.float16),
+                bias=self.bias,
+                ngram_max=np.array(self.ngram_max),
+                temperature=np.array(self.temperature),
+                puzzle_slug=np.array(self.puzzle_slug),
+            )
+
+    @classmethod
+    def load(cls, path: str) -> 'JudgeModel':
+        with np.load(path, allow_pickle=False) as data:
+            vocabulary = str(data['vocabulary'])
+            return cls(
+                vocabulary.split(_SEPARATOR) if vocabulary else [],
+                data['weights'],
+                data['bias'],
+                str(data['labels']).split(_SEPARATOR),
+                int(data['ngram_max']),
+                float(data['temperature']),
+                str(data['puzzle_slug']),
+            )
+
+
+def train(
+    examples: Sequence[Tuple[str, str, int]],
+    ngram_max: int = JUDGE_CLASSIFIER['NGRAM_MAX'],
+    l2: float = JUDGE_CLASSIFIER['L2'],
+    epochs: int = JUDGE_CLASSIFIER['EPOCHS'],
+    learning_rate: float = JUDGE_CLASSIFIER['LEARNING_RATE'],
+    puzzle_slug: str = ''
+) -> JudgeModel:
+    """Fit on (canonical question, verdict, times asked) examples with full-batch gradient descent."""
+    labels = JUDGE_VERDICTS
+    vocabulary = sorted({gram for canonical, _, _ in examples for gram in ngrams(canonical, ngram_max)})
+    model = JudgeModel(
+        vocabulary,
+        np.zeros((len(vocabulary), len(labels)), dtype=np.float32),
+        np.zeros(len(labels), dtype=np.float32),
+        labels,
+        ngram_max,
+        puzzle_slug=puzzle_slug
+    )
+    features = model.matrix(canonical for canonical, _, _ in examples)
+    targets = np.eye(len(labels), dtype=np.float32)[[labels.index(verdict) for _, verdict, _ in examples]]
+    sample_weight = np.array([count for _, _, count in examples], dtype=np.float32)
+    sample_weight /= sample_weight.sum()
+
+    for _ in range(epochs):
+        gradient = (softmax(model.logits(features)) - targets) * sample_weight[:, None]
+        model.weights -= learning_rate * (features.T @ gradient + l2 * model.weights)
+        model.bias -= learning_rate * gradient.sum(axis=0)
+    return model
+
+
+def fit_temperature(model: JudgeModel, examples: Sequence[Tuple[str, str, int]]) -> float:
+    """The temperature that minimises the negative log-likelihood of held-out examples."""
+    if not examples:
+        return 1.0
+    logits = model.logits(model.matrix(canonical for canonical, _, _ in examples))
+    truth = np.array([model.labels.index(verdict) for _, verdict, _ in examples])
+    counts = np.array([count for _, _, count in examples], dtype=np.float32)
+    best_temperature, best_loss = 1.0, None
+    for temperature in np.arange(0.25, 4.01, 0.05):
+        probabilities = softmax(logits / temperature)[np.arange(len(truth)), truth]
+        loss = float(-(np.log(probabilities + 1e-9) * counts).sum() / counts.sum())
+        if best_loss is None or loss < best_loss:
+            best_temperature, best_loss = float(temperature), loss
+    return round(best_temperature, 2)
+
+
+def model_path(puzzle_slug: str) -> str:
+    return os.path.join(str(settings.JUDGE_CLASSIFIER_DIR), f"{puzzle_slug}.npz")
+
+
+def confidence_bucket(confidence: float) -> str:
+    """The highest JUDGE_CLASSIFIER['CONFIDENCE_BUCKETS'] bound reached, as a metric label."""
+    reached = [bound for bound in JUDGE_CLASSIFIER['CONFIDENCE_BUCKETS'] if confidence >= bound]
+    return str(reached[-1]) if reached else '0'
+
+
+class Prediction:
+    __slots__ = ('verdict', 'confidence')
+
+    def __init__(self, verdict: str, confidence: float):
+        self.verdict = verdict
+        self.confidence = confidence
+
+
+class LocalJudge:
+    """Answers judge questions from the puzzle's classifier when it is confident enough."""
+
+    def __init__(self, mode: Optional[str] = None, threshold: Optional[float] = None):
+        self.mode = mode or getattr(settings, 'JUDGE_CLASSIFIER_MODE', MODE_OFF)
+        self.threshold = threshold if threshold is not None else getattr(settings, 'JUDGE_CLASSIFIER_THRESHOLD', 0.9)
+        self._models: Dict[str, Tuple[float, Optional[JudgeModel]]] = {}
+
+    def model_for(self, puzzle_slug: str) -> Optional[JudgeModel]:
+        """The puzzle's model; the file is read again every RELOAD_INTERVAL seconds to pick up retraining."""
+        loaded_at, model = self._models.get(puzzle_slug, (None, None))
+        now = time.monotonic()
+        if loaded_at is not None and now - loaded_at < JUDGE_CLASSIFIER['RELOAD_INTERVAL']:
+            return model
+        model = None
+        path = model_path(puzzle_slug)
+        if os.path.exists(path):
+            try:
+                model = JudgeModel.load(path)
+            except Exception as e:
+                logger.error(f"Failed to load judge classifier {path}: {e}")
+        self._models[puzzle_slug] = (now, model)
+        return model
+
+    def predict(self, puzzle, question: str) -> Optional[Prediction]:
+        """The classifier's verdict for a question, or None when it must not be used."""
+        if self.mode == MODE_OFF:
+            return None
+        if puzzle.might_solve(question):
+            metrics.judge_classifier_prediction('skipped')
+            return None
+        return self.guess(puzzle, question)
+
+    def guess(self, puzzle, question: str) -> Optional[Prediction]:
+        """The model's verdict in any mode (e.g. to speculate on), or None without a model."""
+        model = self.model_for(puzzle.slug)
+        if model is None:
+            return None
+        verdict, confidence = model.predict(question)
+        return Prediction(verdict, confidence)
+
+    def answer(self, prediction: Optional[Prediction]) -> Optional[Dict[str, str]]:
+        """A judge result from a confident prediction in 'on' mode, else None (ask the LLM)."""
+        if prediction is None:
+            return None
+        if self.mode == MODE_ON and prediction.confidence >= self.threshold:
+            metrics.judge_classifier_prediction('local')
+            return {'evaluation': QUERY_EVALUATION, 'answer': prediction.verdict}
+        metrics.judge_classifier_prediction('deferred')
+        return None
+
+    def observe(self, prediction: Optional[Prediction], result: Dict[str, str]) -> None:
+        """Compare a deferred prediction with the LLM judge's result."""
+        if prediction is None:
+            return
+        evaluation, answer = result.get('evaluation'), result.get('answer')
+        if evaluation == QUERY_EVALUATION and answer not in JUDGE_VERDICTS:
+            # 裁判呼叫失敗，沒有可比較的答案
+            return
+        agreed = evaluation == QUERY_EVALUATION and answer == prediction.verdict
+        bucket = confidence_bucket(prediction.confidence)
+        metrics.judge_classifier_shadow(bucket, agreed)
+        logger.info(
+            f"Judge classifier {'agreed' if agreed else 'disagreed'}: predicted {prediction.verdict} "
+            f"({prediction.confidence:.2f}), judge said {evaluation}/{answer}"
+        )
+
+
+# Global local judge instance
+local_judge = LocalJudge()
@@ -2,13 +2,14 @@
 WebSocket message handler for processing different message types.
 """
 
-import json
 import logging
 from typing import Dict, Any, Optional
 
-from ..constants import MESSAGE_TYPES, ERROR_MESSAGES, FIXED_PUZZLE
+from ..constants import MESSAGE_TYPES, ERROR_MESSAGES, ROOM_RESYNC, SEQUENCED_EVENT_TYPES
 from .ai_service import ai_service
 from .db_service import db_service
+from .room_events import room_events
+from . import idempotency, metrics, tracing, usage
 
 logger = logging.getLogger(__name__)
 
@@ -31,15 +32,19 @@ class MessageHandler:
             MESSAGE_TYPES['SUGGESTION_RESPONSE']: self._handle_suggestion_response,
             MESSAGE_TYPES['TYPING']: self._handle_typing,
             MESSAGE_TYPES['STOP_TYPING']: self._handle_stop_typing,
+            MESSAGE_TYPES['RESYNC']: self._handle_resync,
         }
         
         handler = handlers.get(message_type)
         if handler:
-            try:
-                await handler(data)
-            except Exception as e:
-                logger.error(f"Error handling {message_type}: {e}")
-                await self._send_error(ERROR_MESSAGES['INVALID_MESSAGE'])
+            with tracing.span(f"handler.{message_type}") as trace, \
+                    usage.attribute(room_name=self.room_name, user_name=self.user_name):
+                try:
+                    await handler(data)
+                except Exception as e:
+                    trace.record_error(e)
+                    logger.error(f"Error handling {message_type}: {e}")
+                    await self._send_error(ERROR_MESSAGES['INVALID_MESSAGE'])
         else:
             logger.warning(f"Unknown message type: {message_type}")
             await self._send_error(ERROR_MESSAGES['INVALID_MESSAGE'])
@@ -54,6 +59,16 @@ class MessageHandler:
             await self._send_error("Message cannot be empty")
             return
         
+        # Check if this might be a puzzle solution; messages that mention
+        # too little of the answer skip the AI call
+        solution_check = {'is_correct': False}
+        checked = self.consumer.puzzle.might_solve(message)
+        metrics.solution_prefilter(checked)
+        if checked:
+            solution_check = await ai_service.check_puzzle_solution(
+                message, self.consumer.puzzle
+            )
+        
         # Save to database
         chat_message = await db_service.create_chat_message(
             room_name=self.room_name,
@@ -64,29 +79,20 @@ class MessageHandler:
         )
         
         if chat_message:
-            # Check if this might be a puzzle solution
-            solution_check = await ai_service.check_puzzle_solution(
-                message, FIXED_PUZZLE['answer']
-            )
-            
-            # Broadcast to room
-            await self.consumer.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'chat_message',
-                    'user_name': self.user_name,
-                    'message': message,
-                    'reply_text': reply_text,
-                    'reply_author': reply_author,
-                    'timestamp': chat_message.timestamp.isoformat(),
-                    'message_id': chat_message.id,
-                    'is_solution': solution_check.get('is_correct', False)
-                }
+            # Number the event only when it can be broadcast right away, so a
+            # lower seq never reaches clients after a higher one
+            chat_message.seq = await room_events.next_seq(self.room_name)
+            await self._group_send(
+                self._chat_event(chat_message, solution_check.get('is_correct', False))
             )
+            await db_service.assign_seq(chat_message, chat_message.seq)
             
             # Handle game over if solution is correct
             if solution_check.get('is_correct', False):
                 await self._handle_game_over(message)
+        else:
+            # 沒有存進資料庫，重送時要再處理一次
+            idempotency.fail()
         
         # Invalidate cache
         db_service.invalidate_room_cache(self.room_name)
@@ -101,7 +107,8 @@ class MessageHandler:
             return
         
         # Get AI response
-        ai_response = await ai_service.get_puzzle_hint(user_message, self.room_name)
+        with usage.attribute(mode=mode):
+            ai_response = await ai_service.get_puzzle_hint(user_message, self.room_name)
         
         if ai_response:
             # Save to database
@@ -114,8 +121,9 @@ class MessageHandler:
             )
             
             if ai_message:
+                ai_message.seq = await room_events.next_seq(self.room_name)
                 # Send to user
-                await self.consumer.send(text_data=json.dumps({
+                await self.consumer.send_frame(idempotency.capture({
                     'type': MESSAGE_TYPES['AI_MESSAGE'],
                     'sender': self.user_name,
                     'ai_message': ai_response,
@@ -125,15 +133,10 @@ class MessageHandler:
                 }))
                 
                 # Send to shared view for others
-                await self.consumer.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'shared_message',
-                        'sender': self.user_name,
-                        'user_message': user_message,
-                        'ai_reply_content': ai_response
-                    }
-                )
+                await self._group_send(self._shared_event(ai_message))
+                await db_service.assign_seq(ai_message, ai_message.seq)
+            else:
+                idempotency.fail()
         else:
             await self._send_error(ERROR_MESSAGES['AI_API_FAILED'])
     
@@ -151,8 +154,7 @@ class MessageHandler:
         
         if result['success']:
             # Broadcast like update
-            await self.consumer.channel_layer.group_send(
-                self.room_group_name,
+            await self._group_send(
                 {
                     'type': 'like_update',
                     'message_id': message_id,
@@ -183,8 +185,7 @@ class MessageHandler:
         """Handle typing indicator."""
         message = data.get('message', '')
         
-        await self.consumer.channel_layer.group_send(
-            self.room_group_name,
+        await self._group_send(
             {
                 'type': 'typing_indicator',
                 'user_name': self.user_name,
@@ -194,29 +195,103 @@ class MessageHandler:
     
     async def _handle_stop_typing(self, data: Dict[str, Any]) -> None:
         """Handle stop typing indicator."""
-        await self.consumer.channel_layer.group_send(
-            self.room_group_name,
+        await self._group_send(
             {
                 'type': 'stop_typing_indicator',
                 'user_name': self.user_name
             }
         )
     
+    async def _handle_resync(self, data: Dict[str, Any]) -> None:
+        """Replay the room events a reconnecting client missed, or send a snapshot."""
+        last_seq = data.get('last_seq')
+        if not isinstance(last_seq, int) or last_seq < 0:
+            await self._send_error("last_seq required")
+            return
+        
+        missed = await room_events.since(self.room_name, last_seq, self._load_persisted_events)
+        if missed is None:
+            await self._send_snapshot()
+            return
+        for frame in missed:
+            await self.consumer.send_frame(frame)
+    
+    async def _send_snapshot(self) -> None:
+        """Send recent room state with the sequence number it is current as of."""
+        last_seq = room_events.current(self.room_name)
+        messages = await db_service.get_room_messages(
+            self.room_name, limit=ROOM_RESYNC['SNAPSHOT_MESSAGES'], use_cache=False
+        )
+        ai_messages = await db_service.get_ai_messages(self.room_name, user_name=self.user_name)
+        await self.consumer.send_frame({
+            'type': MESSAGE_TYPES['SNAPSHOT'],
+            'last_seq': last_seq,
+            'messages': [self._chat_event(message) for message in reversed(messages)],
+            'ai_messages': [self._shared_event(message) for message in reversed(ai_messages)],
+        })
+    
+    async def _load_persisted_events(self, seqs) -> Dict[int, Dict[str, Any]]:
+        """Rebuild events that left the hot buffer from the rows carrying their numbers."""
+        chat_messages, ai_messages = await db_service.get_messages_by_seq(self.room_name, seqs)
+        events = {message.seq: self._chat_event(message) for message in chat_messages}
+        events.update({message.seq: self._shared_event(message) for message in ai_messages})
+        return events
+    
+    @staticmethod
+    def _chat_event(chat_message, is_solution: bool = False) -> Dict[str, Any]:
+        return {
+            'type': 'chat_message',
+            'user_name': chat_message.user_name,
+            'message': chat_message.message,
+            'reply_text': chat_message.reply_message,
+            'reply_author': chat_message.reply_author,
+            'timestamp': chat_message.timestamp.isoformat(),
+            'message_id': chat_message.id,
+            'is_solution': is_solution,
+            'seq': chat_message.seq
+        }
+    
+    @staticmethod
+    def _shared_event(ai_message) -> Dict[str, Any]:
+        return {
+            'type': 'shared_message',
+            'sender': ai_message.user_name,
+            'user_message': ai_message.message,
+            'ai_reply_content': ai_message.ai_message,
+            'seq': ai_message.seq
+        }
+    
     async def _handle_game_over(self, winning_message: str) -> None:
         """Handle game over scenario."""
-        await self.consumer.channel_layer.group_send(
-            self.room_group_name,
+        await self._group_send(
             {
                 'type': 'game_over',
                 'winner': self.user_name,
-                'final_answer': FIXED_PUZZLE['answer'],
+                'final_answer': self.consumer.puzzle.answer,
                 'winning_message': winning_message
             }
         )
     
+    async def _group_send(self, event: Dict[str, Any]) -> None:
+        """Broadcast an event to the room, counting channel layer failures."""
+        if event['type'] in SEQUENCED_EVENT_TYPES:
+            seq = event.get('seq')
+            if seq is None:
+                seq = await room_events.next_seq(self.room_name)
+            room_events.record(self.room_name, event, seq)
+        # 重送的動作會拿到同一份事件
+        idempotency.capture(event)
+        with tracing.span('channel_layer.group_send', event_type=event.get('type')):
+            try:
+                await self.consumer.channel_layer.group_send(self.room_group_name, tracing.inject(event))
+            except Exception:
+                metrics.channel_layer_failed('group_send')
+                raise
+    
     async def _send_error(self, error_message: str) -> None:
-        """Send error message to client."""
-        await self.consumer.send(text_data=json.dumps({
+        """Send error message to client; a failed action may be retried with the same key."""
+        idempotency.fail()
+        await self.consumer.send_frame({
             'type': 'error',
             'message': error_message
-        }))
\ No newline at end of file
+        })
\ No newline at end of file
@@ -0,0 +1,389 @@
+"""
+Prometheus-style metrics for the chat and AI hot paths.
+
+A small in-process registry rendered in the Prometheus text format by the
+/metrics view. Each worker process keeps its own counters, so scrape every
+worker (or label them by the `worker` label on the connection gauge).
+When METRICS_ENABLED is off every hook returns after a single flag check.
+"""
+
+import os
+import socket
+import threading
+import time
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from ..constants import MESSAGE_TYPES
+
+# 秒為單位；涵蓋資料庫的毫秒級操作到 OpenAI 的數十秒等待
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+KNOWN_MESSAGE_TYPES = frozenset(MESSAGE_TYPES.values())
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self) -> str:
+        header = f"# HELP {self.name} {self.documentation}\n# TYPE {self.name} {self.kind}\n"
+        return header + ''.join(self._samples())
+
+    def _samples(self):
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_number(value)}\n"
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # key -> [bucket counts..., sum, count]
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[index] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((key, list(state)) for key, state in self._values.items())
+        for key, state in items:
+            cumulative = 0
+            for index, bound in enumerate(self.buckets):
+                cumulative += state[index]
+                labels = _format_labels(self.labelnames, key, f'le="{_format_number(bound)}"')
+                yield f"{self.name}_bucket{labels} {cumulative}\n"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_number(state[-2])}\n"
+            yield f"{self.name}_count{labels} {state[-1]}\n"
+
+
+class MetricsRegistry:
+    """Holds every metric of the process and renders them for /metrics."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return ''.join(metric.render() for metric in self._metrics)
+
+
+registry = MetricsRegistry()
+
+enabled = getattr(settings, 'METRICS_ENABLED', False)
+
+ws_message_seconds = registry.register(Histogram(
+    'chat_ws_receive_to_broadcast_seconds',
+    'Time from receiving a WebSocket frame to finishing its handler (broadcast included).',
+    ['type'],
+))
+ws_active_connections = registry.register(Gauge(
+    'chat_ws_active_connections',
+    'Open WebSocket connections handled by this worker.',
+    ['worker'],
+))
+channel_layer_failures = registry.register(Counter(
+    'chat_channel_layer_send_failures_total',
+    'Channel layer calls that raised.',
+    ['method'],
+))
+openai_request_seconds = registry.register(Histogram(
+    'chat_openai_request_seconds',
+    'OpenAI chat completion latency per model attempt.',
+    ['model', 'status'],
+))
+openai_tokens = registry.register(Counter(
+    'chat_openai_tokens_total',
+    'Tokens reported in OpenAI usage blocks by model and kind (prompt/completion/cached).',
+    ['model', 'kind'],
+))
+model_routing_decisions = registry.register(Counter(
+    'chat_model_routing_decisions_total',
+    'Model routing decisions by task, chosen model and reason.',
+    ['task', 'model', 'reason'],
+))
+rate_limited_messages = registry.register(Counter(
+    'chat_rate_limited_messages_total',
+    'WebSocket messages rejected by the rate limiter, by message type and scope (user/room).',
+    ['type', 'scope'],
+))
+idempotent_replays = registry.register(Counter(
+    'chat_idempotent_replays_total',
+    'Duplicate client actions answered with the stored result instead of running again, by message type.',
+    ['type'],
+))
+room_resyncs = registry.register(Counter(
+    'chat_room_resyncs_total',
+    'Reconnect resyncs by how the gap was filled (none/buffer/db/snapshot).',
+    ['source'],
+))
+outbound_queue_depth = registry.register(Histogram(
+    'chat_outbound_queue_depth',
+    'Frames waiting in a connection\'s outbound queue, observed on every enqueue.',
+    buckets=(0, 1, 2, 4, 8, 16, 32, 64, 128),
+))
+outbound_queued_frames = registry.register(Gauge(
+    'chat_outbound_queued_frames',
+    'Frames currently waiting in the outbound queues of this worker.',
+))
+outbound_dropped_frames = registry.register(Counter(
+    'chat_outbound_dropped_frames_total',
+    'Outbound frames not delivered, by frame type and reason (shed/coalesced/closed).',
+    ['type', 'reason'],
+))
+solution_checks = registry.register(Counter(
+    'chat_solution_checks_total',
+    'Chat messages by whether the keyword prefilter sent them to the AI solution check (checked/skipped).',
+    ['result'],
+))
+judge_classifier_predictions = registry.register(Counter(
+    'chat_judge_classifier_predictions_total',
+    'Local judge classifier use by outcome (local = answered, deferred = sent to the LLM, skipped = possible solution).',
+    ['outcome'],
+))
+judge_classifier_shadow_results = registry.register(Counter(
+    'chat_judge_classifier_shadow_total',
+    'Deferred classifier predictions compared with the LLM judge, by confidence bucket and result (agree/disagree).',
+    ['confidence', 'result'],
+))
+speculative_suggestions = registry.register(Counter(
+    'chat_speculative_suggestions_total',
+    'Suggestions started before the judge answered, by verdict source (classifier/history) and outcome (hit/miss).',
+    ['source', 'outcome'],
+))
+speculative_wasted_tokens = registry.register(Counter(
+    'chat_speculative_suggestion_wasted_tokens_total',
+    'Tokens spent on speculative suggestions whose predicted verdict was wrong.',
+))
+drained_jobs = registry.register(Counter(
+    'chat_drained_jobs_total',
+    'AI jobs during a shutdown drain, by outcome (finished/abandoned = cancelled at the deadline/refused).',
+    ['outcome'],
+))
+cache_requests = registry.register(Counter(
+    'chat_cache_requests_total',
+    'Cache lookups by cache and result (hit/miss).',
+    ['cache', 'result'],
+))
+sync_to_async_wait_seconds = registry.register(Histogram(
+    'chat_sync_to_async_wait_seconds',
+    'Time a sync_to_async call waited for a worker thread before running.',
+    ['operation'],
+))
+sync_to_async_run_seconds = registry.register(Histogram(
+    'chat_sync_to_async_run_seconds',
+    'Time a sync_to_async call spent running in the worker thread.',
+    ['operation'],
+))
+
+
+# --- Hooks -------------------------------------------------------------
+
+def message_type_label(message_type: Optional[str]) -> str:
+    """Bound label cardinality to the known MESSAGE_TYPES values."""
+    return message_type if message_type in KNOWN_MESSAGE_TYPES else 'unknown'
+
+
+def observe_message(message_type: Optional[str], started: float) -> None:
+    if enabled:
+        ws_message_seconds.observe(time.perf_counter() - started, type=message_type_label(message_type))
+
+
+def connection_opened() -> None:
+    if enabled:
+        ws_active_connections.inc(worker=WORKER_ID)
+
+
+def connection_closed() -> None:
+    if enabled:
+        ws_active_connections.dec(worker=WORKER_ID)
+
+
+def channel_layer_failed(method: str) -> None:
+    if enabled:
+        channel_layer_failures.inc(method=method)
+
+
+def observe_openai(model: str, status, started: float) -> None:
+    if enabled:
+        openai_request_seconds.observe(time.perf_counter() - started, model=model, status=str(status))
+
+
+def observe_tokens(model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int) -> None:
+    if enabled:
+        openai_tokens.inc(prompt_tokens, model=model, kind='prompt')
+        openai_tokens.inc(completion_tokens, model=model, kind='completion')
+        openai_tokens.inc(cached_tokens, model=model, kind='cached')
+
+
+def routing_decision(task: str, model: str, reason: str) -> None:
+    if enabled:
+        model_routing_decisions.inc(task=task, model=model, reason=reason)
+
+
+def rate_limited(message_type: str, scope: str) -> None:
+    if enabled:
+        rate_limited_messages.inc(type=message_type_label(message_type), scope=scope)
+
+
+def idempotent_replay(message_type: str) -> None:
+    if enabled:
+        idempotent_replays.inc(type=message_type_label(message_type))
+
+
+def room_resync(source: str) -> None:
+    if enabled:
+        room_resyncs.inc(source=source)
+
+
+def outbound_enqueued(depth: int) -> None:
+    if enabled:
+        outbound_queue_depth.observe(depth)
+        outbound_queued_frames.inc()
+
+
+def outbound_dequeued(count: int = 1) -> None:
+    if enabled:
+        outbound_queued_frames.dec(count)
+
+
+def outbound_dropped(frame_type: str, reason: str) -> None:
+    if enabled:
+        outbound_dropped_frames.inc(type=frame_type, reason=reason)
+
+
+def solution_prefilter(checked: bool) -> None:
+    if enabled:
+        solution_checks.inc(result='checked' if checked else 'skipped')
+
+
+def judge_classifier_prediction(outcome: str) -> None:
+    if enabled:
+        judge_classifier_predictions.inc(outcome=outcome)
+
+
+def judge_classifier_shadow(confidence: str, agreed: bool) -> None:
+    if enabled:
+        judge_classifier_shadow_results.inc(confidence=confidence, result='agree' if agreed else 'disagree')
+
+
+def speculative_suggestion(source: str, hit: bool) -> None:
+    if enabled:
+        speculative_suggestions.inc(source=source, outcome='hit' if hit else 'miss')
+
+
+def speculation_wasted(tokens: int) -> None:
+    if enabled and tokens:
+        speculative_wasted_tokens.inc(tokens)
+
+
+def drained_job(outcome: str, count: int = 1) -> None:
+    if enabled and count:
+        drained_jobs.inc(count, outcome=outcome)
+
+
+def cache_lookup(cache_name: str, hit: bool) -> None:
+    if enabled:
+        cache_requests.inc(cache=cache_name, result='hit' if hit else 'miss')
+
+
+def timed_sync_to_async(operation: str, func: Callable) -> Callable:
+    """
+    Drop-in for sync_to_async(func) that records how long the call queued
+    for the thread executor and how long it ran.
+    """
+    if not enabled:
+        return sync_to_async(func)
+
+    async def wrapper(*args, **kwargs):
+        submitted = time.perf_counter()
+
+        def run():
+            started = time.perf_counter()
+            sync_to_async_wait_seconds.observe(started - submitted, operation=operation)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                sync_to_async_run_seconds.observe(time.perf_counter() - started, operation=operation)
+
+        return await sync_to_async(run)()
+
+    return wrapper
@@ -0,0 +1,147 @@
+"""
+Latency- and load-aware model routing.
+
+Every OpenAI call reports its latency and outcome here. The router keeps a
+rolling window per model and, per task type, decides whether a call should
+stay on the requested model or move to AI_MODELS['FAST']. Tasks that need
+precision (the judge, solution checks) never move; suggestions, hints and
+summaries do when the requested model is slow, failing or overloaded.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+from ..constants import AI_MODELS, MODEL_ROUTING, MODEL_TASK_POLICIES
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+REASON_REQUESTED = 'requested'
+REASON_ERRORS = 'error_rate'
+REASON_LATENCY = 'latency'
+REASON_LOAD = 'load'
+
+
+class ModelHealth:
+    """Rolling window of (finished_at, latency, ok) samples plus the in-flight count of one model."""
+
+    def __init__(self, window_seconds: float):
+        self.window_seconds = window_seconds
+        self.samples = deque()
+        self.in_flight = 0
+
+    def _trim(self, now: float) -> None:
+        while self.samples and now - self.samples[0][0] > self.window_seconds:
+            self.samples.popleft()
+
+    def observe(self, latency: float, ok: bool, now: float) -> None:
+        self.samples.append((now, latency, ok))
+        self._trim(now)
+
+    def snapshot(self, now: float) -> Dict[str, float]:
+        self._trim(now)
+        count = len(self.samples)
+        if not count:
+            return {'samples': 0, 'error_rate': 0.0, 'p90_latency': 0.0, 'in_flight': self.in_flight}
+        latencies = sorted(sample[1] for sample in self.samples)
+        errors = sum(1 for sample in self.samples if not sample[2])
+        return {
+            'samples': count,
+            'error_rate': errors / count,
+            'p90_latency': latencies[min(count - 1, int(count * 0.9))],
+            'in_flight': self.in_flight,
+        }
+
+
+class ModelRouter:
+    """Chooses the model for a call from its task policy and the requested model's recent health."""
+
+    def __init__(self, config: Dict = MODEL_ROUTING, policies: Dict = MODEL_TASK_POLICIES):
+        self.config = config
+        self.policies = policies
+        self._health: Dict[str, ModelHealth] = {}
+        self._lock = threading.Lock()
+        self._last_reason: Dict[Tuple[str, str], str] = {}
+
+    def _model_health(self, model: str) -> ModelHealth:
+        health = self._health.get(model)
+        if health is None:
+            health = self._health.setdefault(model, ModelHealth(self.config['WINDOW_SECONDS']))
+        return health
+
+    @contextmanager
+    def track(self, model: str):
+        """
+        Count the call as in flight and record its latency. The caller sets
+        `outcome['ok']` once it knows whether the call succeeded.
+        """
+        outcome = {'ok': False}
+        health = self._model_health(model)
+        with self._lock:
+            health.in_flight += 1
+        started = time.perf_counter()
+        cancelled = False
+        try:
+            yield outcome
+        except asyncio.CancelledError:
+            # 使用者離線而取消的呼叫不代表模型狀況
+            cancelled = True
+            raise
+        finally:
+            finished = time.perf_counter()
+            with self._lock:
+                health.in_flight -= 1
+                if not cancelled:
+                    health.observe(finished - started, outcome['ok'], time.monotonic())
+
+    def degradation(self, model: str) -> Optional[str]:
+        """Why `model` should be avoided right now, or None if it looks healthy."""
+        with self._lock:
+            stats = self._model_health(model).snapshot(time.monotonic())
+        if stats['in_flight'] >= self.config['MAX_IN_FLIGHT']:
+            return REASON_LOAD
+        if stats['samples'] < self.config['MIN_SAMPLES']:
+            return None
+        if stats['error_rate'] > self.config['MAX_ERROR_RATE']:
+            return REASON_ERRORS
+        if stats['p90_latency'] > self.config['MAX_P90_LATENCY']:
+            return REASON_LATENCY
+        return None
+
+    def route(self, task: Optional[str], model: str) -> str:
+        """Return the model to use for `task`; logs and meters every decision."""
+        policy = self.policies.get(task or '', {})
+        reason = REASON_REQUESTED
+        chosen = model
+        fast_model = AI_MODELS['FAST']
+
+        if self.config['ENABLED'] and policy.get('downgrade') and model != fast_model:
+            degraded = self.degradation(model)
+            if degraded:
+                chosen, reason = fast_model, degraded
+
+        metrics.routing_decision(task or 'unknown', chosen, reason)
+
+        # 只在路由結果改變時記錄，避免每次呼叫都寫 log
+        key = (task or 'unknown', model)
+        if self._last_reason.get(key, REASON_REQUESTED) != reason:
+            if reason == REASON_REQUESTED:
+                logger.info(f"Model routing: {task} back on {model}")
+            else:
+                logger.warning(f"Model routing: {task} moved from {model} to {chosen} ({reason})")
+            self._last_reason[key] = reason
+        return chosen
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        now = time.monotonic()
+        with self._lock:
+            return {model: health.snapshot(now) for model, health in self._health.items()}
+
+
+# Global model router instance
+model_router = ModelRouter()
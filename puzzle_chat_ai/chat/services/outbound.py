@@ -0,0 +1,151 @@
+"""
+Bounded per-connection outbound queue with priority-aware load shedding.
+
+Channel-layer event handlers used to await the socket write themselves, so a
+slow client held up its consumer and its channel-layer inbox filled until
+the layer dropped messages at random. Handlers now only enqueue here, and
+one writer task per connection drains the queue to the socket.
+
+The queue is bounded by OUTBOUND_QUEUE['MAX_SIZE']. A frame whose coalesce
+slot (see OUTBOUND_POLICIES) is already queued replaces that frame in place:
+a newer like count, or the newest typing state of a user. When the queue is
+full, ephemeral frames go first: an incoming ephemeral frame is dropped,
+and any other frame evicts the oldest queued ephemeral frame. A normal
+frame is dropped only when no ephemeral frame is left to evict. Critical
+frames, and direct replies to the client's own requests, are always queued
+even past the bound.
+"""
+
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Union
+
+from ..constants import OUTBOUND_POLICIES, OUTBOUND_QUEUE
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+FrameData = Union[str, bytes]
+
+PRIORITY_EPHEMERAL = 'ephemeral'
+PRIORITY_NORMAL = 'normal'
+PRIORITY_CRITICAL = 'critical'
+
+DIRECT_FRAME_TYPE = 'direct'
+
+
+class _Entry:
+    __slots__ = ('text', 'frame_type', 'priority', 'slot')
+
+    def __init__(self, text: FrameData, frame_type: str, priority: str, slot: Optional[Hashable]):
+        self.text = text
+        self.frame_type = frame_type
+        self.priority = priority
+        self.slot = slot
+
+
+class OutboundQueue:
+    """Frames waiting to be written to one WebSocket, drained by `run`."""
+
+    def __init__(
+        self,
+        write: Callable[[FrameData], Awaitable[None]],
+        owner: str = '',
+        max_size: int = OUTBOUND_QUEUE['MAX_SIZE'],
+        policies: Dict = OUTBOUND_POLICIES
+    ):
+        self.write = write
+        self.owner = owner
+        self.max_size = max_size
+        self.policies = policies
+        self._entries = deque()
+        self._slots: Dict[Hashable, _Entry] = {}
+        self._ready = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def put(self, text: FrameData, frame: Optional[dict] = None) -> bool:
+        """
+        Queue a serialized frame. `frame` is the decoded event it came from;
+        without it the frame is a direct reply and is always delivered.
+        Returns False when the frame was dropped.
+        """
+        if frame is None:
+            frame_type, policy = DIRECT_FRAME_TYPE, {'priority': PRIORITY_CRITICAL}
+        else:
+            frame_type = frame.get('type', '')
+            policy = self.policies.get(frame_type, {})
+        priority = policy.get('priority', PRIORITY_NORMAL)
+
+        slot = None
+        if 'coalesce' in policy:
+            slot_name, field = policy['coalesce']
+            slot = (slot_name, frame.get(field))
+            queued = self._slots.get(slot)
+            if queued is not None:
+                # 同一欄位只保留最新狀態，位置不變
+                metrics.outbound_dropped(queued.frame_type, 'coalesced')
+                queued.text, queued.frame_type, queued.priority = text, frame_type, priority
+                return True
+
+        if len(self._entries) >= self.max_size and priority != PRIORITY_CRITICAL:
+            # 佇列滿了：新的暫態訊息直接丟掉；其他訊息先擠掉最舊的暫態訊息
+            if priority == PRIORITY_EPHEMERAL or not self._shed(PRIORITY_EPHEMERAL):
+                metrics.outbound_dropped(frame_type, 'shed')
+                return False
+
+        entry = _Entry(text, frame_type, priority, slot)
+        self._entries.append(entry)
+        if slot is not None:
+            self._slots[slot] = entry
+        metrics.outbound_enqueued(len(self._entries))
+        self._idle.clear()
+        self._ready.set()
+        return True
+
+    def _shed(self, priority: str) -> bool:
+        """Evict the oldest queued frame of `priority`; False if there is none."""
+        for entry in self._entries:
+            if entry.priority == priority:
+                self._remove(entry)
+                metrics.outbound_dropped(entry.frame_type, 'shed')
+                return True
+        return False
+
+    def _remove(self, entry: _Entry) -> None:
+        self._entries.remove(entry)
+        if entry.slot is not None and self._slots.get(entry.slot) is entry:
+            del self._slots[entry.slot]
+        metrics.outbound_dequeued()
+
+    async def run(self) -> None:
+        """Write queued frames in order until cancelled; undelivered frames are counted as dropped."""
+        try:
+            while True:
+                if not self._entries:
+                    self._idle.set()
+                    self._ready.clear()
+                    await self._ready.wait()
+                    continue
+                entry = self._entries[0]
+                self._remove(entry)
+                await self.write(entry.text)
+        finally:
+            for entry in self._entries:
+                metrics.outbound_dropped(entry.frame_type, 'closed')
+            metrics.outbound_dequeued(len(self._entries))
+            self._entries.clear()
+            self._slots.clear()
+            self._idle.set()
+
+    async def flush(self, timeout: float) -> bool:
+        """Wait until every queued frame has been written; False if `timeout` passed first."""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def __len__(self) -> int:
+        return len(self._entries)
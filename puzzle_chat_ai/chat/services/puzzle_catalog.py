@@ -0,0 +1,191 @@
+"""
+Puzzle catalog with precompiled per-puzzle judge assets.
+
+A room plays the puzzle assigned to it in PuzzleAssignment, or the default
+puzzle: the catalog row with slug PUZZLE_CATALOG['DEFAULT_SLUG'], or
+FIXED_PUZZLE when there is no such row. Consumers resolve their room's
+puzzle once on connect, so no message waits for the catalog.
+
+Everything derived from a puzzle is built once per process, the first time
+the puzzle is used: the judge, suggestion and solution-check prompts
+compiled with its text (chat.prompts.compile_prompts), the solution keywords
+that prefilter the solution check, and its warm verdicts with a similarity
+index (chat.services.verdict_cache). The assets are kept in an LRU of
+PUZZLE_CATALOG['MAX_ASSETS'] puzzles and rebuilt after ASSET_TTL seconds, so
+edits to a catalog row reach running servers without a restart.
+
+A room's puzzle can only be changed while the room has no messages, so its
+history, verdict memo and exports always belong to one puzzle.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from ..constants import FIXED_PUZZLE, PUZZLE_CATALOG
+from ..models import AIChatMessage, ChatMessage, Puzzle, PuzzleAssignment
+from .. import prompts
+from . import metrics
+from .metrics import timed_sync_to_async
+from .verdict_cache import SimilarityIndex, bigrams, canonicalize, verdict_memo
+
+logger = logging.getLogger(__name__)
+
+
+def derive_solution_keywords(question: str, answer: str) -> FrozenSet[str]:
+    """Character bigrams of the answer that the question does not already contain."""
+    return bigrams(canonicalize(answer)) - bigrams(canonicalize(question))
+
+
+class PuzzleAssets:
+    """One puzzle and everything precomputed from it."""
+
+    def __init__(self, slug: str, question: str, answer: str, solution_keywords: Iterable[str] = (), title: str = ''):
+        self.slug = slug
+        self.title = title
+        self.question = question
+        self.answer = answer
+        self.prompts = prompts.compile_prompts(question, answer)
+        keywords = frozenset(filter(None, (canonicalize(keyword) for keyword in solution_keywords)))
+        self.solution_keywords = keywords or derive_solution_keywords(question, answer)
+        # 由答案推導的字組很多且零散，提到任何一個就檢查，以免漏掉換句話說的正解
+        self.prefilter_min_hits = PUZZLE_CATALOG['PREFILTER_MIN_HITS'] if keywords else 1
+        self.loaded_at = time.monotonic()
+        self._warm_index: Optional[SimilarityIndex] = None
+        self._warm_checked: Optional[float] = None
+
+    def might_solve(self, message: str) -> bool:
+        """
+        Whether a chat message mentions enough of the answer to be worth a
+        solution check: any keyword, or PREFILTER_MIN_HITS of curated ones.
+        """
+        text = canonicalize(message)
+        needed = min(self.prefilter_min_hits, len(self.solution_keywords))
+        hits = 0
+        for keyword in self.solution_keywords:
+            if keyword in text:
+                hits += 1
+                if hits >= needed:
+                    return True
+        return hits >= needed
+
+    def warm_verdict(self, canonical: str) -> Optional[str]:
+        """The warm answer for a canonical question (see SimilarityIndex.lookup), else None."""
+        index = self._warm_index
+        if index is None:
+            now = time.monotonic()
+            # 還沒預熱的謎題 (或啟動時預熱尚未完成) 隔一段時間再找一次
+            if self._warm_checked is not None and now - self._warm_checked < PUZZLE_CATALOG['INDEX_RETRY']:
+                return None
+            self._warm_checked = now
+            verdicts = verdict_memo.load_warm(self.slug)
+            if not verdicts:
+                return None
+            index = self._warm_index = SimilarityIndex(verdicts)
+        return index.lookup(canonical)
+
+    def common_verdict(self) -> Optional[Tuple[str, float]]:
+        """The most frequent warm answer and its share, once the warm verdicts are loaded."""
+        index = self._warm_index
+        if index is None or not index.prior:
+            return None
+        return next(iter(index.prior.items()))
+
+
+class PuzzleCatalog:
+    """Resolves rooms to puzzles and keeps the assets of recently used puzzles."""
+
+    def __init__(
+        self,
+        max_assets: int = PUZZLE_CATALOG['MAX_ASSETS'],
+        ttl: int = PUZZLE_CATALOG['ASSET_TTL'],
+        default_slug: str = PUZZLE_CATALOG['DEFAULT_SLUG']
+    ):
+        self.max_assets = max_assets
+        self.ttl = ttl
+        self.default_slug = default_slug
+        self._assets: Dict[str, PuzzleAssets] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cached(self, slug: str) -> Optional[PuzzleAssets]:
+        with self._lock:
+            assets = self._assets.get(slug)
+            if assets is None or time.monotonic() - assets.loaded_at >= self.ttl:
+                return None
+            self._assets.move_to_end(slug)
+            return assets
+
+    def get(self, slug: str) -> PuzzleAssets:
+        """A puzzle's assets, built on first use. Reads the database on a miss."""
+        assets = self._cached(slug)
+        metrics.cache_lookup('puzzle_assets', assets is not None)
+        if assets is not None:
+            return assets
+
+        puzzle = Puzzle.objects.filter(slug=slug).first()
+        if puzzle is not None:
+            assets = PuzzleAssets(puzzle.slug, puzzle.question, puzzle.answer, puzzle.solution_keywords, puzzle.title)
+        elif slug == self.default_slug:
+            assets = PuzzleAssets(self.default_slug, FIXED_PUZZLE['question'], FIXED_PUZZLE['answer'])
+        else:
+            raise Puzzle.DoesNotExist(f"Unknown puzzle '{slug}'")
+
+        with self._lock:
+            self._assets[slug] = assets
+            self._assets.move_to_end(slug)
+            while len(self._assets) > self.max_assets:
+                self._assets.popitem(last=False)
+        return assets
+
+    def slug_for_room(self, room_name: str) -> str:
+        slug = PuzzleAssignment.objects.filter(room_name=room_name).values_list('puzzle__slug', flat=True).first()
+        return slug or self.default_slug
+
+    async def for_room(self, room_name: str) -> PuzzleAssets:
+        """The assets of the puzzle a room plays; falls back to the default puzzle on errors."""
+        try:
+            slug = await timed_sync_to_async('resolve_room_puzzle', self.slug_for_room)(room_name)
+            return self._cached(slug) or await timed_sync_to_async('load_puzzle', self.get)(slug)
+        except Exception as e:
+            logger.error(f"Failed to load the puzzle of room {room_name}: {e}")
+            return self._cached(self.default_slug) or PuzzleAssets(
+                self.default_slug, FIXED_PUZZLE['question'], FIXED_PUZZLE['answer']
+            )
+
+    def slugs(self) -> List[str]:
+        """Every puzzle a room can play: the default first, then the catalog rows."""
+        return [self.default_slug] + [
+            slug for slug in Puzzle.objects.order_by('slug').values_list('slug', flat=True)
+            if slug != self.default_slug
+        ]
+
+    def assignments(self) -> Dict[str, str]:
+        """room_name -> puzzle slug for every room with an assignment."""
+        return dict(PuzzleAssignment.objects.values_list('room_name', 'puzzle__slug'))
+
+    def assign(self, room_name: str, slug: str) -> PuzzleAssignment:
+        """Bind a room to a puzzle. Refused once the room has messages for another puzzle."""
+        puzzle = Puzzle.objects.get(slug=slug)
+        current = self.slug_for_room(room_name)
+        has_history = (
+            ChatMessage.objects.filter(room_name=room_name).exists()
+            or AIChatMessage.objects.filter(room_name=room_name).exists()
+        )
+        if current != slug and has_history:
+            raise ValueError(f"Room '{room_name}' already has messages for puzzle '{current}'")
+        assignment, _ = PuzzleAssignment.objects.update_or_create(room_name=room_name, defaults={'puzzle': puzzle})
+        return assignment
+
+    def invalidate(self, slug: Optional[str] = None) -> None:
+        """Drop cached assets (of one puzzle, or all) so they are rebuilt on next use."""
+        with self._lock:
+            if slug is None:
+                self._assets.clear()
+            else:
+                self._assets.pop(slug, None)
+
+
+# Global puzzle catalog instance
+puzzle_catalog = PuzzleCatalog()
@@ -0,0 +1,99 @@
+"""
+Sliding-window rate limiting of WebSocket messages per user and per room.
+
+Uses the sliding-window counter approximation: one counter per fixed window
+in the Django cache (Redis in production, where INCR is atomic and shared by
+all workers), with the previous window's count weighted by how much of it
+still overlaps the sliding window. Two cache keys per scope, no per-request
+log, and the limit holds across worker processes.
+"""
+
+import logging
+import math
+import time
+from typing import Dict, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+from ..constants import RATE_LIMITS
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+enabled = getattr(settings, 'RATE_LIMIT_ENABLED', True)
+
+
+class SlidingWindowLimiter:
+    """Checks and counts messages against the per-type budgets in RATE_LIMITS."""
+
+    def __init__(self, limits: Dict[str, Dict[str, Tuple[int, int]]] = RATE_LIMITS):
+        self.limits = limits
+
+    def _key(self, scope: str, identity: str, message_type: str, window: int, bucket: int) -> str:
+        return f"rate_limit:{scope}:{identity}:{message_type}:{window}:{bucket}"
+
+    def _check_scope(
+        self,
+        scope: str,
+        identity: str,
+        message_type: str,
+        limit: int,
+        window: int,
+        now: float
+    ) -> Tuple[Optional[float], str]:
+        """Return (retry_after or None, current key) for one scope without counting."""
+        bucket = int(now // window)
+        current_key = self._key(scope, identity, message_type, window, bucket)
+        previous_key = self._key(scope, identity, message_type, window, bucket - 1)
+        counts = cache.get_many([current_key, previous_key])
+        current = counts.get(current_key, 0)
+        previous = counts.get(previous_key, 0)
+
+        elapsed = (now - bucket * window) / window
+        if previous * (1 - elapsed) + current < limit:
+            return None, current_key
+
+        # 估計何時加權後的次數會降到上限以下
+        if current < limit:
+            needed = 1 - (limit - current) / previous
+            retry_after = (needed - elapsed) * window
+        else:
+            retry_after = (1 - elapsed) * window + (1 - limit / current) * window
+        return max(retry_after, 0.0), current_key
+
+    def hit(self, message_type: str, user_name: str, room_name: str) -> Optional[int]:
+        """
+        Count one message. Returns None when it is allowed, otherwise the
+        whole seconds the client should wait before retrying.
+        """
+        budgets = self.limits.get(message_type)
+        if not enabled or not budgets:
+            return None
+
+        now = time.time()
+        identities = {'user': user_name, 'room': room_name}
+        to_count = []
+        try:
+            for scope, (limit, window) in budgets.items():
+                retry_after, key = self._check_scope(scope, identities[scope], message_type, limit, window, now)
+                if retry_after is not None:
+                    metrics.rate_limited(message_type, scope)
+                    return max(1, math.ceil(retry_after))
+                to_count.append((key, window))
+
+            for key, window in to_count:
+                # 保留兩個視窗長度，讓下一個視窗還能讀到這個計數
+                cache.add(key, 0, window * 2)
+                try:
+                    cache.incr(key)
+                except ValueError:
+                    cache.set(key, 1, window * 2)
+        except Exception as e:
+            # 快取故障時放行，不要因為限流器把聊天室整個擋掉
+            logger.error(f"Rate limiter unavailable: {e}")
+        return None
+
+
+# Global rate limiter instance
+rate_limiter = SlidingWindowLimiter()
@@ -0,0 +1,137 @@
+"""
+Per-room event sequence numbers and a hot buffer for resync on reconnect.
+
+Every persisted or broadcast room event gets the next number of a per-room
+counter in the Django cache (Redis INCR in production, so all workers share
+one order), and persisted rows keep their number in their `seq` column. The
+last few minutes of events are also kept in the cache, one key per number.
+
+A reconnecting client sends the last number it saw. The gap is replayed from
+the hot buffer; numbers that have left the buffer are rebuilt from the rows
+that carry them. When the gap is larger than ROOM_RESYNC['MAX_REPLAY'], or
+contains an unpersisted event (a like, game over) that left the buffer, the
+caller sends a snapshot instead.
+"""
+
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from django.core.cache import cache
+from django.db.models import Max
+
+from ..constants import CACHE_CONFIG, ROOM_RESYNC
+from ..models import AIChatMessage, ChatMessage
+from . import metrics
+from .metrics import timed_sync_to_async
+
+logger = logging.getLogger(__name__)
+
+SEQ_FIELD = 'seq'
+
+RESYNC_NONE = 'none'
+RESYNC_BUFFER = 'buffer'
+RESYNC_DB = 'db'
+RESYNC_SNAPSHOT = 'snapshot'
+
+PersistedLoader = Callable[[List[int]], Awaitable[Dict[int, dict]]]
+
+
+def _persisted_max_seq(room_name: str) -> int:
+    highest = [
+        model.objects.filter(room_name=room_name).aggregate(highest=Max('seq'))['highest'] or 0
+        for model in (ChatMessage, AIChatMessage)
+    ]
+    return max(highest)
+
+
+class RoomEventLog:
+    """Sequence counter and hot buffer of recent events, per room."""
+
+    def __init__(
+        self,
+        buffer_timeout: int = CACHE_CONFIG['ROOM_EVENT_BUFFER_TIMEOUT'],
+        seq_timeout: int = CACHE_CONFIG['ROOM_LIFETIME_TIMEOUT'],
+        max_replay: int = ROOM_RESYNC['MAX_REPLAY']
+    ):
+        self.buffer_timeout = buffer_timeout
+        self.seq_timeout = seq_timeout
+        self.max_replay = max_replay
+
+    def _seq_key(self, room_name: str) -> str:
+        return f"room_seq:{room_name}"
+
+    def _event_key(self, room_name: str, seq: int) -> str:
+        return f"room_event:{room_name}:{seq}"
+
+    async def next_seq(self, room_name: str) -> Optional[int]:
+        """Allocate the room's next sequence number; None if the cache is unavailable."""
+        key = self._seq_key(room_name)
+        try:
+            if cache.get(key) is None:
+                # 計數器過期或第一次使用：從資料庫中最大的序號接續，避免重複
+                start = await timed_sync_to_async('seed_room_seq', _persisted_max_seq)(room_name)
+                cache.add(key, start, self.seq_timeout)
+            return cache.incr(key)
+        except Exception as e:
+            logger.error(f"Failed to allocate event sequence for {room_name}: {e}")
+            return None
+
+    def current(self, room_name: str) -> int:
+        """The last sequence number handed out in the room (0 if unknown)."""
+        try:
+            return cache.get(self._seq_key(room_name)) or 0
+        except Exception as e:
+            logger.error(f"Failed to read event sequence for {room_name}: {e}")
+            return 0
+
+    def record(self, room_name: str, frame: dict, seq: Optional[int]) -> dict:
+        """Stamp `seq` on a client frame and keep a copy in the hot buffer."""
+        if seq is None:
+            return frame
+        frame[SEQ_FIELD] = seq
+        try:
+            cache.set(self._event_key(room_name, seq), dict(frame), self.buffer_timeout)
+        except Exception as e:
+            logger.error(f"Failed to buffer room event {seq} for {room_name}: {e}")
+        return frame
+
+    async def since(self, room_name: str, last_seq: int, load_persisted: PersistedLoader) -> Optional[List[dict]]:
+        """
+        The events after `last_seq`, in order, or None when the caller should
+        send a snapshot. `load_persisted(seqs)` rebuilds frames from the rows
+        carrying those numbers.
+        """
+        current = self.current(room_name)
+        gap = current - last_seq
+        if gap < 0 or gap > self.max_replay:
+            # 序號比伺服器還新表示計數器重設過
+            metrics.room_resync(RESYNC_SNAPSHOT)
+            return None
+        if gap == 0:
+            metrics.room_resync(RESYNC_NONE)
+            return []
+
+        seqs = range(last_seq + 1, current + 1)
+        keys = {seq: self._event_key(room_name, seq) for seq in seqs}
+        try:
+            found = cache.get_many(list(keys.values()))
+        except Exception as e:
+            logger.error(f"Failed to read room events for {room_name}: {e}")
+            found = {}
+        frames = {seq: found[key] for seq, key in keys.items() if key in found}
+
+        source = RESYNC_BUFFER
+        missing = [seq for seq in seqs if seq not in frames]
+        if missing:
+            source = RESYNC_DB
+            frames.update(await load_persisted(missing))
+            if len(frames) < gap:
+                metrics.room_resync(RESYNC_SNAPSHOT)
+                return None
+
+        metrics.room_resync(source)
+        return [frames[seq] for seq in seqs]
+
+
+# Global room event log instance
+room_events = RoomEventLog()
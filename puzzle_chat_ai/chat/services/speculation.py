@@ -0,0 +1,122 @@
+"""
+Speculative suggestions.
+
+In the A/B/C experiment flow the suggestion prompt includes the judge's
+answer, so the suggestion call normally waits for the judge call. With
+SPECULATIVE_SUGGESTIONS on, the consumer starts the suggestion for the most
+likely answer while the judge is still answering. The guess comes from:
+
+- classifier: the puzzle's local judge classifier, in any
+  JUDGE_CLASSIFIER_MODE, once a model has been trained;
+- history: otherwise the most frequent of the puzzle's warm verdicts.
+
+If the judge gives the guessed answer, the speculative suggestion is used as
+is. Otherwise the suggestion is generated again for the real answer, and the
+tokens of the discarded call are counted as wasted. Guesses below
+SPECULATIVE_SUGGESTION_MIN_CONFIDENCE and questions that might solve the
+puzzle are not speculated on.
+"""
+
+import asyncio
+import logging
+from typing import Callable, Coroutine, Optional, Tuple
+
+from django.conf import settings
+
+from . import metrics, usage
+from .judge_classifier import Prediction, local_judge
+from .task_tracker import ConnectionTasks
+from .verdict_cache import QUERY_EVALUATION
+
+logger = logging.getLogger(__name__)
+
+SOURCE_CLASSIFIER = 'classifier'
+SOURCE_HISTORY = 'history'
+
+
+class Speculation:
+    """A suggestion started for a guessed verdict."""
+
+    __slots__ = ('verdict', 'source', 'task', 'tally')
+
+    def __init__(self, verdict: str, source: str, task: asyncio.Task, tally: usage.TokenTally):
+        self.verdict = verdict
+        self.source = source
+        self.task = task
+        self.tally = tally
+
+
+class SpeculativeSuggestions:
+    """Starts suggestions before the judge answers and settles them against its verdict."""
+
+    def __init__(self, enabled: Optional[bool] = None, min_confidence: Optional[float] = None):
+        self.enabled = enabled if enabled is not None else getattr(settings, 'SPECULATIVE_SUGGESTIONS', False)
+        self.min_confidence = (
+            min_confidence if min_confidence is not None
+            else getattr(settings, 'SPECULATIVE_SUGGESTION_MIN_CONFIDENCE', 0.0)
+        )
+
+    def guess(self, puzzle, question: str, prediction: Optional[Prediction] = None) -> Optional[Tuple[str, str]]:
+        """(verdict, source) worth speculating on, or None."""
+        if puzzle.might_solve(question):
+            return None
+        prediction = prediction or local_judge.guess(puzzle, question)
+        if prediction is not None:
+            verdict, confidence, source = prediction.verdict, prediction.confidence, SOURCE_CLASSIFIER
+        else:
+            common = puzzle.common_verdict()
+            if common is None:
+                return None
+            (verdict, confidence), source = common, SOURCE_HISTORY
+        if confidence < self.min_confidence:
+            return None
+        return verdict, source
+
+    def start(
+        self,
+        tasks: ConnectionTasks,
+        puzzle,
+        question: str,
+        generate: Callable[[str], Coroutine],
+        prediction: Optional[Prediction] = None,
+        name: Optional[str] = None
+    ) -> Optional[Speculation]:
+        """Spawn `generate(guessed verdict)` as a transient task; None when not speculating."""
+        if not self.enabled:
+            return None
+        guessed = self.guess(puzzle, question, prediction)
+        if guessed is None:
+            return None
+        verdict, source = guessed
+        tally = usage.TokenTally()
+        task = tasks.spawn(self._counted(generate(verdict), tally), name=name)
+        return Speculation(verdict, source, task, tally)
+
+    @staticmethod
+    async def _counted(coro: Coroutine, tally: usage.TokenTally):
+        with usage.counting(tally):
+            return await coro
+
+    async def settle(self, speculation: Speculation, evaluation: str, answer: str) -> Optional[str]:
+        """The speculative suggestion if the judge answered as guessed; None means generate it again."""
+        hit = evaluation == QUERY_EVALUATION and answer == speculation.verdict
+        metrics.speculative_suggestion(speculation.source, hit)
+        if hit:
+            await asyncio.wait({speculation.task})
+            return "" if speculation.task.cancelled() else speculation.task.result()
+
+        # 猜錯：已送出的請求讓它跑完，記下浪費的 token (連線關閉時照常取消)
+        speculation.task.add_done_callback(lambda task: self._wasted(speculation, answer))
+        return None
+
+    @staticmethod
+    def _wasted(speculation: Speculation, answer: str) -> None:
+        metrics.speculation_wasted(speculation.tally.total)
+        logger.info(
+            f"Speculative suggestion missed: guessed {speculation.verdict} ({speculation.source}), "
+            f"judge said {answer}; {speculation.tally.total} tokens wasted"
+        )
+
+
+# Global speculative suggestions instance
+speculative_suggestions = SpeculativeSuggestions()
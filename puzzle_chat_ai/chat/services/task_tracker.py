@@ -0,0 +1,54 @@
+"""
+Per-connection tracking of background work.
+
+Channels runs a consumer's handlers one at a time, so a 20-second AI call
+inside `receive` also delays the disconnect. Long jobs are therefore spawned
+as tasks registered here. On disconnect, transient jobs (a personal hint or
+suggestion nobody will see) are cancelled, and the cancellation reaches the
+pending aiohttp request. Persistent jobs (a verdict that is saved and
+broadcast to the room) run to completion.
+"""
+
+import asyncio
+import logging
+from typing import Coroutine, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionTasks:
+    """The tasks one WebSocket connection has spawned, with their disconnect policy."""
+
+    def __init__(self, owner: str = ''):
+        self.owner = owner
+        self.closed = False
+        self._tasks: Dict[asyncio.Task, bool] = {}
+
+    def spawn(self, coro: Coroutine, persist: bool = False, name: Optional[str] = None) -> asyncio.Task:
+        """
+        Run `coro` as a task (it inherits the current contextvars, so tracing
+        and usage attribution carry over). `persist=True` keeps it running
+        after the connection closes.
+        """
+        task = asyncio.get_running_loop().create_task(coro, name=name)
+        self._tasks[task] = persist
+        task.add_done_callback(self._finished)
+        if self.closed and not persist:
+            task.cancel()
+        return task
+
+    def _finished(self, task: asyncio.Task) -> None:
+        self._tasks.pop(task, None)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Background task {task.get_name()} of {self.owner} failed: {task.exception()}")
+
+    def close(self) -> int:
+        """Mark the connection closed and cancel its transient tasks; returns how many were cancelled."""
+        self.closed = True
+        transient = [task for task, persist in self._tasks.items() if not persist and not task.done()]
+        for task in transient:
+            task.cancel()
+        return len(transient)
+
+    def __len__(self) -> int:
+        return len(self._tasks)
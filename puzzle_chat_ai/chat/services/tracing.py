@@ -0,0 +1,263 @@
+"""
+Request-scoped tracing for the chat and AI paths.
+
+Spans live in a contextvar, so nested `with tracing.span(...)` blocks inside
+one WebSocket message (consumer -> handler -> AI / DB services) form a single
+trace without passing anything around. The sampling decision is taken once,
+when the root span starts (head-based), and travels with the trace into
+channel-layer events via `inject` / `continue_from`.
+
+Finished spans are written as JSON lines, either one flat object per span
+('json') or one OTLP/JSON ExportTraceServiceRequest per span ('otlp', the
+format the OpenTelemetry collector's file receiver reads).
+"""
+
+import functools
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = 'puzzle_chat_ai'
+
+# 事件中攜帶追蹤資訊的欄位
+TRACE_ID_KEY = 'trace_id'
+TRACE_PARENT_KEY = 'trace_parent'
+
+sample_rate = float(getattr(settings, 'TRACE_SAMPLE_RATE', 0.0) or 0.0)
+enabled = sample_rate > 0
+
+
+class Span:
+    """One timed operation. Only sampled traces create these."""
+
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'start_ns', 'end_ns', 'attributes', 'error')
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes
+        self.error = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def record_error(self, error: BaseException) -> None:
+        self.error = f"{type(error).__name__}: {error}"
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start_ns': self.start_ns,
+            'end_ns': self.end_ns,
+            'duration_ms': round((self.end_ns - self.start_ns) / 1e6, 3),
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': 1,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns),
+            'attributes': [{'key': key, 'value': _otlp_value(value)} for key, value in self.attributes.items()],
+            'status': {'code': 2, 'message': self.error} if self.error else {'code': 1},
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        return {
+            'resourceSpans': [{
+                'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': SERVICE_NAME}}]},
+                'scopeSpans': [{'scope': {'name': __name__}, 'spans': [span]}],
+            }]
+        }
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+class _NoopSpan:
+    """Returned when tracing is off or the trace was not sampled."""
+
+    trace_id = None
+    span_id = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+
+    def record_error(self, error: BaseException) -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+_current_span: ContextVar = ContextVar('chat_current_span', default=None)
+
+
+class JsonLinesExporter:
+    """
+    Writes finished spans from a background thread, so the event loop never
+    blocks on file I/O. Without a path the lines go to this module's logger.
+    """
+
+    def __init__(self, path: str = '', export_format: str = 'json'):
+        self.path = path
+        self.export_format = export_format
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        payload = span.to_otlp() if self.export_format == 'otlp' else span.to_json()
+        line = json.dumps(payload, ensure_ascii=False, default=str)
+        if not self.path:
+            logger.info(line)
+            return
+        self._ensure_thread()
+        self._queue.put(line)
+
+    def _ensure_thread(self) -> None:
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._write_loop, name='trace-exporter', daemon=True)
+                    self._thread.start()
+
+    def _write_loop(self) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as output:
+            while True:
+                lines = [self._queue.get()]
+                # 一次寫出目前排隊中的所有 span
+                while True:
+                    try:
+                        lines.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                output.write('\n'.join(lines) + '\n')
+                output.flush()
+
+
+exporter = JsonLinesExporter(
+    getattr(settings, 'TRACE_EXPORT_PATH', ''),
+    getattr(settings, 'TRACE_EXPORT_FORMAT', 'json'),
+)
+
+# 未取樣的 trace 在 contextvar 中放這個標記，讓子 span 也跳過
+_UNSAMPLED = object()
+
+
+@contextmanager
+def _activate(new_span):
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as error:
+        if isinstance(new_span, Span):
+            new_span.record_error(error)
+        raise
+    finally:
+        _current_span.reset(token)
+        if isinstance(new_span, Span):
+            new_span.end_ns = time.time_ns()
+            exporter.export(new_span)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Start a span under the current one, or a new sampled-or-not trace when
+    there is none. Yields the span (or NOOP_SPAN) for adding attributes.
+    """
+    if not enabled:
+        yield NOOP_SPAN
+        return
+
+    parent = _current_span.get()
+    if parent is _UNSAMPLED:
+        yield NOOP_SPAN
+        return
+    if parent is None:
+        if random.random() >= sample_rate:
+            with _activate(_UNSAMPLED):
+                yield NOOP_SPAN
+            return
+        new_span = Span(name, os.urandom(16).hex(), None, attributes)
+    else:
+        new_span = Span(name, parent.trace_id, parent.span_id, attributes)
+
+    with _activate(new_span):
+        yield new_span
+
+
+@contextmanager
+def continue_from(event: Dict[str, Any], name: str, **attributes):
+    """Continue a trace carried in a channel-layer event; nothing if the event has none."""
+    trace_id = event.get(TRACE_ID_KEY)
+    if not enabled or not trace_id:
+        yield NOOP_SPAN
+        return
+    with _activate(Span(name, trace_id, event.get(TRACE_PARENT_KEY), attributes)) as new_span:
+        yield new_span
+
+
+def inject(event: Dict[str, Any]) -> Dict[str, Any]:
+    """Add the current trace id / span id to an outgoing channel-layer event."""
+    current = _current_span.get() if enabled else None
+    if isinstance(current, Span):
+        event[TRACE_ID_KEY] = current.trace_id
+        event[TRACE_PARENT_KEY] = current.span_id
+    return event
+
+
+def annotate(key: str, value: Any) -> None:
+    """Set an attribute on the current span, if any."""
+    current = _current_span.get() if enabled else None
+    if isinstance(current, Span):
+        current.attributes[key] = value
+
+
+def current_trace_id() -> Optional[str]:
+    current = _current_span.get() if enabled else None
+    return current.trace_id if isinstance(current, Span) else None
+
+
+def traced(name: str):
+    """Decorator: run an async function inside a span called `name`."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not enabled:
+                return await func(*args, **kwargs)
+            with span(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
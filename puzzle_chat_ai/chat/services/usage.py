@@ -0,0 +1,217 @@
+"""
+Token usage accounting and per-room budgets for OpenAI calls.
+
+Every completion's `usage` block is recorded with the room, user, experiment
+mode and prompt path (purpose) it was made for. Rows are buffered in memory
+and written with one bulk insert per flush, so the request path never waits
+on the database. A per-room token counter is kept in the cache for budget
+checks; when a room goes over AI_ROOM_TOKEN_BUDGET its calls are moved to
+AI_MODELS['FAST'] or rejected, depending on AI_ROOM_BUDGET_ACTION.
+
+Callers describe who a call is for with `usage.attribute(...)`; the values
+live in a contextvar, like tracing spans, so the AI service picks them up
+without extra parameters. `usage.counting(tally)` adds up the tokens of the
+calls made inside a block in the same way.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics
+from .metrics import timed_sync_to_async
+
+logger = logging.getLogger(__name__)
+
+BUDGET_DOWNGRADE = 'downgrade'
+BUDGET_REJECT = 'reject'
+
+room_token_budget = int(getattr(settings, 'AI_ROOM_TOKEN_BUDGET', 0) or 0)
+budget_action = getattr(settings, 'AI_ROOM_BUDGET_ACTION', BUDGET_DOWNGRADE)
+budget_window = int(getattr(settings, 'AI_ROOM_BUDGET_WINDOW', 86400))
+flush_size = int(getattr(settings, 'AI_USAGE_FLUSH_SIZE', 50))
+flush_interval = float(getattr(settings, 'AI_USAGE_FLUSH_INTERVAL', 10.0))
+
+_attribution: ContextVar = ContextVar('chat_usage_attribution', default={})
+_tallies: ContextVar = ContextVar('chat_usage_tallies', default=())
+
+
+@contextmanager
+def attribute(**fields):
+    """Attribute AI calls made inside this block (room_name, user_name, mode, purpose)."""
+    token = _attribution.set({**_attribution.get(), **fields})
+    try:
+        yield
+    finally:
+        _attribution.reset(token)
+
+
+def current_attribution() -> Dict[str, Any]:
+    return _attribution.get()
+
+
+class TokenTally:
+    """Prompt and completion tokens of the AI calls made inside `counting(tally)`."""
+
+    def __init__(self):
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    @property
+    def total(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+
+@contextmanager
+def counting(tally: TokenTally):
+    """Add the tokens of AI calls made inside this block (and tasks it spawns) to `tally`."""
+    token = _tallies.set(_tallies.get() + (tally,))
+    try:
+        yield tally
+    finally:
+        _tallies.reset(token)
+
+
+def _room_tokens_key(room_name: str) -> str:
+    return f"ai_usage_tokens:{room_name}"
+
+
+def room_tokens(room_name: str) -> int:
+    return cache.get(_room_tokens_key(room_name)) or 0
+
+
+def check_budget(room_name: Optional[str] = None) -> Optional[str]:
+    """
+    Return None while the room is within its token budget, otherwise the
+    configured action (BUDGET_DOWNGRADE or BUDGET_REJECT).
+    """
+    if not room_token_budget:
+        return None
+    room_name = room_name or _attribution.get().get('room_name')
+    if not room_name:
+        return None
+    try:
+        if room_tokens(room_name) < room_token_budget:
+            return None
+    except Exception as e:
+        logger.error(f"Failed to read token budget for {room_name}: {e}")
+        return None
+    return BUDGET_REJECT if budget_action == BUDGET_REJECT else BUDGET_DOWNGRADE
+
+
+def _add_room_tokens(room_name: str, tokens: int) -> None:
+    key = _room_tokens_key(room_name)
+    try:
+        cache.add(key, 0, budget_window)
+        cache.incr(key, tokens)
+    except ValueError:
+        # 計數器剛好過期，重新開始
+        cache.set(key, tokens, budget_window)
+    except Exception as e:
+        logger.error(f"Failed to update token budget for {room_name}: {e}")
+
+
+class UsageRecorder:
+    """Buffers AIUsage rows and bulk-inserts them every flush_size rows or flush_interval seconds."""
+
+    def __init__(self):
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._pending = set()
+
+    def record(
+        self,
+        model: str,
+        status: Any,
+        usage: Optional[Dict[str, Any]],
+        latency: float,
+        **fields
+    ) -> None:
+        """Record one API call; `fields` override the current attribution."""
+        from ..models import AIUsage
+
+        usage = usage or {}
+        attribution = {**_attribution.get(), **fields}
+        prompt_tokens = int(usage.get('prompt_tokens') or 0)
+        completion_tokens = int(usage.get('completion_tokens') or 0)
+        cached_tokens = int((usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0)
+
+        row = AIUsage(
+            room_name=attribution.get('room_name') or '',
+            user_name=attribution.get('user_name') or '',
+            mode=attribution.get('mode') or '',
+            purpose=attribution.get('purpose') or '',
+            model=model or '',
+            status=str(status),
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            cached_tokens=cached_tokens,
+            latency_ms=int(latency * 1000),
+        )
+
+        if row.room_name and (prompt_tokens or completion_tokens):
+            _add_room_tokens(row.room_name, prompt_tokens + completion_tokens)
+        metrics.observe_tokens(row.model, prompt_tokens, completion_tokens, cached_tokens)
+        for tally in _tallies.get():
+            tally.prompt_tokens += prompt_tokens
+            tally.completion_tokens += completion_tokens
+
+        with self._lock:
+            self._buffer.append(row)
+            due = (
+                len(self._buffer) >= flush_size
+                or time.monotonic() - self._last_flush >= flush_interval
+            )
+        if due:
+            self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush_sync()
+            return
+        task = loop.create_task(self.flush())
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    def _take(self):
+        with self._lock:
+            rows, self._buffer = self._buffer, []
+            self._last_flush = time.monotonic()
+        return rows
+
+    def flush_sync(self) -> int:
+        """Write the buffered rows now; returns how many were written."""
+        from ..models import AIUsage
+
+        rows = self._take()
+        if not rows:
+            return 0
+        try:
+            AIUsage.objects.bulk_create(rows)
+        except Exception as e:
+            logger.error(f"Failed to write {len(rows)} AI usage rows: {e}")
+            return 0
+        return len(rows)
+
+    async def flush(self) -> int:
+        return await timed_sync_to_async('flush_ai_usage', self.flush_sync)()
+
+    async def flush_all(self) -> int:
+        """Wait for scheduled flushes, then write what is left (on shutdown)."""
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+        return await self.flush()
+
+
+# Global usage recorder instance
+recorder = UsageRecorder()
@@ -0,0 +1,230 @@
+"""
+Per-room memo of judge verdicts.
+
+Partners often re-ask a question the other already asked. The memo maps a
+canonical form of the question to the judge's verdict, so a repeat is
+answered from the cache without another judge call, and with the same answer
+as the first time. On first use in a room the memo is seeded from the room's
+AIChatMessage rows, and entries live for CACHE_CONFIG['ROOM_LIFETIME_TIMEOUT'].
+
+Below the room memo sits a puzzle-wide tier filled at deploy time by the
+warm_judge_cache command from historical sessions of the same puzzle. It is
+stored as one cache entry per puzzle and held in process by the puzzle's
+assets (chat.services.puzzle_catalog) as a SimilarityIndex. A warm verdict is
+reused only for the same canonical question. With JUDGE_WARM_FUZZY_MATCH on,
+it also answers questions that differ from a warm one by a character or two,
+but never a pair that differs in negation (沒/不/非/無/未), which flips the
+answer. A room miss that hits the warm tier is copied into the room memo, so
+the room keeps that answer. All keys are namespaced by the puzzle slug.
+"""
+
+import hashlib
+import logging
+import unicodedata
+from collections import Counter, defaultdict
+from typing import Dict, FrozenSet, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+from ..constants import CACHE_CONFIG, JUDGE_VERDICTS, PUZZLE_CATALOG
+from ..models import AIChatMessage
+from . import metrics, tracing
+from .metrics import timed_sync_to_async
+
+logger = logging.getLogger(__name__)
+
+QUERY_EVALUATION = 'query'
+
+# 否定字：只差在這些字的兩個問題答案通常相反
+NEGATION_CHARS = frozenset('沒不非無未')
+
+
+def canonicalize(question: str) -> str:
+    """
+    Fold the variations that don't change a yes/no question: full-width vs
+    half-width characters, case, whitespace, punctuation and symbols.
+    """
+    text = unicodedata.normalize('NFKC', question or '').casefold()
+    return ''.join(
+        char for char in text
+        if not char.isspace() and unicodedata.category(char)[0] not in ('P', 'S')
+    )
+
+
+def negations(canonical: str) -> str:
+    """The negation characters of a canonical question, in order."""
+    return ''.join(char for char in canonical if char in NEGATION_CHARS)
+
+
+def bigrams(canonical: str) -> FrozenSet[str]:
+    """Overlapping character pairs of a canonical string (the string itself when shorter)."""
+    if len(canonical) < 2:
+        return frozenset([canonical]) if canonical else frozenset()
+    return frozenset(canonical[i:i + 2] for i in range(len(canonical) - 1))
+
+
+class SimilarityIndex:
+    """Warm verdicts of one puzzle, with a bigram inverted index for near-identical questions."""
+
+    def __init__(
+        self,
+        verdicts: Dict[str, str],
+        threshold: float = PUZZLE_CATALOG['SIMILARITY_THRESHOLD'],
+        fuzzy: Optional[bool] = None
+    ):
+        self.verdicts = verdicts
+        self.threshold = threshold
+        self.fuzzy = fuzzy if fuzzy is not None else getattr(settings, 'JUDGE_WARM_FUZZY_MATCH', False)
+        # 各答案所占比例，作為沒有其他線索時的先驗
+        counts = Counter(verdicts.values())
+        self.prior = {answer: count / len(verdicts) for answer, count in counts.most_common()}
+        self._sizes = {}
+        self._postings = defaultdict(list)
+        for canonical in verdicts:
+            grams = bigrams(canonical)
+            self._sizes[canonical] = len(grams)
+            for gram in grams:
+                self._postings[gram].append(canonical)
+
+    def __len__(self) -> int:
+        return len(self.verdicts)
+
+    def lookup(self, canonical: str) -> Optional[str]:
+        """
+        The answer to `canonical`. With fuzzy matching on, else the answer to the
+        most similar indexed question at or above the threshold with the same
+        negations.
+        """
+        answer = self.verdicts.get(canonical)
+        if answer is not None or not self.fuzzy or self.threshold >= 1:
+            return answer
+        grams = bigrams(canonical)
+        negated = negations(canonical)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self._postings.get(gram, ()))
+        best, best_score = None, 0.0
+        for candidate, count in shared.items():
+            if negations(candidate) != negated:
+                # 「有…嗎」與「沒有…嗎」字組幾乎相同，答案卻相反
+                continue
+            # Jaccard：共同字組 / 全部字組
+            score = count / (len(grams) + self._sizes[candidate] - count)
+            if score > best_score:
+                best, best_score = candidate, score
+        if best is None or best_score < self.threshold:
+            return None
+        return self.verdicts[best]
+
+
+class VerdictMemo:
+    """Room-scoped (canonical question -> verdict) cache consulted before the judge."""
+
+    def __init__(
+        self,
+        timeout: int = CACHE_CONFIG['ROOM_LIFETIME_TIMEOUT'],
+        warm_timeout: int = CACHE_CONFIG['JUDGE_WARM_TIMEOUT']
+    ):
+        self.timeout = timeout
+        self.warm_timeout = warm_timeout
+
+    def _key(self, puzzle_slug: str, room_name: str, canonical: str) -> str:
+        digest = hashlib.md5(canonical.encode('utf-8')).hexdigest()
+        return f"verdict_memo:{puzzle_slug}:{room_name}:{digest}"
+
+    def _seeded_key(self, puzzle_slug: str, room_name: str) -> str:
+        return f"verdict_memo_seeded:{puzzle_slug}:{room_name}"
+
+    def _warm_key(self, puzzle_slug: str) -> str:
+        return f"verdict_memo_warm:{puzzle_slug}"
+
+    async def lookup(self, room_name: str, question: str, puzzle) -> Optional[Dict[str, str]]:
+        """
+        Return {'evaluation', 'answer'} for a question already judged in this
+        room or in the puzzle's warm tier, else None. `puzzle` is the room's
+        PuzzleAssets.
+        """
+        canonical = canonicalize(question)
+        if not canonical:
+            return None
+
+        try:
+            if not cache.get(self._seeded_key(puzzle.slug, room_name)):
+                await self.seed(room_name, puzzle)
+            room_key = self._key(puzzle.slug, room_name, canonical)
+            verdict = cache.get(room_key)
+            if verdict is None:
+                # 房間沒有紀錄時查謎題的預熱答案 (行程內索引，不需再讀快取)
+                answer = puzzle.warm_verdict(canonical)
+                metrics.cache_lookup('verdict_warm', answer is not None)
+                if answer is not None:
+                    verdict = {'evaluation': QUERY_EVALUATION, 'answer': answer}
+                    cache.add(room_key, verdict, self.timeout)
+        except Exception as e:
+            logger.error(f"Failed to read verdict memo for {room_name}: {e}")
+            return None
+
+        metrics.cache_lookup('verdict_memo', verdict is not None)
+        tracing.annotate('verdict_memo_hit', verdict is not None)
+        return verdict
+
+    def remember(self, room_name: str, question: str, evaluation: str, answer: str, puzzle) -> None:
+        """Store a judge verdict; the first verdict for a question wins."""
+        canonical = canonicalize(question)
+        if not canonical or (evaluation == QUERY_EVALUATION and answer not in JUDGE_VERDICTS):
+            # 只記住正規的裁判答案，錯誤訊息不記
+            return
+        try:
+            cache.add(self._key(puzzle.slug, room_name, canonical), {'evaluation': evaluation, 'answer': answer}, self.timeout)
+        except Exception as e:
+            logger.error(f"Failed to update verdict memo for {room_name}: {e}")
+
+    async def seed(self, room_name: str, puzzle) -> int:
+        """Load the verdicts already given in this room; returns how many entries were added."""
+        try:
+            rows = await timed_sync_to_async('seed_verdict_memo', list)(
+                AIChatMessage.objects.filter(room_name=room_name, ai_message__in=JUDGE_VERDICTS)
+                .order_by('id')
+                .values_list('message', 'ai_message')
+            )
+        except Exception as e:
+            logger.error(f"Failed to seed verdict memo for {room_name}: {e}")
+            return 0
+
+        entries = {}
+        for message, answer in rows:
+            canonical = canonicalize(message)
+            key = self._key(puzzle.slug, room_name, canonical)
+            if canonical and key not in entries:
+                entries[key] = {'evaluation': QUERY_EVALUATION, 'answer': answer}
+
+        # 已在快取中的項目不覆蓋
+        existing = cache.get_many(list(entries)) if entries else {}
+        missing = {key: value for key, value in entries.items() if key not in existing}
+        if missing:
+            cache.set_many(missing, self.timeout)
+        cache.set(self._seeded_key(puzzle.slug, room_name), True, self.timeout)
+        return len(missing)
+
+    def preload(self, puzzle_slug: str, verdicts: Dict[str, str]) -> int:
+        """Replace a puzzle's warm tier with (canonical question -> answer) pairs."""
+        entries = {
+            canonical: answer
+            for canonical, answer in verdicts.items()
+            if canonical and answer in JUDGE_VERDICTS
+        }
+        cache.set(self._warm_key(puzzle_slug), entries, self.warm_timeout)
+        return len(entries)
+
+    def load_warm(self, puzzle_slug: str) -> Optional[Dict[str, str]]:
+        """A puzzle's warm tier as written by preload, or None if it has not been warmed."""
+        try:
+            return cache.get(self._warm_key(puzzle_slug))
+        except Exception as e:
+            logger.error(f"Failed to read warm verdicts of {puzzle_slug}: {e}")
+            return None
+
+
+# Global verdict memo instance
+verdict_memo = VerdictMemo()
@@ -0,0 +1,90 @@
+"""
+WebSocket frame encodings.
+
+JSON text frames stay the default. A client that offers the
+`puzzle-chat.msgpack.v1` subprotocol on connect gets binary MessagePack
+frames instead, with field names replaced by the short integer ids in
+WIRE_FIELD_IDS (nested maps included). A msgpack connection still accepts
+JSON text frames from the client, so it can switch encodings one message
+type at a time.
+"""
+
+import json
+import logging
+from typing import Any, Dict, Iterable, Optional, Union
+
+from ..constants import WIRE_FIELD_IDS
+
+try:
+    import msgpack
+except ImportError:  # 可選套件；沒有安裝時只提供 JSON
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+MSGPACK_SUBPROTOCOL = 'puzzle-chat.msgpack.v1'
+
+_FIELD_NAMES = {field_id: name for name, field_id in WIRE_FIELD_IDS.items()}
+
+# 解碼失敗的例外：JSON 錯誤與非 map 的訊框是 ValueError，其餘來自 msgpack
+DECODE_ERRORS = (ValueError, msgpack.UnpackException) if msgpack is not None else (ValueError,)
+
+
+def _compact(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {WIRE_FIELD_IDS.get(key, key): _compact(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_compact(item) for item in value]
+    return value
+
+
+def _expand(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {_FIELD_NAMES.get(key, key): _expand(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_expand(item) for item in value]
+    return value
+
+
+class JsonCodec:
+    """Text frames with plain JSON objects (the default)."""
+
+    subprotocol: Optional[str] = None
+    binary = False
+
+    def encode(self, frame: Dict[str, Any]) -> str:
+        return json.dumps(frame)
+
+    def decode(self, data: Union[str, bytes]) -> Dict[str, Any]:
+        return json.loads(data)
+
+
+class MsgpackCodec(JsonCodec):
+    """Binary MessagePack frames with short field ids; text frames are still read as JSON."""
+
+    subprotocol = MSGPACK_SUBPROTOCOL
+    binary = True
+
+    def encode(self, frame: Dict[str, Any]) -> bytes:
+        return msgpack.packb(_compact(frame), use_bin_type=True)
+
+    def decode(self, data: Union[str, bytes]) -> Dict[str, Any]:
+        if isinstance(data, str):
+            return json.loads(data)
+        frame = _expand(msgpack.unpackb(data, raw=False, strict_map_key=False))
+        if not isinstance(frame, dict):
+            raise ValueError("Frame is not a map")
+        return frame
+
+
+JSON_CODEC = JsonCodec()
+MSGPACK_CODEC = MsgpackCodec() if msgpack is not None else None
+
+
+def negotiate(subprotocols: Iterable[str]) -> JsonCodec:
+    """Pick the codec for the subprotocols a client offered; JSON unless it asked for msgpack."""
+    if MSGPACK_SUBPROTOCOL in (subprotocols or ()):
+        if MSGPACK_CODEC is not None:
+            return MSGPACK_CODEC
+        logger.warning(f"Client asked for {MSGPACK_SUBPROTOCOL} but msgpack is not installed; using JSON")
+    return JSON_CODEC
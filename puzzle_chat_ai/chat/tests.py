@@ -1,3 +1,368 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import signal
+import tempfile
+from io import StringIO
 
-# Create your tests here.
+from aiohttp import web
+from asgiref.sync import sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+
+from . import prompts
+from .consumers_original import ChatConsumer
+from .constants import DRAIN, FIXED_PUZZLE
+from .models import AIChatMessage, AIUsage, ChatMessage, ChatMessageSummary
+from .openai_stub import create_app
+from .services.drain import drain
+from .services.idempotency import idempotency_store
+from .services.outbound import OutboundQueue
+from .services.puzzle_catalog import PuzzleAssets
+from .services.verdict_cache import SimilarityIndex, canonicalize
+
+
+# 改版前 consumers_original.py 中三個建議條件的提示詞原文 (system, user)
+BASELINE_SUGGESTION_PROMPTS = {
+    'suggestion_baseline': (
+        """
+你是我的「海龜湯」遊戲搭檔。你的目標是根據我的問答和聊天紀錄，為我（使用者名稱：{current_user_name}）草擬一段給夥伴的訊息。
+這段訊息必須以『我』的口吻，包含兩部分：
+1. **口語化總結**：用我的語氣，總結我剛才的發現。
+2. **提出通用的互動問題**：在結尾加上一句「關於這點你有什麼想法嗎？」
+
+**重要**：直接輸出訊息，不要有任何前綴。
+---海龜湯總問題：{puzzle_main_question}---
+""",
+        "# 聊天紀錄:\n{chat_history}\n\n# 我剛才的行動:\n- 我的問題: \"{user_question}\"\n- 裁判的回答: \"{ai_answer}\"\n\n# 請幫我（{current_user_name}）草擬訊息："
+    ),
+    'suggestion_process': (
+        """
+# 在接下來的聊天紀錄中，「Me」代表我本人，「Partner」代表我的夥伴。聊天紀錄:\n{chat_history}\n\n
+
+你是我的「海龜湯」遊戲搭檔，也是一位邏輯清晰的思考者。你的任務是，在我問完裁判後，根據聊天紀錄，幫我（使用者名稱：{current_user_name}）草擬一段訊息，讓他了解我的思考過程。
+
+**結構模板 (必須遵守):**
+1.  **口語化總結**：用口語化的方式，清晰地總結我剛從裁判那裡得到的「發現」。
+
+
+**嚴格禁止**：
+-   搞錯「我」和「夥伴」的角色。
+-   提供任何新的解謎方向或下一步建議。
+-   你的輸出只能是這段要傳給夥伴的訊息，不要包含任何其他前綴或解釋。
+
+---海龜湯總問題：{puzzle_main_question}---
+""",
+        "# 我剛才的行動:\n- 我的問題: \"{user_question}\"\n- 裁判的回答: \"{ai_answer}\"\n\n# 請幫我（{current_user_name}）草擬訊息："
+    ),
+    'suggestion_cohesive': (
+        """
+# 在接下來的聊天紀錄中，「Me」代表我本人，「Partner」代表我的夥伴。聊天紀錄:\n{chat_history}\n\n
+
+你是我的「海龜湯」遊戲搭檔，也是一位頂尖的團隊溝通教練。你會根據我們的聊天紀錄和我剛才的行動，為我（使用者名稱：{current_user_name}）生成一句能「開啟高凝聚力溝通序列」的建議。
+
+**你的行為準則:**
+-   高凝聚力序列：道歉→鼓勵, 回答→提問
+-   你會仔細閱讀聊天紀錄，判斷哪則訊息是哪個使用者說的，以便做出精準的反應，例如肯定夥伴之前提出的觀點，或承認我的想法錯誤。
+
+---
+**核心反應原則 (以『我』的視角)：**
+**0.  **口語化總結**：用口語化的方式，清晰地總結我剛從裁判那裡得到的「發現」。
+
+**1. 當我得到「與此無關」的答案時 (處於逆境):**
+   - **你的目標：** 開啟「道歉→鼓勵」的序列。
+   - **反應策略：** 草擬一個簡短的「道歉」（承認自己想錯了），並把問題拋給夥伴，創造讓他「鼓勵」我的機會。**如果夥伴之前提過不同方向，你必須藉機肯定他。**
+
+**2. 當我得到其他的答案時 (得到一個需要處理的『回答』):**
+   - **你的目標：** 開啟「回答→提問」的序列。
+   - **反應策略：** 草擬一句話，先簡述裁判的「回答」，然後立刻基於這個回答和「聊天紀錄」，向夥伴提出一個能將討論推進下去的建設性「提問」。**如果這個答案驗證了夥伴的猜測，你必須歸功於他。**
+---
+
+   - **注意：** 這個提問必須是開放式的，讓夥伴有空間去思考和回應，而不是簡單的「是」或「否」。
+
+**嚴格禁止**：
+-   搞錯「我」和「夥伴」的角色。
+-   提供任何新的解謎方向或下一步建議。
+-   你的輸出只能是這段要傳給夥伴的訊息，不要包含任何其他前綴或解釋。
+
+請根據聊天紀錄和我提供的「我的問題」和「裁判的回答」，遵循上述原則，先簡述我問了AI什麼問題，以及AI的答覆，再為「我」生成一句最適當的、能開啟高凝聚力溝通序列的訊息。請直接輸出那句話。
+
+---海龜湯總問題：{puzzle_main_question}---
+""",
+        "# 我剛才的行動:\n- 我的問題: \"{user_question}\"\n- 裁判的回答: \"{ai_answer}\"\n\n# 請幫我（{current_user_name}）草擬訊息："
+    ),
+}
+
+
+class PromptPrefixTests(SimpleTestCase):
+    """Static content must stay a byte-identical prefix so provider-side prompt caching applies."""
+
+    CALLS = [
+        {
+            'chat_history': 'Me: 他是名人嗎？\nPartner: 可能吧',
+            'user_question': '他認識老闆嗎？',
+            'ai_answer': '是也不是（測試）',
+            'current_user_name': 'alice',
+        },
+        {
+            'chat_history': 'Partner: 支票有問題？',
+            'user_question': '支票是假的嗎？',
+            'ai_answer': '與此無關',
+            'current_user_name': 'bob',
+        },
+    ]
+
+    def test_suggestion_prefix_is_identical_across_calls(self):
+        for name in ('suggestion_baseline', 'suggestion_process', 'suggestion_cohesive'):
+            template = prompts.get_prompt(name)
+            first, second = (template.render(**call) for call in self.CALLS)
+            with self.subTest(template=name):
+                self.assertEqual(first[0]['content'].encode('utf-8'), second[0]['content'].encode('utf-8'))
+                self.assertNotEqual(first[-1]['content'], second[-1]['content'])
+
+    def test_volatile_values_only_in_last_message(self):
+        for name in ('suggestion_baseline', 'suggestion_process', 'suggestion_cohesive'):
+            messages = prompts.get_prompt(name).render(**self.CALLS[0])
+            with self.subTest(template=name):
+                for value in self.CALLS[0].values():
+                    self.assertNotIn(value, messages[0]['content'])
+                    self.assertIn(value, messages[-1]['content'])
+
+    def test_judge_history_follows_static_prefix(self):
+        history = [{'role': 'user', 'content': '他是名人嗎？'}, {'role': 'assistant', 'content': '是'}]
+        first = prompts.JUDGE.render(history, user_question='他認識老闆嗎？')
+        second = prompts.JUDGE.render(history + [{'role': 'user', 'content': '他很有錢嗎？'}], user_question='支票是假的嗎？')
+
+        self.assertEqual(first[0]['content'].encode('utf-8'), second[0]['content'].encode('utf-8'))
+        # 歷史逐輪增加時，前一輪的整段 messages 仍是下一輪的前綴
+        self.assertEqual(first[:3], second[:3])
+        self.assertEqual(second[-1], {'role': 'user', 'content': '支票是假的嗎？'})
+
+
+
+class SuggestionWordingTests(SimpleTestCase):
+    """Moving volatile values last changes only where the A/B/C condition text sits, not the text itself."""
+
+    CALL = PromptPrefixTests.CALLS[0]
+
+    @staticmethod
+    def lines(*texts):
+        return [line.strip() for text in texts for line in text.splitlines() if line.strip()]
+
+    def test_conditions_keep_their_baseline_wording(self):
+        for name, (system, user) in BASELINE_SUGGESTION_PROMPTS.items():
+            # 唯一的文字改動：使用者名稱不放在系統訊息中，只留在最後「請幫我（名稱）草擬訊息」
+            system = system.replace('（使用者名稱：{current_user_name}）', '')
+            values = dict(self.CALL, puzzle_main_question=FIXED_PUZZLE['question'])
+            baseline = self.lines(system.format(**values), user.format(**values))
+            rendered = self.lines(*(message['content'] for message in prompts.get_prompt(name).render(**self.CALL)))
+            with self.subTest(condition=name):
+                self.assertCountEqual(rendered, baseline)
+
+    def test_baseline_condition_has_no_role_legend(self):
+        _, user = BASELINE_SUGGESTION_PROMPTS['suggestion_baseline']
+        messages = prompts.get_prompt('suggestion_baseline').render(**self.CALL)
+        self.assertEqual(messages[-1]['content'], user.format(**self.CALL))
+        self.assertNotIn('「Partner」', ''.join(message['content'] for message in messages))
+
+
+class WarmVerdictMatchTests(SimpleTestCase):
+    """A warm verdict must never answer a question whose negation differs."""
+
+    POSITIVE = canonicalize('男子跟餐廳老闆之前有商業往來嗎？')
+    NEGATED = canonicalize('男子跟餐廳老闆之前沒有商業往來嗎？')
+
+    def test_exact_match_only_by_default(self):
+        index = SimilarityIndex({self.POSITIVE: '否'})
+        self.assertEqual(index.lookup(self.POSITIVE), '否')
+        self.assertIsNone(index.lookup(canonicalize('男子跟餐廳老闆以前有商業往來嗎')))
+
+    def test_fuzzy_match_refuses_negation_pair(self):
+        index = SimilarityIndex({self.POSITIVE: '否'}, fuzzy=True)
+        self.assertIsNone(index.lookup(self.NEGATED))
+        self.assertIsNone(SimilarityIndex({self.NEGATED: '是'}, fuzzy=True).lookup(self.POSITIVE))
+        # 否定相同、只差一兩個字的問題照常沿用
+        self.assertEqual(index.lookup(canonicalize('男子跟餐廳老闆之前有商業往來嗎嗎')), '否')
+
+
+
+class SolutionPrefilterTests(SimpleTestCase):
+    """The keyword prefilter may skip small talk but never a correct answer in other words."""
+
+    def test_paraphrased_solutions_reach_the_solution_check(self):
+        puzzle = PuzzleAssets('default', FIXED_PUZZLE['question'], FIXED_PUZZLE['answer'])
+        for message in ('老闆想留作紀念所以不兌現', '因為簽名很珍貴', '支票上有他的親筆簽名，老闆會收藏'):
+            with self.subTest(message=message):
+                self.assertTrue(puzzle.might_solve(message))
+        self.assertFalse(puzzle.might_solve('今天天氣很好'))
+
+    def test_curated_keywords_need_several_hits(self):
+        puzzle = PuzzleAssets('curated', FIXED_PUZZLE['question'], FIXED_PUZZLE['answer'], ['簽名', '收藏', '兌現'])
+        self.assertFalse(puzzle.might_solve('因為簽名很珍貴'))
+        self.assertTrue(puzzle.might_solve('簽名支票被收藏了'))
+
+
+class OutboundQueueTests(SimpleTestCase):
+    """A full queue sheds typing frames first and never drops a sequenced event."""
+
+    def setUp(self):
+        self.queue = OutboundQueue(write=None, max_size=3)
+
+    def put(self, frame):
+        return self.queue.put(json.dumps(frame), frame)
+
+    def queued_types(self):
+        return [json.loads(entry.text)['type'] for entry in self.queue._entries]
+
+    def test_sequenced_events_are_never_shed(self):
+        for index in range(3):
+            self.assertTrue(self.put({'type': 'chat_message', 'seq': index}))
+        for frame_type in ('shared_message', 'game_over'):
+            with self.subTest(frame_type=frame_type):
+                self.assertTrue(self.put({'type': frame_type}))
+        self.assertEqual(len(self.queue), 5)
+
+    def test_full_queue_sheds_ephemeral_frames_first(self):
+        self.put({'type': 'typing_indicator', 'user_name': 'a'})
+        self.put({'type': 'chat_message'})
+        self.put({'type': 'chat_message'})
+        self.assertFalse(self.put({'type': 'typing_indicator', 'user_name': 'b'}))
+        # 一般訊息擠掉最舊的暫態訊息；沒有暫態訊息可擠時才丟掉
+        self.assertTrue(self.put({'type': 'user_joined'}))
+        self.assertEqual(self.queued_types(), ['chat_message', 'chat_message', 'user_joined'])
+        self.assertFalse(self.put({'type': 'user_left'}))
+
+    def test_coalesced_frames_replace_in_place(self):
+        self.put({'type': 'like_update', 'message_id': 1, 'likes': 1})
+        self.put({'type': 'typing_indicator', 'user_name': 'a'})
+        self.put({'type': 'like_update', 'message_id': 1, 'likes': 2})
+        self.put({'type': 'stop_typing_indicator', 'user_name': 'a'})
+        self.assertEqual(self.queued_types(), ['like_update', 'stop_typing_indicator'])
+        self.assertEqual(json.loads(self.queue._entries[0].text)['likes'], 2)
+
+
+class ImportDataTests(TestCase):
+    """Importing the same export twice writes nothing the second time, even for rows given new ids."""
+
+    FILES = {
+        'chatmessage_export.csv': (
+            'id,room_name,user_name,message,reply_message,reply_author,timestamp,liked_by\n'
+            '501,ZZ,33,hi,,,2025-07-03T11:37:05.326746+00:00,[]\n'
+            '502,ZZ,Ted,hello,,,2025-07-03T11:37:15.292386+00:00,"[""33""]"\n'
+            '503,ZZ,33,是簽名嗎,,,2025-07-03T11:38:00+00:00,[]\n'
+        ),
+        'chatmessagesummary_export.csv': (
+            'id,room_name,summary_idx,summary_message\n'
+            '601,ZZ,0,第一段摘要\n'
+            '602,ZZ,1,第二段摘要\n'
+        ),
+    }
+
+    def setUp(self):
+        # 其他房間已經用掉部分 id：這些列匯入時會改配新的 id
+        ChatMessage.objects.create(id=502, room_name='other', user_name='x', message='taken')
+        ChatMessageSummary.objects.create(id=602, room_name='other', summary_idx=0, summary_message='taken')
+        self.directory = tempfile.TemporaryDirectory()
+        for name, content in self.FILES.items():
+            with open(os.path.join(self.directory.name, name), 'w', encoding='utf-8') as csvfile:
+                csvfile.write(content)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_reimport_is_idempotent(self):
+        for _ in range(2):
+            call_command('import_data', self.directory.name, stdout=StringIO())
+            for model, rows in ((ChatMessage, 3), (ChatMessageSummary, 2)):
+                with self.subTest(model=model.__name__):
+                    self.assertEqual(model.objects.filter(room_name='ZZ').count(), rows)
+                    self.assertEqual(model.objects.filter(room_name__startswith='ZZ_').count(), 0)
+                    self.assertEqual(model.objects.get(room_name='other').id, 502 if model is ChatMessage else 602)
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+)
+class SigtermDrainTests(TransactionTestCase):
+    """SIGTERM while judge calls are in flight: every accepted question is answered and saved."""
+
+    ROOM = 'drain_room'
+    QUESTIONS = ['他是美食評論家嗎', '餐廳有辦活動嗎', '老闆認識他嗎', '他有付錢嗎', '他很有名嗎', '他是畫家嗎']
+
+    def setUp(self):
+        # 代替伺服器自己的 SIGTERM 處理：drain 結束後訊號會轉交到這裡
+        self.previous_handler = signal.getsignal(signal.SIGTERM)
+        self.forwarded = []
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.forwarded.append(signum))
+
+    def tearDown(self):
+        signal.signal(signal.SIGTERM, self.previous_handler)
+        drain.reset()
+
+    def test_sigterm_under_load_loses_no_accepted_question(self):
+        asyncio.run(self.sigterm_under_load())
+
+    async def connect(self, user_name):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/?userName={user_name}&roomName={self.ROOM}')
+        connected, _ = await communicator.connect()
+        return communicator, connected
+
+    async def sigterm_under_load(self):
+        runner = web.AppRunner(create_app(latency_ms=300, seed=1))
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', 0).start()
+        port = runner.addresses[0][1]
+        try:
+            with self.settings(OPENAI_API_URL=f'http://127.0.0.1:{port}/v1/chat/completions'):
+                await self.drain_during_questions()
+        finally:
+            await runner.cleanup()
+
+    async def drain_during_questions(self):
+        drain.install_signal_handler()
+        players = []
+        for index, question in enumerate(self.QUESTIONS):
+            communicator, connected = await self.connect(f'player{index}')
+            self.assertTrue(connected)
+            await communicator.send_to(text_data=json.dumps({
+                'type': 'ai_chat', 'userName': f'player{index}', 'ai_message': question, 'mode': 'A',
+                'idempotency_key': f'question-{index}',
+            }))
+            players.append(communicator)
+        while len(drain) < len(self.QUESTIONS):
+            await asyncio.sleep(0.01)
+
+        os.kill(os.getpid(), signal.SIGTERM)
+        while not drain.draining:
+            await asyncio.sleep(0.01)
+
+        # 開始關閉後：新問題不受理 (key 釋放以便重送)，新連線被拒
+        await players[0].send_to(text_data=json.dumps({
+            'type': 'ai_chat', 'userName': 'player0', 'ai_message': '他是廚師嗎', 'mode': 'A', 'idempotency_key': 'late',
+        }))
+        late_player, connected = await self.connect('late_player')
+        self.assertFalse(connected)
+
+        for index, communicator in enumerate(players):
+            frames = []
+            while True:
+                output = await communicator.receive_output(timeout=10)
+                if output['type'] == 'websocket.close':
+                    break
+                frames.append(json.loads(output['text']))
+            self.assertEqual(output.get('code'), DRAIN['CLOSE_CODE'])
+            types = [frame['type'] for frame in frames]
+            with self.subTest(player=index):
+                self.assertIn('display_suggestion', types)
+                self.assertEqual(types[-1], 'reconnect')
+                self.assertIn(self.QUESTIONS[index], [frame.get('user_message') for frame in frames])
+        while not self.forwarded:
+            await asyncio.sleep(0.01)
+
+        saved = await sync_to_async(list)(AIChatMessage.objects.filter(room_name=self.ROOM).values_list('message', flat=True))
+        self.assertCountEqual(saved, self.QUESTIONS)
+        # 每題一次裁判與一次建議呼叫，緩衝中的用量在關閉前寫入
+        self.assertEqual(await sync_to_async(AIUsage.objects.count)(), 2 * len(self.QUESTIONS))
+        self.assertIsNone(idempotency_store.claim(self.ROOM, 'player0', 'late'))
@@ -1,9 +1,10 @@
 # chat/views.py (簡化後)
 
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse, Http404
 from asgiref.sync import sync_to_async
 from .models import ChatUser
+from .services import metrics
 
 # 視圖：處理使用者登入頁面
 def login_view(request):
@@ -28,4 +29,10 @@ def check_username_view(request):
         return JsonResponse({'valid': False, 'message': 'Username cannot be empty.'})
     if ChatUser.objects.filter(user_name=user_name).exists():
         return JsonResponse({'valid': False, 'message': 'The name has already been used. Please enter a different name.'})
-    return JsonResponse({'valid': True})
\ No newline at end of file
+    return JsonResponse({'valid': True})
+
+# 視圖：Prometheus 抓取指標 (METRICS_ENABLED 關閉時回傳 404)
+def metrics_view(request):
+    if not metrics.enabled:
+        raise Http404()
+    return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
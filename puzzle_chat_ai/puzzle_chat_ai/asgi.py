@@ -13,11 +13,13 @@ from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 import chat.routing
+from . import lifespan
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'puzzle_chat_ai.settings')
 
 application = ProtocolTypeRouter({
     'http':get_asgi_application(),
+    'lifespan':lifespan.application,
     'websocket':AuthMiddlewareStack(
         URLRouter(
             chat.routing.websocket_urlpatterns
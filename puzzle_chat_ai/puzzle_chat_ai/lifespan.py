@@ -0,0 +1,29 @@
+"""
+ASGI lifespan handling for servers that send it (uvicorn, hypercorn).
+
+On startup the drain (chat.services.drain) takes over SIGTERM and then hands
+the signal on to the server's own handler. On shutdown in-flight AI jobs are
+drained, if SIGTERM has not done so already. Daphne does not send lifespan
+events; it drains through puzzle_chat_ai.server instead.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+async def application(scope, receive, send):
+    from chat.services.drain import drain
+
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            drain.install_signal_handler()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            try:
+                await drain.drain()
+            except Exception as e:
+                logger.error(f"Drain failed: {e}")
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
@@ -0,0 +1,72 @@
+"""
+Daphne with permessage-deflate and a graceful drain on shutdown.
+
+Daphne does not expose autobahn's WebSocket compression options, so this
+entry point runs the stock daphne CLI with a Server that accepts a client's
+permessage-deflate offer (all current browsers send one). Chat frames are
+mostly repeated keys and CJK text and shrink well, and browsers decompress
+transparently, so existing clients need no change.
+
+On SIGTERM daphne cancels every application instance before the reactor
+stops. This Server first drains in-flight AI jobs (chat.services.drain), then
+lets daphne cancel what is left.
+
+    python -m puzzle_chat_ai.server -b 0.0.0.0 -p 8000 puzzle_chat_ai.asgi:application
+
+Takes the same arguments as `daphne`. WS_PERMESSAGE_DEFLATE=False in the
+environment turns compression off.
+"""
+
+import asyncio
+import logging
+
+from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+from daphne.cli import CommandLineInterface
+from daphne.server import Server
+from django.conf import settings
+from twisted.internet import defer
+
+logger = logging.getLogger(__name__)
+
+
+def accept_deflate(offers):
+    """Accept the first permessage-deflate offer; anything else is declined."""
+    for offer in offers:
+        if isinstance(offer, PerMessageDeflateOffer):
+            return PerMessageDeflateOfferAccept(offer)
+    return None
+
+
+class DeflateServer(Server):
+    """Daphne Server whose WebSocket factory negotiates permessage-deflate, and which drains on shutdown."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        ready_callable = self.ready_callable
+
+        # ws_factory is created inside run(); ready_callable runs right after that, before the reactor starts
+        def configure_factory():
+            if getattr(settings, 'WS_PERMESSAGE_DEFLATE', True):
+                self.ws_factory.setProtocolOptions(perMessageCompressionAccept=accept_deflate)
+                logger.info("WebSocket permessage-deflate enabled")
+            if ready_callable:
+                ready_callable()
+
+        self.ready_callable = configure_factory
+
+    def kill_all_applications(self):
+        """Drain first; daphne then cancels the application instances still running."""
+        from chat.services.drain import drain
+
+        drained = defer.Deferred.fromFuture(asyncio.ensure_future(drain.drain()))
+        drained.addErrback(lambda failure: logger.error(f"Drain failed: {failure.value}"))
+        drained.addBoth(lambda _: Server.kill_all_applications(self))
+        return drained
+
+
+class DeflateCommandLineInterface(CommandLineInterface):
+    server_class = DeflateServer
+
+
+if __name__ == '__main__':
+    DeflateCommandLineInterface.entrypoint()
@@ -20,6 +20,8 @@ load_dotenv()
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 openai.api_key = OPENAI_API_KEY
+# 可改指向本機的 OpenAI 替身伺服器 (python manage.py run_openai_stub) 以離線測試
+OPENAI_API_URL = os.getenv("OPENAI_API_URL", "https://api.openai.com/v1/chat/completions")
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -157,6 +159,44 @@ CACHES = {
     }
 }
 
+# Metrics (/metrics, Prometheus text format); off by default
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'False').lower() == 'true'
+
+# Tracing: 取樣比例 (0 = 關閉)、輸出檔案 (空白 = 寫入 log) 與格式 (json / otlp)
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0'))
+TRACE_EXPORT_PATH = os.getenv('TRACE_EXPORT_PATH', '')
+TRACE_EXPORT_FORMAT = os.getenv('TRACE_EXPORT_FORMAT', 'json')
+
+# AI token 用量：每個房間的 token 預算 (0 = 不限)，超過後 downgrade (改用快速模型) 或 reject
+AI_ROOM_TOKEN_BUDGET = int(os.getenv('AI_ROOM_TOKEN_BUDGET', '0'))
+AI_ROOM_BUDGET_ACTION = os.getenv('AI_ROOM_BUDGET_ACTION', 'downgrade')
+AI_ROOM_BUDGET_WINDOW = int(os.getenv('AI_ROOM_BUDGET_WINDOW', '86400'))
+AI_USAGE_FLUSH_SIZE = int(os.getenv('AI_USAGE_FLUSH_SIZE', '50'))
+AI_USAGE_FLUSH_INTERVAL = float(os.getenv('AI_USAGE_FLUSH_INTERVAL', '10'))
+
+# WebSocket 訊息限流 (每位使用者 / 每個房間，上限見 chat.constants.RATE_LIMITS)
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'True').lower() == 'true'
+
+# 啟動時以歷史紀錄預熱裁判快取 (warm_judge_cache)
+JUDGE_CACHE_WARM_ON_STARTUP = os.getenv('JUDGE_CACHE_WARM_ON_STARTUP', 'False').lower() == 'true'
+# 預熱答案也套用到幾乎相同的問題 (否定字不同的問題一律不套用)
+JUDGE_WARM_FUZZY_MATCH = os.getenv('JUDGE_WARM_FUZZY_MATCH', 'False').lower() == 'true'
+
+# 本地裁判分類器：off / shadow (只比對不回答) / on (信心足夠時直接回答)
+JUDGE_CLASSIFIER_MODE = os.getenv('JUDGE_CLASSIFIER_MODE', 'off').lower()
+JUDGE_CLASSIFIER_THRESHOLD = float(os.getenv('JUDGE_CLASSIFIER_THRESHOLD', '0.9'))
+JUDGE_CLASSIFIER_DIR = os.getenv('JUDGE_CLASSIFIER_DIR', str(BASE_DIR / 'judge_models'))
+
+# 裁判作答期間，先以最可能的答案平行產生建議 (猜錯時重新產生，多花 token 換延遲)
+SPECULATIVE_SUGGESTIONS = os.getenv('SPECULATIVE_SUGGESTIONS', 'False').lower() == 'true'
+SPECULATIVE_SUGGESTION_MIN_CONFIDENCE = float(os.getenv('SPECULATIVE_SUGGESTION_MIN_CONFIDENCE', '0'))
+
+# 部署時的優雅關閉：收到 SIGTERM 後等待進行中的 AI 工作的秒數上限
+DRAIN_DEADLINE_SECONDS = float(os.getenv('DRAIN_DEADLINE_SECONDS', '25'))
+
+# WebSocket permessage-deflate 壓縮 (以 python -m puzzle_chat_ai.server 啟動時生效)
+WS_PERMESSAGE_DEFLATE = os.getenv('WS_PERMESSAGE_DEFLATE', 'True').lower() == 'true'
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/5.1/howto/static-files/
 
@@ -12,4 +12,7 @@ urlpatterns = [
 
     # 將所有 /chat/ 開頭的 URL 請求，轉交給 chat app 的 urls.py 檔案
     path('chat/', include('chat.urls')),
+
+    # Prometheus 指標
+    path('metrics', chat_views.metrics_view, name='metrics'),
 ]
\ No newline at end of file
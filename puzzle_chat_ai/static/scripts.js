@@ -53,20 +53,65 @@ const DOMElements = {
 // --- 3. 全域變數 ---
 let tooltipElement = null;
 let tooltipTimeout = null;
+let chatSocket = null;
+let hasConnected = false;
+let reconnectAttempts = 0;
+const RECONNECT_MAX_DELAY_MS = 15000;
+// 尚未收到結果的動作 (idempotency_key -> 訊息)，重連後以同一個 key 重送
+const pendingActions = new Map();
+// 已即時收到結果的 key，伺服器重播同一結果時略過
+const receivedActionKeys = new Set();
+// 房間事件序號：重連時只請伺服器補送 lastSeq 之後的事件
+let lastSeq = 0;
+const seenSeqs = new Set();
 
 // --- 4. WebSocket 連線 ---
-const chatSocket = new WebSocket(`wss://${WEBSOCKET_URL_BASE}/ws/socket-server/?userName=${userName}&roomName=${roomName}`);
+function connectSocket() {
+    chatSocket = new WebSocket(`wss://${WEBSOCKET_URL_BASE}/ws/socket-server/?userName=${userName}&roomName=${roomName}`);
+    chatSocket.onopen = handleSocketOpen;
+    chatSocket.onmessage = handleSocketMessage;
+    chatSocket.onclose = handleSocketClose;
+    chatSocket.onerror = (error) => { console.error('WebSocket Error:', error); };
+}
 
-chatSocket.onopen = () => {
+function handleSocketOpen() {
     console.log('WebSocket connection established for room:', roomName);
-    chatSocket.send(JSON.stringify({ type: 'user_connect', userName }));
-    initializeUIBasedOnMode(); // 初始化UI
-};
+    reconnectAttempts = 0;
+    if (!hasConnected) {
+        hasConnected = true;
+        socketSend({ type: 'user_connect', userName });
+        initializeUIBasedOnMode(); // 初始化UI
+    } else {
+        socketSend({ type: 'user_connect', userName, last_seq: lastSeq });
+    }
+    // 重送斷線前沒有收到結果的動作；伺服器依 key 去重，不會重複處理
+    pendingActions.forEach(payload => socketSend(payload));
+}
 
-chatSocket.onmessage = (event) => {
+function handleSocketClose() {
+    // 指數退避加上隨機延遲，避免所有人同時重連
+    const delay = Math.min(RECONNECT_MAX_DELAY_MS, 500 * 2 ** reconnectAttempts) * (0.5 + Math.random() / 2);
+    reconnectAttempts += 1;
+    console.log(`WebSocket connection closed. Reconnecting in ${Math.round(delay)} ms.`);
+    setTimeout(connectSocket, delay);
+}
+
+function handleSocketMessage(event) {
     const data = JSON.parse(event.data);
     console.log("Received data:", data);
 
+    if (data.idempotency_key) {
+        if (data.replayed && receivedActionKeys.has(data.idempotency_key)) return;
+        if (!data.replayed) receivedActionKeys.add(data.idempotency_key);
+        pendingActions.delete(data.idempotency_key);
+    }
+    // 補送與即時廣播可能重疊，同一序號只處理一次
+    if (typeof data.seq === 'number') {
+        if (seenSeqs.has(data.seq)) return;
+        seenSeqs.add(data.seq);
+        lastSeq = Math.max(lastSeq, data.seq);
+    }
+
     switch (data.type) {
         case 'chat': handleUserChatMessage(data); break;
         case 'ai_chat': handleAIChatMessage(data); break;
@@ -76,14 +121,35 @@ chatSocket.onmessage = (event) => {
         case 'stop_typing': hideTypingIndicator(); break;
         case 'update_thumb_count': updateThumbCount(data.message_index, data.thumb_count, data.likers); break;
         case 'game_over': handleGameOver(data); break;
+        case 'game_info': handleGameInfo(data); break;
+        case 'history_reset': resetHistory(); break;
+        // 伺服器重啟前的提示：連線隨即關閉，立刻重連 (未收到結果的動作會重送)
+        case 'reconnect': reconnectAttempts = 0; break;
         // ⭐ MODIFIED: Handle new 'ai_message_id' property
         case 'display_suggestion': showSuggestion(data.suggestion, data.ai_message_id); break;
         default: console.warn('Unknown message type:', data.type);
     }
-};
+}
+
+function socketSend(payload) {
+    if (chatSocket && chatSocket.readyState === WebSocket.OPEN) {
+        chatSocket.send(JSON.stringify(payload));
+    }
+}
+
+function newIdempotencyKey() {
+    if (window.crypto && typeof window.crypto.randomUUID === 'function') return window.crypto.randomUUID();
+    return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 12)}`;
+}
+
+// 會改變狀態的動作都帶 idempotency_key；awaitResult 時保留到收到結果為止，斷線重連後重送
+function sendAction(payload, awaitResult = true) {
+    const action = { ...payload, idempotency_key: newIdempotencyKey() };
+    if (awaitResult) pendingActions.set(action.idempotency_key, action);
+    socketSend(action);
+}
 
-chatSocket.onclose = () => { console.log('WebSocket connection closed.'); };
-chatSocket.onerror = (error) => { console.error('WebSocket Error:', error); };
+connectSocket();
 
 // --- 5. 事件監聽器 (Event Listeners) ---
 DOMElements.userChat.form.addEventListener('submit', (e) => { e.preventDefault(); sendMessageToUser(); });
@@ -95,8 +161,8 @@ DOMElements.aiChat.messageBox.addEventListener('keydown', (e) => { if (e.key ===
     textarea.addEventListener('input', function () { this.style.height = 'auto'; this.style.height = `${this.scrollHeight}px`; });
 });
 
-DOMElements.userChat.messageBox.addEventListener('input', () => { chatSocket.send(JSON.stringify({ type: 'typing', userName: userName, typing_message: DOMElements.userChat.messageBox.value })); });
-DOMElements.userChat.messagesContainer.parentElement.addEventListener('click', () => { chatSocket.send(JSON.stringify({ type: 'mark_all_read', userName })); });
+DOMElements.userChat.messageBox.addEventListener('input', () => { socketSend({ type: 'typing', userName: userName, typing_message: DOMElements.userChat.messageBox.value }); });
+DOMElements.userChat.messagesContainer.parentElement.addEventListener('click', () => { socketSend({ type: 'mark_all_read', userName }); });
 DOMElements.userChat.messagesContainer.addEventListener('contextmenu', (e) => {
     const messageElement = e.target.closest('.message');
     if (messageElement) { e.preventDefault(); const messageP = messageElement.querySelector('p.current_message'); if (messageP) { const messageText = messageP.textContent; const messageAuthor = messageElement.dataset.author; showCustomContextMenu(e, messageText, messageAuthor); } }
@@ -111,10 +177,10 @@ DOMElements.suggestion.sendBtn.addEventListener('click', () => {
     // ⭐ NEW: Send feedback to server
     const aiMessageId = DOMElements.suggestion.container.dataset.aiMessageId;
     if (aiMessageId) {
-        chatSocket.send(JSON.stringify({
+        sendAction({
             type: 'suggestion_sent',
             ai_message_id: parseInt(aiMessageId)
-        }));
+        }, false);
     }
     // End new code
     if (suggestionText) { DOMElements.userChat.messageBox.value = suggestionText; sendMessageToUser(); hideSuggestion(); DOMElements.userChat.messageBox.style.height = 'auto'; DOMElements.userChat.messageBox.style.height = `${DOMElements.userChat.messageBox.scrollHeight}px`; } });
@@ -122,10 +188,10 @@ DOMElements.suggestion.dismissBtn.addEventListener('click', () => {
     // ⭐ NEW: Send feedback to server
     const aiMessageId = DOMElements.suggestion.container.dataset.aiMessageId;
     if (aiMessageId) {
-        chatSocket.send(JSON.stringify({
+        sendAction({
             type: 'suggestion_dismissed',
             ai_message_id: parseInt(aiMessageId)
-        }));
+        }, false);
     }
     // End new code
     hideSuggestion();
@@ -141,7 +207,7 @@ function sendMessageToUser() {
     const replyContainer = DOMElements.userChat.replyContainer;
     let replyText = replyContainer.dataset.replyText || '';
     let replyAuthor = replyContainer.dataset.replyAuthor || '';
-    chatSocket.send(JSON.stringify({ type: 'chat', userName, message, replyText, replyAuthor }));
+    sendAction({ type: 'chat', userName, message, replyText, replyAuthor });
     DOMElements.userChat.messageBox.value = '';
     DOMElements.userChat.messageBox.style.height = 'auto';
     hideReplyPreview();
@@ -152,7 +218,7 @@ function sendMessageToAI() {
     if (!message) return;
     appendAIMessage(userName, message);
     appendAIMessage('ai', '...', true);
-    chatSocket.send(JSON.stringify({ type: 'ai_chat', userName, ai_message: message, mode: MODE }));
+    sendAction({ type: 'ai_chat', userName, ai_message: message, mode: MODE });
     DOMElements.aiChat.messageBox.value = '';
     DOMElements.aiChat.messageBox.style.height = 'auto';
 }
@@ -184,7 +250,9 @@ function handleAIChatMessage(data) {
     }
 }
 function loadAIChatMessage(data) { const { userName: sender, user_message, ai_reply_content } = data; if (userName === sender) { appendAIMessage(sender, user_message); appendAIMessage('ai', ai_reply_content); } else { updateSharedContent(data); } }
-function handleGameInfo(data) { const puzzleBox = document.getElementById('puzzle-question-text'); if (puzzleBox) { puzzleBox.textContent = data.puzzle_question; } }
+function handleGameInfo(data) { const puzzleBox = document.getElementById('puzzle-question-text'); if (puzzleBox) { puzzleBox.textContent = data.puzzle_question; } if (typeof data.last_seq === 'number') { lastSeq = Math.max(lastSeq, data.last_seq); } }
+// 斷線太久、伺服器無法補送時，清空畫面等待完整歷史重新載入
+function resetHistory() { DOMElements.userChat.messagesContainer.innerHTML = ''; DOMElements.aiChat.messagesContainer.innerHTML = ''; DOMElements.sharedContent.messagesContainer.innerHTML = ''; seenSeqs.clear(); lastSeq = 0; }
 
 // --- 7. UI 與輔助函式 (UI & Helper Functions) ---
 
@@ -271,7 +339,7 @@ function showCustomContextMenu(event, messageText, messageAuthor) { const existi
 function showReplyPreview(messageText, messageAuthor) { const container = DOMElements.userChat.replyContainer; container.style.display = 'block'; container.dataset.replyText = messageText; container.dataset.replyAuthor = messageAuthor; const previewText = messageText.length > 50 ? messageText.substring(0, 50) + '...' : messageText; container.innerHTML = `回覆: ${previewText} <span id="close-reply">×</span>`; container.querySelector('#close-reply').addEventListener('click', (e) => { e.stopPropagation(); hideReplyPreview(); }); }
 function hideReplyPreview() { const container = DOMElements.userChat.replyContainer; container.style.display = 'none'; container.textContent = ''; container.dataset.replyText = ''; container.dataset.replyAuthor = ''; }
 DOMElements.userChat.messagesContainer.addEventListener('click', (e) => { const thumbIcon = e.target.closest('.thumb-icon'); if (thumbIcon) { toggleThumb(thumbIcon); } });
-function toggleThumb(element) { const messageElement = element.closest('.message'); const messageIndex = messageElement.dataset.index; chatSocket.send(JSON.stringify({ type: 'thumb_press', userName, index: messageIndex })); }
+function toggleThumb(element) { const messageElement = element.closest('.message'); const messageIndex = messageElement.dataset.index; sendAction({ type: 'thumb_press', userName, index: messageIndex }); }
 function updateThumbCount(messageIndex, thumbCount, likers) { const messageElement = document.querySelector(`.message[data-index="${messageIndex}"]`); if (!messageElement) return; const thumbCountElement = messageElement.querySelector('.thumb-count'); const thumbIcon = messageElement.querySelector('.thumb-icon'); if (thumbCountElement) thumbCountElement.textContent = thumbCount; if (thumbIcon && likers) { const hasLiked = likers.includes(userName); thumbIcon.classList.toggle('blue', hasLiked); thumbIcon.classList.toggle('gray', !hasLiked); } }
 function markMessagesAsRead(notifiedPerson) { if (userName === notifiedPerson) { const ownMessages = document.querySelectorAll('.message.own'); ownMessages.forEach(msg => { const bundle = msg.querySelector('.message-bundle'); if (bundle && !bundle.querySelector('.read-status')) { const status = document.createElement('span'); status.className = 'read-status'; status.textContent = '已讀'; bundle.appendChild(status); } }); } }
 function showTooltip(targetElement, text) { if (tooltipTimeout) clearTimeout(tooltipTimeout); if (tooltipElement) tooltipElement.remove(); tooltipElement = document.createElement('div'); tooltipElement.className = 'universal-tooltip'; tooltipElement.textContent = text; document.body.appendChild(tooltipElement); const targetRect = targetElement.getBoundingClientRect(); const tooltipRect = tooltipElement.getBoundingClientRect(); let top = targetRect.top - tooltipRect.height - 8; let left = targetRect.left + (targetRect.width / 2) - (tooltipRect.width / 2); if (top < 0) top = targetRect.bottom + 8; if (left < 0) left = 5; if (left + tooltipRect.width > window.innerWidth) left = window.innerWidth - tooltipRect.width - 5; tooltipElement.style.top = `${top + window.scrollY}px`; tooltipElement.style.left = `${left + window.scrollX}px`; tooltipElement.style.opacity = '1'; }